@@ -0,0 +1,226 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark for directory listing parsing: entries/sec and MB/sec through the
+generic HTMLParser path versus the autoindex fast path, on large listings in
+the markup Apache (table and pre), nginx and lighttpd generate.
+
+usage: bench/listing.py [-n ENTRIES] [-r ROUNDS] [-w DIR]
+"""
+
+# Stdlib imports
+import os
+import sys
+import time
+import random
+import logging
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Internal imports
+from megamaid.grabber import LinkParser
+from megamaid.listing import detect_format
+
+NAMES = [
+    "base{}.tgz",
+    "install{}.iso",
+    "FreeBSD-{}.0-RELEASE-amd64-disc1.iso",
+    "linux-6.{}.tar.xz",
+    "patch-6.{}.3.xz",
+    "packages-2024{}.txt",
+    "R&D notes {}.pdf",
+]
+
+MONTHS = "Jan Feb Mar Apr May Jun Jul Aug Sep Oct Nov Dec".split()
+
+
+def entries(n):
+    random.seed(0)
+    retv = []
+    for i in range(n):
+        when = time.gmtime(1500000000 + random.randint(0, 250000000))
+        if i % 10 == 0:
+            retv.append((f"dir{i}/", None, when))
+        else:
+            name = random.choice(NAMES).format(i)
+            retv.append((name, random.randint(0, 5 * 1024**3), when))
+    return retv
+
+
+def human(size):
+    for unit in "KMGT":
+        size /= 1024
+        if size < 1024:
+            return f"{size:.1f}{unit}" if size < 10 else f"{size:.0f}{unit}"
+    return f"{size:.0f}P"
+
+
+def quote(name):
+    return name.replace("&", "&amp;").replace(" ", "%20")
+
+
+def apache_table(rows):
+    out = [
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n'
+        "  <title>Index of /pub</title>\n </head>\n <body>\n<h1>Index of /pub</h1>\n"
+        '  <table>\n   <tr><th valign="top"><img src="/icons/blank.gif" alt="[ICO]"></th>'
+        '<th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th>'
+        '<th><a href="?C=S;O=A">Size</a></th><th><a href="?C=D;O=A">Description</a></th></tr>\n'
+        '   <tr><th colspan="5"><hr></th></tr>\n'
+        '<tr><td valign="top"><img src="/icons/back.gif" alt="[PARENTDIR]"></td>'
+        '<td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td>'
+        "<td>&nbsp;</td></tr>\n"
+    ]
+    for name, size, when in rows:
+        out.append(
+            '<tr><td valign="top"><img src="/icons/unknown.gif" alt="[   ]"></td>'
+            f'<td><a href="{quote(name)}">{name.replace("&", "&amp;")}</a></td>'
+            f'<td align="right">{time.strftime("%Y-%m-%d %H:%M", when)}  </td>'
+            f'<td align="right">{"  - " if size is None else human(size)}</td>'
+            "<td>&nbsp;</td></tr>\n"
+        )
+    out.append('   <tr><th colspan="5"><hr></th></tr>\n</table>\n</body></html>\n')
+    return "".join(out).encode()
+
+
+def apache_pre(rows):
+    out = [
+        '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 3.2 Final//EN">\n<html>\n <head>\n'
+        "  <title>Index of /pub</title>\n </head>\n <body>\n<h1>Index of /pub</h1>\n"
+        '<pre><img src="/icons/blank.gif" alt="Icon "> <a href="?C=N;O=D">Name</a>'
+        '                    <a href="?C=M;O=A">Last modified</a>      '
+        '<a href="?C=S;O=A">Size</a>  <a href="?C=D;O=A">Description</a><hr>'
+        '<img src="/icons/back.gif" alt="[PARENTDIR]"> <a href="/">Parent Directory</a>'
+        "                             -   \n"
+    ]
+    for name, size, when in rows:
+        label = name if len(name) <= 23 else name[:20] + "..&gt;"
+        out.append(
+            '<img src="/icons/unknown.gif" alt="[   ]"> '
+            f'<a href="{quote(name)}">{label.replace("&", "&amp;")}</a>'
+            f'{" " * max(1, 24 - len(label))}{time.strftime("%Y-%m-%d %H:%M", when)}  '
+            f'{"  - " if size is None else human(size):>4}  \n'
+        )
+    out.append("<hr></pre>\n</body></html>\n")
+    return "".join(out).encode()
+
+
+def nginx(rows):
+    out = [
+        "<html>\n<head><title>Index of /pub/</title></head>\n<body>\n"
+        '<h1>Index of /pub/</h1><hr><pre><a href="../">../</a>\n'
+    ]
+    for name, size, when in rows:
+        label = name if len(name) <= 50 else name[:47] + "..&gt;"
+        stamp = f"{when.tm_mday:02}-{MONTHS[when.tm_mon - 1]}-{when.tm_year}"
+        out.append(
+            f'<a href="{quote(name)}">{label.replace("&", "&amp;")}</a>'
+            f'{" " * max(1, 51 - len(label))}{stamp} {time.strftime("%H:%M", when)}'
+            f'{"-" if size is None else size:>20}\n'
+        )
+    out.append("</pre><hr></body>\n</html>\n")
+    return "".join(out).encode()
+
+
+def lighttpd(rows):
+    out = [
+        '<?xml version="1.0" encoding="utf-8"?>\n<!DOCTYPE html>\n'
+        '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">\n'
+        "<head>\n<title>Index of /pub/</title>\n</head>\n<body>\n"
+        '<h2>Index of /pub/</h2>\n<div class="list">\n'
+        '<table summary="Directory Listing" cellpadding="0" cellspacing="0">\n'
+        '<thead><tr><th class="n">Name</th><th class="m">Last Modified</th>'
+        '<th class="s">Size</th><th class="t">Type</th></tr></thead>\n<tbody>\n'
+        '<tr class="d"><td class="n"><a href="../">Parent Directory</a>/</td>'
+        '<td class="m">&nbsp;</td><td class="s">- &nbsp;</td>'
+        '<td class="t">Directory</td></tr>\n'
+    ]
+    for name, size, when in rows:
+        stamp = time.strftime("%Y-%b-%d %H:%M:%S", when)
+        if size is None:
+            out.append(
+                f'<tr class="d"><td class="n"><a href="{quote(name)}">{name[:-1]}</a>/</td>'
+                f'<td class="m">{stamp}</td><td class="s">- &nbsp;</td>'
+                '<td class="t">Directory</td></tr>\n'
+            )
+        else:
+            out.append(
+                f'<tr><td class="n"><a href="{quote(name)}">{name.replace("&", "&amp;")}</a></td>'
+                f'<td class="m">{stamp}</td><td class="s">{human(size)}</td>'
+                '<td class="t">application/octet-stream</td></tr>\n'
+            )
+    out.append(
+        '</tbody>\n</table>\n</div>\n<div class="foot">lighttpd/1.4.69</div>\n'
+        "</body>\n</html>\n"
+    )
+    return "".join(out).encode()
+
+
+FIXTURES = {
+    "apache-table": apache_table,
+    "apache-pre": apache_pre,
+    "nginx": nginx,
+    "lighttpd": lighttpd,
+}
+
+
+class Collector(list):
+    put = list.append
+
+
+def run(data, fast):
+    parser = LinkParser()
+    parser.site = "http://mirror.example.org/pub"
+    parser.site_q = Collector()
+    parser.link_q = Collector()
+    parser.gui_q = Collector()
+    parser.log_q = logging.getLogger("bench")
+    parser.recursive = True
+    if fast:
+        parser.parse(data)
+    else:
+        parser.feed(data.decode("utf-8"))
+    parser.close()
+    return sorted(r.url for r in parser.link_q) + sorted(parser.site_q)
+
+
+def bench(name, data, fast, rounds):
+    best = None
+    for _ in range(rounds):
+        st = time.perf_counter()
+        found = run(data, fast)
+        el = time.perf_counter() - st
+        best = el if best is None else min(best, el)
+    print(
+        f"  {name:<12} {len(found) / best:>12,.0f} entries/sec "
+        f"{len(data) / best / 1024**2:>8.1f} MB/sec"
+    )
+    return found
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(os.path.basename(__file__))
+    parser.add_argument("-n", "--entries", type=int, default=100000)
+    parser.add_argument("-r", "--rounds", type=int, default=3)
+    parser.add_argument(
+        "-w", "--write", metavar="DIR", help="also save the fixtures to DIR"
+    )
+    args = parser.parse_args()
+
+    rows = entries(args.entries)
+    failed = False
+    for name, gen in FIXTURES.items():
+        data = gen(rows)
+        if args.write:
+            os.makedirs(args.write, exist_ok=True)
+            with open(os.path.join(args.write, f"{name}.html"), "wb") as fp:
+                fp.write(data)
+        print(f"{name} ({len(data) / 1024**2:.1f} MB, detected as {detect_format(data)})")
+        a = bench("HTMLParser", data, False, args.rounds)
+        b = bench("autoindex", data, True, args.rounds)
+        if a != b:
+            print("  MISMATCH: the parsers found different entries")
+            failed = True
+    if failed:
+        sys.exit(1)
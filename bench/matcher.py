@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmark for LinkMatcher: links/sec through the old per-link
+re.compile() loop versus the precompiled matcher.
+
+usage: bench/matcher.py [-n LINKS] [-r ROUNDS]
+"""
+
+# Stdlib imports
+import os
+import re
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Internal imports
+from megamaid.matcher import LinkMatcher
+
+# The README's example patterns
+PATTERNS = [
+    r".*(FreeBSD-[0-9].*|NetBSD-[0-9].*)\.(iso|img)$",
+    r"^.*(linux-[0-9].*\.0\.tar|patch-[0-9]*\.[0-9]*\.[0-9]*)\.xz$",
+    r"^.*(install|floppy|inst|kc|cd|cdrom|upgr|upgrade|floppy[A-Z])[0-9][0-9]\.(fs|img|iso)$",
+    r".*SHA256$",
+    r".*\.(iso|img)$",
+]
+
+NAMES = [
+    "base74.tgz",
+    "comp74.tgz",
+    "install74.iso",
+    "install74.img",
+    "FreeBSD-14.0-RELEASE-amd64-disc1.iso",
+    "NetBSD-9.3-amd64.iso",
+    "linux-6.0.tar.xz",
+    "linux-6.1.3.tar.xz",
+    "patch-6.1.3.xz",
+    "SHA256",
+    "SHA256.sig",
+    "index.txt",
+    "bsd.rd",
+    "packages-20240101.txt",
+]
+
+
+def links(n):
+    random.seed(0)
+    retv = []
+    for _ in range(n):
+        depth = random.randint(1, 5)
+        path = "/".join(f"dir{random.randint(0, 99)}" for _ in range(depth))
+        retv.append(f"https://mirror.example.org/pub/{path}/{random.choice(NAMES)}")
+    return retv
+
+
+def old_filter(link, patterns):
+    # LinkFilter.run() before LinkMatcher
+    shipit = False
+    for patt in patterns:
+        if re.compile(patt).match(link):
+            shipit = True
+    return shipit
+
+
+def bench(name, fn, sample, rounds):
+    best = None
+    for _ in range(rounds):
+        st = time.perf_counter()
+        hits = sum(1 for link in sample if fn(link))
+        el = time.perf_counter() - st
+        best = el if best is None else min(best, el)
+    print(f"{name:<12} {len(sample) / best:>12,.0f} links/sec  ({hits} matched)")
+    return hits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(os.path.basename(__file__))
+    parser.add_argument("-n", "--links", type=int, default=200000)
+    parser.add_argument("-r", "--rounds", type=int, default=3)
+    args = parser.parse_args()
+
+    sample = links(args.links)
+    matcher = LinkMatcher(PATTERNS)
+    a = bench("re.compile", lambda l: old_filter(l, PATTERNS), sample, args.rounds)
+    b = bench("LinkMatcher", matcher.match, sample, args.rounds)
+    if a != b:
+        print("MISMATCH: the matchers disagree")
+        sys.exit(1)
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+
+"""
+End to end benchmark: serves a synthetic mirror tree from local stand-in HTTP
+(Apache, nginx or lighttpd style autoindex pages) and FTP servers, runs the
+whole megamaid.py pipeline against it, and reports listings/sec, links/sec,
+files/sec, MB/s, peak RSS and time to completion as JSON, to compare runs by.
+Options after -- go to megamaid.py.
+
+usage: bench/pipeline.py [-P {http,ftp}] [-s STYLE] [--no-mlsd] [-D DEPTH]
+                         [-F FANOUT] [-n FILES] [-S SIZES] [-L MS] [-l RATE]
+                         [-r RUNS] [-i SECS] [-o FILE] [-c BASE] [-k]
+                         [-- megamaid.py options]
+"""
+
+# Stdlib imports
+import os
+import sys
+import json
+import math
+import time
+import random
+import shutil
+import socket
+import argparse
+import posixpath
+import tempfile
+import threading
+import statistics
+import subprocess
+import socketserver
+
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import unquote, urlsplit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Internal imports
+from megamaid.throttle import parse_rate
+from listing import apache_pre, apache_table, lighttpd, nginx
+
+MEGAMAID = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "megamaid.py")
+
+STYLES = {
+    "apache": apache_table,
+    "apache-pre": apache_pre,
+    "nginx": nginx,
+    "lighttpd": lighttpd,
+}
+
+# File contents are this block, repeated
+BLOCK = 1024 * 1024
+
+CHUNK = 65536
+
+# Lower is better for these, higher for the rest
+COSTS = ("seconds", "wall_seconds", "peak_rss")
+
+
+def size_dist(spec):
+    # "64K" fixed, "1K-4M" uniform, "logn:256K" lognormal around a median
+    if spec.startswith("logn:"):
+        mu = math.log(parse_rate(spec[5:]))
+        return lambda rnd: int(rnd.lognormvariate(mu, 1.0))
+    lo, sep, hi = spec.partition("-")
+    if sep:
+        lo, hi = parse_rate(lo), parse_rate(hi)
+        return lambda rnd: rnd.randint(lo, hi)
+    size = parse_rate(spec)
+    return lambda rnd: size
+
+
+class Tree:
+    """
+    A synthetic mirror: `depth` levels of `fanout` subdirectories, each
+    directory holding `files` files, sizes drawn from `sizes`.
+    """
+
+    def __init__(self, depth, fanout, files, sizes, seed=0):
+        rnd = random.Random(seed)
+        draw = size_dist(sizes)
+        self.dirs = {}
+        self.files = {}
+        self.block = memoryview(rnd.randbytes(BLOCK))
+        todo = [("/", 0)]
+        while todo:
+            path, level = todo.pop()
+            # names differ between directories, or a listing that repeats
+            # its parent's looks like a symlink loop
+            tag = len(self.dirs)
+            rows = []
+            if level < depth:
+                for i in range(fanout):
+                    name = f"dir{tag}-{i}/"
+                    rows.append((name, None, 1700000000 + rnd.randrange(10**7)))
+                    todo.append((f"{path}{name}", level + 1))
+            for i in range(files):
+                name = f"file{tag}-{i}.bin"
+                size, mtime = draw(rnd), 1700000000 + rnd.randrange(10**7)
+                rows.append((name, size, mtime))
+                self.files[f"{path}{name}"] = (size, mtime)
+            self.dirs[path] = rows
+
+    def summary(self):
+        return {
+            "dirs": len(self.dirs),
+            "files": len(self.files),
+            "bytes": sum(size for size, _ in self.files.values()),
+        }
+
+
+def paced(write, block, start, stop, rate):
+    # Send bytes [start, stop) of a file, at no more than `rate` bytes/sec
+    st = time.perf_counter()
+    pos = start
+    while pos < stop:
+        off = pos % BLOCK
+        n = min(CHUNK, stop - pos, BLOCK - off)
+        write(block[off : off + n])
+        pos += n
+        if rate:
+            ahead = (pos - start) / rate - (time.perf_counter() - st)
+            if ahead > 0:
+                time.sleep(ahead)
+
+
+class HttpHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # headers and body go out in separate writes, Nagle would hold the body
+    # back until the client's delayed ACK
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self._serve(False)
+
+    def do_GET(self):
+        self._serve(True)
+
+    def _serve(self, body):
+        srv = self.server
+        if srv.latency:
+            time.sleep(srv.latency)
+        path = unquote(urlsplit(self.path).path)
+        if path in srv.tree.dirs:
+            data = srv.page(path)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/html")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            if body:
+                self.wfile.write(data)
+            return
+        if path not in srv.tree.files:
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        size, mtime = srv.tree.files[path]
+        start, stop = 0, size
+        rng = self.headers.get("Range", "")
+        if rng.startswith("bytes=") and size:
+            first, _, last = rng[6:].split(",")[0].partition("-")
+            start = int(first or 0)
+            stop = min(size, int(last) + 1) if last else size
+        self.send_response(206 if stop - start < size else 200)
+        if stop - start < size:
+            self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{size}")
+        self.send_header("Content-Length", str(stop - start))
+        self.send_header("Last-Modified", formatdate(mtime, usegmt=True))
+        self.send_header("ETag", f'"{size:x}-{mtime:x}"')
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+        if body:
+            paced(self.wfile.write, srv.tree.block, start, stop, srv.rate)
+
+
+class HttpMirror(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, tree, style, latency=0.0, rate=0):
+        ThreadingHTTPServer.__init__(self, ("127.0.0.1", 0), HttpHandler)
+        self.tree = tree
+        self.style = STYLES[style]
+        self.latency = latency
+        self.rate = rate
+        self._pages = {}
+
+    def page(self, path):
+        if path not in self._pages:
+            rows = [(n, s, time.gmtime(m)) for n, s, m in self.tree.dirs[path]]
+            self._pages[path] = self.style(rows)
+        return self._pages[path]
+
+
+class FtpHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.cwd = "/"
+        self.rest = 0
+        self.pasv = None
+        self.reply("220 megamaid bench FTP")
+        for raw in self.rfile:
+            cmd, _, arg = raw.decode("utf-8", "replace").rstrip("\r\n").partition(" ")
+            if self.server.latency:
+                time.sleep(self.server.latency)
+            func = getattr(self, f"ftp_{cmd.upper()}", None)
+            if func is None:
+                self.reply("502 Command not implemented")
+            elif func(arg) is False:
+                break
+        if self.pasv:
+            self.pasv.close()
+
+    def reply(self, line):
+        self.wfile.write(f"{line}\r\n".encode())
+
+    def resolve(self, arg):
+        return posixpath.normpath(posixpath.join(self.cwd, arg or "."))
+
+    def data(self):
+        if self.pasv is None:
+            self.reply("425 Use PASV first")
+            return None
+        self.pasv.settimeout(10)
+        try:
+            conn, _ = self.pasv.accept()
+        finally:
+            self.pasv.close()
+            self.pasv = None
+        return conn
+
+    def ftp_USER(self, arg):
+        self.reply("331 Any password will do")
+
+    def ftp_PASS(self, arg):
+        self.reply("230 Logged in")
+
+    def ftp_SYST(self, arg):
+        self.reply("215 UNIX Type: L8")
+
+    def ftp_TYPE(self, arg):
+        self.reply("200 Type set")
+
+    def ftp_NOOP(self, arg):
+        self.reply("200 NOOP ok")
+
+    def ftp_QUIT(self, arg):
+        self.reply("221 Bye")
+        return False
+
+    def ftp_PWD(self, arg):
+        self.reply(f'257 "{self.cwd}"')
+
+    def ftp_CWD(self, arg):
+        path = self.resolve(arg)
+        if path.rstrip("/") + "/" in self.server.tree.dirs:
+            self.cwd = path
+            self.reply("250 Directory changed")
+        else:
+            self.reply("550 No such directory")
+
+    def ftp_PASV(self, arg):
+        if self.pasv:
+            self.pasv.close()
+        self.pasv = socket.create_server(("127.0.0.1", 0))
+        port = self.pasv.getsockname()[1]
+        self.reply(f"227 Entering Passive Mode (127,0,0,1,{port >> 8},{port & 255})")
+
+    def ftp_EPSV(self, arg):
+        if self.pasv:
+            self.pasv.close()
+        self.pasv = socket.create_server(("127.0.0.1", 0))
+        port = self.pasv.getsockname()[1]
+        self.reply(f"229 Entering Extended Passive Mode (|||{port}|)")
+
+    def ftp_REST(self, arg):
+        self.rest = int(arg)
+        self.reply(f"350 Restarting at {self.rest}")
+
+    def ftp_SIZE(self, arg):
+        entry = self.server.tree.files.get(self.resolve(arg))
+        self.reply(f"213 {entry[0]}" if entry else "550 No such file")
+
+    def ftp_MDTM(self, arg):
+        entry = self.server.tree.files.get(self.resolve(arg))
+        if entry:
+            self.reply(f"213 {time.strftime('%Y%m%d%H%M%S', time.gmtime(entry[1]))}")
+        else:
+            self.reply("550 No such file")
+
+    def ftp_RETR(self, arg):
+        entry = self.server.tree.files.get(self.resolve(arg))
+        start, self.rest = self.rest, 0
+        if not entry:
+            self.reply("550 No such file")
+            return
+        self.reply("150 Opening BINARY mode data connection")
+        conn = self.data()
+        if conn is None:
+            return
+        with conn:
+            srv = self.server
+            paced(conn.sendall, srv.tree.block, start, entry[0], srv.rate)
+        self.reply("226 Transfer complete")
+
+    def _listing(self, arg, fmt):
+        rows = self.server.tree.dirs.get(self.resolve(arg).rstrip("/") + "/")
+        if rows is None:
+            self.reply("550 No such directory")
+            return
+        self.reply("150 Here comes the listing")
+        conn = self.data()
+        if conn is None:
+            return
+        with conn:
+            conn.sendall("".join(fmt(*row) for row in rows).encode())
+        self.reply("226 Listing sent")
+
+    def ftp_MLSD(self, arg):
+        if not self.server.mlsd:
+            self.reply("500 MLSD not understood")
+            return
+
+        def fmt(name, size, mtime):
+            stamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(mtime))
+            if size is None:
+                return f"type=dir;modify={stamp}; {name[:-1]}\r\n"
+            return f"type=file;size={size};modify={stamp}; {name}\r\n"
+
+        self._listing(arg, fmt)
+
+    def ftp_LIST(self, arg):
+        def fmt(name, size, mtime):
+            stamp = time.strftime("%b %d  %Y", time.gmtime(mtime))
+            if size is None:
+                return f"drwxr-xr-x 2 ftp ftp {4096:>12} {stamp} {name[:-1]}\r\n"
+            return f"-rw-r--r-- 1 ftp ftp {size:>12} {stamp} {name}\r\n"
+
+        self._listing(arg, fmt)
+
+
+class FtpMirror(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, tree, latency=0.0, rate=0, mlsd=True):
+        socketserver.ThreadingTCPServer.__init__(self, ("127.0.0.1", 0), FtpHandler)
+        self.tree = tree
+        self.latency = latency
+        self.rate = rate
+        self.mlsd = mlsd
+
+
+def run_once(url, args, extra, expected):
+    work = tempfile.mkdtemp(prefix="megamaid-bench-")
+    cmd = [sys.executable, os.path.abspath(MEGAMAID), url, "-r", "-p", ".*"]
+    cmd += ["--idle", str(args.idle), "--stats-json", "stats.json", *extra]
+    st = time.perf_counter()
+    proc = subprocess.Popen(cmd, cwd=work)
+    _, status, usage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - st
+
+    try:
+        with open(os.path.join(work, "stats.json")) as fp:
+            retv = json.load(fp)
+    except OSError:
+        retv = {}
+    for key in ("engine", "started"):
+        retv.pop(key, None)
+    ondisk = sum(len(f) for _, _, f in os.walk(os.path.join(work, "127.0.0.1")))
+    retv.update(
+        wall_seconds=round(wall, 3),
+        peak_rss=usage.ru_maxrss * 1024,
+        exit=proc.returncode,
+        complete=ondisk == expected,
+    )
+    if args.keep:
+        retv["tree"] = work
+    else:
+        shutil.rmtree(work)
+    return retv
+
+
+def medians(runs):
+    # Median of each number the runs report, over the runs that reported it
+    keys = {}
+    for run in runs:
+        for key, val in run.items():
+            if isinstance(val, (int, float)) and not isinstance(val, bool):
+                keys.setdefault(key, [])
+                keys[key].append(val)
+    keys.pop("exit", None)
+    return {key: statistics.median(vals) for key, vals in keys.items()}
+
+
+def compare(base, now):
+    # Percent change of each median, signed so positive is better
+    for key, was in base.items():
+        if key not in now or not isinstance(was, (int, float)) or not was:
+            continue
+        change = (now[key] - was) / was * 100
+        better = -change if key in COSTS else change
+        print(
+            f"{key:>18}: {was:>14,.3f} -> {now[key]:>14,.3f}  {better:+6.1f}%",
+            file=sys.stderr,
+        )
+
+
+def main():
+    argv = sys.argv[1:]
+    extra = []
+    if "--" in argv:
+        extra = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+
+    parser = argparse.ArgumentParser(description="MegaMaid pipeline benchmark")
+    parser.add_argument("-P", "--proto", choices=("http", "ftp"), default="http")
+    parser.add_argument("-s", "--style", choices=sorted(STYLES), default="apache")
+    parser.add_argument("--no-mlsd", action="store_true", help="FTP lists with LIST")
+    parser.add_argument("-D", "--depth", type=int, default=2, help="directory levels")
+    parser.add_argument("-F", "--fanout", type=int, default=4, help="subdirs per dir")
+    parser.add_argument("-n", "--files", type=int, default=20, help="files per dir")
+    parser.add_argument(
+        "-S", "--sizes", default="4K-256K", help="64K, 4K-1M (uniform), logn:64K"
+    )
+    parser.add_argument("-L", "--latency", type=float, default=0, help="ms per request")
+    parser.add_argument("-l", "--rate", default="0", help="per connection, e.g. 1M")
+    parser.add_argument("-r", "--runs", type=int, default=3)
+    parser.add_argument("-i", "--idle", type=float, default=0.5, help="megamaid --idle")
+    parser.add_argument("-o", "--output", help="write the JSON here too")
+    parser.add_argument("-c", "--compare", metavar="BASE", help="an earlier -o file")
+    parser.add_argument("-k", "--keep", action="store_true", help="keep the trees")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    tree = Tree(args.depth, args.fanout, args.files, args.sizes, args.seed)
+    latency, rate = args.latency / 1000, parse_rate(args.rate)
+    if args.proto == "http":
+        server = HttpMirror(tree, args.style, latency, rate)
+    else:
+        server = FtpMirror(tree, latency, rate, not args.no_mlsd)
+    url = f"{args.proto}://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    runs = []
+    failed = []
+    for i in range(args.runs):
+        runs.append(run_once(url, args, extra, len(tree.files)))
+        print(f"run {i + 1}: {json.dumps(runs[-1])}", file=sys.stderr)
+        if runs[-1]["exit"] or not runs[-1]["complete"]:
+            failed.append(i + 1)
+            print(
+                f"run {i + 1}: FAILED, exit {runs[-1]['exit']}, "
+                f"{'complete' if runs[-1]['complete'] else 'incomplete'} tree",
+                file=sys.stderr,
+            )
+    server.shutdown()
+
+    # failed runs stop early, their numbers would only flatter the medians
+    good = [r for n, r in enumerate(runs, 1) if n not in failed]
+    retv = {
+        "config": dict(vars(args), megamaid=extra),
+        "tree": tree.summary(),
+        "runs": runs,
+        "failed": failed,
+        "median": medians(good or runs),
+    }
+    print(json.dumps(retv, indent=2))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(retv, fp, indent=2)
+            fp.write("\n")
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(json.load(fp)["median"], retv["median"])
+    if failed:
+        sys.exit(f"{len(failed)} of {len(runs)} runs failed: {failed}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+"""
+Load generator for the MaidServer protocol: a number of client processes
+send requests to a local TcpServer (or SockServer) with a number of lines in
+flight each, optionally batched, and messages/sec and reply latency are
+reported. Depth 1 and batch 1 is the old one request, one reply exchange.
+-A serves with the asyncio servers instead.
+
+usage: bench/server.py [-c CLIENTS] [-n MESSAGES] [-d DEPTH] [-b BATCH]
+                       [-s BYTES] [-u] [-A] [-a ADDR]
+"""
+
+# Stdlib imports
+import os
+import sys
+import json
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import multiprocessing
+
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+# Internal imports
+from megamaid.server import SockServer, TcpServer
+from megamaid.aserver import AsyncSockServer, AsyncTcpServer
+
+
+def connect(addr):
+    if "/" in addr:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(addr)
+        return sock
+    host, _, port = addr.rpartition(":")
+    sock = socket.create_connection((host, int(port)))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return sock
+
+
+def client(addr, count, depth, batch, size, go, out):
+    sock = connect(addr)
+    payload = "x" * size
+    inflight = deque()
+    lat = []
+    buf = b""
+    nid = done = 0
+    go.wait()
+    st = time.perf_counter()
+    while done < count:
+        lines = []
+        while nid < count and len(inflight) < depth:
+            n = min(batch, count - nid)
+            reqs = [
+                {"command": "echo", "id": nid + i, "data": payload} for i in range(n)
+            ]
+            lines.append(json.dumps(reqs if batch > 1 else reqs[0]).encode())
+            inflight.append((time.perf_counter(), nid, n))
+            nid += n
+        if lines:
+            sock.sendall(b"\n".join(lines) + b"\n")
+
+        data = sock.recv(262144)
+        if not data:
+            raise ConnectionResetError("server hung up")
+        buf += data
+        *replies, buf = buf.split(b"\n")
+        now = time.perf_counter()
+        for line in replies:
+            sent, first, n = inflight.popleft()
+            if line != b"OK":
+                reply = json.loads(line)
+                if isinstance(reply, list):
+                    reply = reply[0]
+                if reply.get("id", first) != first:
+                    raise ValueError(f"reply {reply.get('id')} for request {first}")
+            lat.extend([now - sent] * n)
+            done += n
+    out.put((done, time.perf_counter() - st, lat))
+    sock.close()
+
+
+def serve(args):
+    if args.unix:
+        server = (AsyncSockServer if args.asyncio else SockServer)(
+            "bench", path=args.addr
+        )
+    else:
+        host, _, port = args.addr.rpartition(":")
+        server = (AsyncTcpServer if args.asyncio else TcpServer)(
+            host, int(port), "bench"
+        )
+    # the server logs at debug, the connections would swamp the numbers
+    logging.getLogger("bench").setLevel(logging.WARNING)
+    server.add_handler("echo", lambda conn, data: {"data": data["data"]})
+    server.add_handler("noop", lambda conn, data: None)
+    threading.Thread(target=server.run, daemon=True).start()
+
+
+def pct(vals, p):
+    return vals[min(len(vals) - 1, int(len(vals) * p / 100))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MaidServer protocol benchmark")
+    parser.add_argument("-c", "--clients", type=int, default=4)
+    parser.add_argument("-n", "--messages", type=int, default=50000, help="per client")
+    parser.add_argument("-d", "--depth", type=int, default=32, help="lines in flight")
+    parser.add_argument("-b", "--batch", type=int, default=1, help="requests per line")
+    parser.add_argument("-s", "--size", type=int, default=64, help="payload bytes")
+    parser.add_argument("-u", "--unix", action="store_true", help="UNIX socket")
+    parser.add_argument("-A", "--asyncio", action="store_true", help="asyncio server")
+    parser.add_argument(
+        "-a", "--addr", default=None, help="use a server already running here"
+    )
+    args = parser.parse_args()
+
+    if args.addr is None:
+        if args.unix:
+            args.addr = os.path.join(tempfile.mkdtemp(), "bench.sock")
+        else:
+            with socket.socket() as s:
+                s.bind(("127.0.0.1", 0))
+                args.addr = f"127.0.0.1:{s.getsockname()[1]}"
+        serve(args)
+        time.sleep(0.2)
+
+    go = multiprocessing.Event()
+    out = multiprocessing.Queue()
+    procs = [
+        multiprocessing.Process(
+            target=client,
+            args=(args.addr, args.messages, args.depth, args.batch, args.size, go, out),
+        )
+        for _ in range(args.clients)
+    ]
+    for p in procs:
+        p.start()
+    time.sleep(0.5)
+    st = time.perf_counter()
+    go.set()
+    results = [out.get() for _ in procs]
+    took = time.perf_counter() - st
+    for p in procs:
+        p.join()
+
+    total = sum(r[0] for r in results)
+    lat = sorted(v for r in results for v in r[2])
+    print(
+        f"{args.clients} clients, depth {args.depth}, batch {args.batch}, "
+        f"{args.size} byte payloads, {'unix' if args.unix else 'tcp'}"
+        f"{', asyncio' if args.asyncio else ''}"
+    )
+    print(f"{total} messages in {took:.2f}s: {total / took:,.0f} msgs/sec")
+    print(
+        f"latency ms: p50 {pct(lat, 50):.2f}  p90 {pct(lat, 90):.2f}  "
+        f"p99 {pct(lat, 99):.2f}  max {lat[-1] * 1000:.2f}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@
 # Stdlib imports
 import os
 import sys
+import json
+import logging
 
 # Internal imports
 from megamaid import *
@@ -12,6 +14,53 @@ from megamaid import *
 LOG = log_setup("Main")
 
 
+def serve(args):
+    # Build the coordinator and the server it answers on
+    jobs = None
+    if args.job:
+        LOG.info(f"Opening job store {args.job}")
+        jobs = JobStore(args.job, reset=not args.resume, log_q=LOG)
+    coord = Coordinator(
+        args.pattern, args.exclude, args.recursive, args.lease, jobs=jobs, log_q=LOG
+    )
+    if args.resume:
+        coord.resume()
+    for url in args.urls:
+        coord.add(url)
+
+    if args.bind:
+        host, _, port = args.bind.rpartition(":")
+        server = (AsyncTcpServer if args.asyncio else TcpServer)(
+            host, int(port), "grabber"
+        )
+        LOG.info(f"Coordinating on {args.bind}")
+    else:
+        server = (AsyncSockServer if args.asyncio else SockServer)(
+            "grabber", path=args.unix
+        )
+        LOG.info(f"Coordinating on {server.sock_name}")
+    coord.attach(server)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        LOG.info(f"Stopping, {coord.stats()}")
+    finally:
+        if jobs:
+            jobs.close()
+
+
+def watch(args):
+    # Print a running grabber's events, a JSON object per line
+    client = CoordinatorClient(args.bind or args.unix)
+    try:
+        for event in client.subscribe(args.watch):
+            print(json.dumps(event), flush=True)
+    except KeyboardInterrupt:
+        pass
+    except (OSError, ValueError) as e:
+        sys.exit(f"Can't watch {client.addr}: {e}")
+
+
 def main():
     args_d = dict(
         description="MegaMaid",
@@ -41,17 +90,35 @@ def main():
                         "type": "str",
                     },
                     {
-                        "help": "Host and port for binding tcp sockets (0.0.0.0:9765)",
+                        "help": "Host and port for binding tcp sockets (e.g. 0.0.0.0:9765)",
                         "long": "bind",
                         "metavar": "HOST:PORT",
                         "short": "b",
-                        "default": "0.0.0.0:9765",
-                        "type": "int",
+                        "default": None,
+                        "type": "str",
                     },
                 ],
                 "mutually_exclusive": True,
                 "title": "Server",
             },
+            {
+                "arguments": [
+                    {
+                        "action": "store_true",
+                        "help": "Serve with asyncio, for thousands of clients and event subscriptions.",
+                        "long": "asyncio",
+                        "short": "A",
+                    },
+                    {
+                        "help": "Print the events of a grabber running with --asyncio instead of serving (progress, stats).",
+                        "long": "watch",
+                        "metavar": "TOPIC",
+                        "short": "w",
+                        "nargs": "+",
+                    },
+                ],
+                "title": "Events",
+            },
             {
                 "arguments": [
                     {
@@ -70,11 +137,71 @@ def main():
                 "mutually_exclusive": True,
                 "title": "Logging",
             },
+            {
+                "arguments": [
+                    {
+                        "help": "Specify a pattern to match against links.",
+                        "long": "pattern",
+                        "metavar": "RE",
+                        "short": "p",
+                        "nargs": "+",
+                        "default": False,
+                    },
+                    {
+                        "help": "Skip links matching any of these patterns.",
+                        "long": "exclude",
+                        "metavar": "RE",
+                        "short": "x",
+                        "nargs": "+",
+                    },
+                    {
+                        "action": "store_true",
+                        "help": "Recursively fetch files from the same site.",
+                        "long": "recursive",
+                        "short": "r",
+                    },
+                    {
+                        "help": "Seconds a worker's lease lasts without a heartbeat.",
+                        "long": "lease",
+                        "metavar": "SECS",
+                        "short": "l",
+                        "default": LEASE_TTL,
+                        "type": "float",
+                    },
+                    {
+                        "help": "Record the crawl in a SQLite job store.",
+                        "long": "job",
+                        "metavar": "FILE",
+                        "short": "J",
+                    },
+                    {
+                        "action": "store_true",
+                        "help": "With --job, continue the crawl recorded there.",
+                        "long": "resume",
+                        "short": "R",
+                    },
+                    {
+                        "help": "URL(s) to traverse.",
+                        "positional": "urls",
+                        "metavar": "URL",
+                        "nargs": "*",
+                    },
+                ],
+                "title": "Crawl",
+            },
         ],
     )
 
     args = argparse_constructor(args_d)
+    if args.debug:
+        LOG.setLevel(logging.DEBUG)
+    elif args.quiet:
+        LOG.setLevel(logging.ERROR)
+    if args.watch:
+        watch(args)
+        return
     LOG.info("Starting MegaMaid")
+    serve(args)
 
 
 if __name__ == "__main__":
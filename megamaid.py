@@ -2,11 +2,15 @@
 
 # Stdlib imports
 import os
+import re
 import sys
+import json
 import time
 import curses
+import signal
 import logging
 import argparse
+import resource
 import threading
 
 from queue import Queue, Empty
@@ -20,6 +24,7 @@ from megamaid import *
 SITE_Q = Queue()
 LINK_Q = Queue()
 FETCH_Q = Queue()
+VERIFY_Q = Queue()
 GUI_Q = Queue()
 SIG_Q = Queue()
 LOG_Q = logging.getLogger("MegaMaid")
@@ -34,7 +39,12 @@ STATS = Edict(
         "have": 0,
         "size": 0,
         "speed": 0,
+        "bytes": 0,
+        "verified": 0,
+        "vfailed": 0,
+        "vbytes": 0,
         "lines": [],
+        "progress": {},
     }
 )
 
@@ -64,6 +74,12 @@ class Updater(threading.Thread):
                     for k, v in update.items():
                         if k == "filename":
                             STATS.lines.append(v)
+                        elif k == "progress":
+                            name, done, total = v
+                            if done is None:
+                                STATS.progress.pop(name, None)
+                            else:
+                                STATS.progress[name] = (done, total)
                         elif k in STATS.keys():
                             STATS[k] += v
                 elif type(update) is bool:
@@ -141,14 +157,22 @@ class Tui:
         (y, x) = self._stdscr.getmaxyx()
         self._stdscr.addstr(0, 0, "MegaMaid", curses.color_pair(13))
         self._stdscr.addstr(1, 0, self.shoulders.horizLine * x, curses.color_pair(13))
-        while len(STATS.lines) > (y - 5):
+        xfers = []
+        for name, (done, total) in list(STATS.progress.items()):
+            if total:
+                xfers.append(f"{name} {humanize_bytes(done)}/{humanize_bytes(total)}")
+            else:
+                xfers.append(f"{name} {humanize_bytes(done)}")
+        while len(STATS.lines) > (y - 5) - len(xfers):
             STATS.lines.pop(0)
         idx = 2
-        for line in STATS.lines:
+        for line in STATS.lines + xfers:
             try:
                 padd = " " * (x - (len(line) + 2))
                 if line.find("(pre)") != -1:
                     self._stdscr.addstr(idx, 1, line + padd, curses.color_pair(16))
+                elif line in xfers:
+                    self._stdscr.addstr(idx, 1, line + padd, curses.color_pair(13))
                 else:
                     self._stdscr.addstr(idx, 1, line + padd)
                 idx += 1
@@ -165,6 +189,13 @@ class Tui:
         self._stdscr.addstr(" / ")
         self._stdscr.addstr("Have ")
         self._stdscr.addstr(f"{str(STATS.have):^6}", curses.color_pair(16))
+        if STATS.verified or STATS.vfailed:
+            self._stdscr.addstr(" / ")
+            self._stdscr.addstr("Verified ")
+            self._stdscr.addstr(f"{str(STATS.verified):^6}", curses.color_pair(16))
+            self._stdscr.addstr(" / ")
+            self._stdscr.addstr("Bad ")
+            self._stdscr.addstr(f"{str(STATS.vfailed):^4}", curses.color_pair(16))
         self._stdscr.addstr(" ]")
 
     def _draw_progress(self):
@@ -203,10 +234,259 @@ def tui(stdscr):
     tui.run()
 
 
-def main(args):
-    # Preseed the queue with the URLs and data
+def make_dedup(args, jobs=None):
+    site_seen = make_seen(args.dedup, args.bloom_capacity, args.bloom_error)
+    link_seen = make_seen(args.dedup, args.bloom_capacity, args.bloom_error)
+    guard = make_guard(args.dedup, args.bloom_capacity, args.bloom_error)
+    if jobs and args.resume:
+        # everything the earlier run saw counts as seen, pending work included
+        known = set(jobs.known("sites"))
+        args.urls = [url for url in args.urls if url not in known]
+        if site_seen is not None:
+            for url in known:
+                site_seen.add(url)
+            for url in jobs.known("links"):
+                link_seen.add(url)
+    if site_seen is not None:
+        args.urls = [url for url in args.urls if site_seen.add(url)]
+    return (site_seen, link_seen, guard)
+
+
+def configure_throttle(opts):
+    # Apply the bandwidth options, from the command line or a reloaded config
+    host_rate = 0
+    hosts = {}
+    for item in opts.get("host_limit") or []:
+        host, _, rate = item.rpartition("=")
+        if host:
+            hosts[host.lower()] = parse_rate(rate)
+        else:
+            host_rate = parse_rate(rate)
+    THROTTLE.configure(
+        parse_rate(opts.get("limit_rate") or 0),
+        host_rate,
+        hosts,
+        [parse_schedule(w) for w in opts.get("schedule") or []],
+    )
+
+
+def log_throughput():
+    for host, st in THROTTLE.stats().items():
+        cap = f", cap {humanize_bytes(st.cap)}/s" if st.cap else ""
+        LOG_Q.info(
+            f"Throughput: {host}: {humanize_bytes(st.bytes)} "
+            f"at {humanize_bytes(st.rate)}/s{cap}"
+        )
+
+
+def log_verify(verifier, took):
+    st = verifier.stats()
+    LOG_Q.info(f"Verifier: {st}")
+    LOG_Q.info(
+        f"Verify: {st.verified} files, {humanize_bytes(st.bytes)} "
+        f"({humanize_bytes(st.bytes / max(took, 0.001))}/s over the run, "
+        f"workers hashed {humanize_bytes(st.rate)}/s each), "
+        f"{st.failed} failed, {st.unverified} without a checksum"
+    )
+
+
+def log_mirrors(mirrors):
+    for base, st in mirrors.stats().items():
+        speed = "unmeasured" if st.speed is None else f"{humanize_bytes(st.speed)}/s"
+        LOG_Q.info(
+            f"Mirror: {base}: {st.ok} ok, {st.failed} failed, "
+            f"{humanize_bytes(st.bytes)} at {speed}, error rate {st.errors:.2f}"
+        )
+
+
+def write_stats(fname, engine, started, took, listings, links, files, nbytes):
+    # Machine readable summary of a run, for comparing runs
+    took = max(took, 0.001)
+    retv = {
+        "engine": engine,
+        "started": started,
+        "seconds": round(took, 3),
+        "listings": listings,
+        "links": links,
+        "files": files,
+        "bytes": nbytes,
+        "listings_per_sec": round(listings / took, 2),
+        "links_per_sec": round(links / took, 2),
+        "files_per_sec": round(files / took, 2),
+        "mb_per_sec": round(nbytes / took / 1024**2, 3),
+        # kilobytes on Linux
+        "peak_rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+    if fname == "-":
+        print(json.dumps(retv, indent=2))
+    else:
+        with open(fname, "w") as fp:
+            json.dump(retv, fp, indent=2)
+            fp.write("\n")
+
+
+def profiling(make, outdir):
+    # Wrap a thread factory, so the threads it makes run under cProfile
+    return lambda: profiled(make(), outdir)
+
+
+def save_trace(fname):
+    # Stop tracing, log where the time went and write the spans out
+    tracer = stop_trace()
+    for name, (count, secs) in tracer.totals().items():
+        LOG_Q.info(f"Trace: {name} {count} spans, {secs:.3f}s")
+    count = tracer.save(fname)
+    LOG_Q.info(f"Trace: {count} spans ({tracer.dropped} dropped) written to {fname}")
+
+
+def log_dedup(site_seen, link_seen):
+    if site_seen is not None:
+        LOG_Q.info(f"Site dedup: {site_seen.stats()}")
+        LOG_Q.info(f"Link dedup: {link_seen.stats()}")
+
+
+def main_async(args):
+    site_seen, link_seen, guard = make_dedup(args)
     for url in args.urls:
+        LOG_Q.info(f"-> AsyncEngine {url}")
+        GUI_Q.put({"site": 1})
+
+    LOG_Q.info("Starting Updater thread")
+    updater_t = Updater(GUI_Q, SIG_Q, LOG_Q)
+    updater_t.start()
+
+    LOG_Q.info("Starting AsyncEngine thread")
+    engine = AsyncEngine(
+        args.urls,
+        LOG_Q,
+        GUI_Q,
+        LinkMatcher(args.pattern, args.exclude),
+        args.recursive,
+        args.trim_lead,
+        args.buffer_size,
+        args.concurrency,
+        site_seen,
+        link_seen,
+        guard,
+    )
+    started = time.time()
+    engine_t = threading.Thread(target=engine.run, daemon=True)
+    engine_t.start()
+
+    if args.tui:
+        curses.wrapper(tui)
+    engine_t.join()
+    took = time.time() - started
+    GUI_Q.put(True)
+    updater_t.join()
+    if args.stats_json:
+        write_stats(
+            args.stats_json,
+            "async",
+            started,
+            took,
+            engine.listed,
+            STATS.link,
+            STATS.have,
+            STATS.size,
+        )
+    log_dedup(site_seen, link_seen)
+    log_throughput()
+    LOG_Q.info(f"FTP pool: {FTP_POOL.stats()}")
+    FTP_POOL.close()
+
+
+def main_worker(args):
+    client = CoordinatorClient(args.worker)
+
+    LOG_Q.info("Starting Updater thread")
+    updater_t = Updater(GUI_Q, SIG_Q, LOG_Q)
+    updater_t.start()
+
+    def fetcher():
+        return LinkFetcher(
+            None,
+            LOG_Q,
+            None,
+            GUI_Q,
+            args.trim_lead,
+            args.buffer_size,
+            args.manifest,
+            args.fresh,
+            None,
+            args.segments,
+            args.segment_size,
+        )
+
+    worker = Worker(client, fetcher, LOG_Q, threads=args.fetchers)
+    LOG_Q.info(f"Working for the coordinator at {args.worker} as {worker.name}")
+    worker.run()
+    client.close()
+    GUI_Q.put(True)
+    updater_t.join()
+    LOG_Q.info(f"Worker: {worker.stats()}")
+    log_throughput()
+    LOG_Q.info(f"Connection pool: {POOL.stats()}")
+    LOG_Q.info(f"FTP pool: {FTP_POOL.stats()}")
+    POOL.close()
+    FTP_POOL.close()
+    Manifest.close_all()
+
+
+def resume_jobs(jobs):
+    # Requeue the work an interrupted run left, each at the stage it reached
+    pending = jobs.pending()
+    LOG_Q.info(
+        f"Resuming: {len(pending.sites)} sites, {len(pending.links)} links, "
+        f"{len(pending.matched)} matched links"
+    )
+    for url in pending.sites:
+        SITE_Q.put(url)
+    for url in pending.links:
+        LINK_Q.put(url)
+    for url in pending.matched:
+        FETCH_Q.put(url)
+    GUI_Q.put(
+        {
+            "site": len(pending.sites),
+            "link": len(pending.links),
+            "match": len(pending.matched),
+        }
+    )
+
+
+def main(args):
+    global FETCH_Q
+    if args.priority != "fifo" or args.weight:
+        weights = [parse_weight(w) for w in args.weight or []]
+        FETCH_Q = PriorityFetchQueue(FetchPriority(args.priority, weights, args.aging))
+
+    jobs = None
+    if args.job:
+        LOG_Q.info(f"Opening job store {args.job}")
+        jobs = JobStore(args.job, reset=not args.resume, log_q=LOG_Q)
+    store = None
+    if args.store:
+        LOG_Q.info(f"Opening object store {args.store}")
+        store = ObjectStore(args.store, args.store_link, LOG_Q)
+    mirrors = None
+    if args.mirror_group:
+        mirrors = Mirrors(args.mirror_group)
+    site_seen, link_seen, guard = make_dedup(args, jobs)
+    if args.resume:
+        resume_jobs(jobs)
+
+    started = time.time()
+
+    # Preseed the queue with the URLs and data, mirror groups are listed
+    # from their first mirror unless told otherwise
+    urls = args.urls
+    if not urls and mirrors and not args.resume:
+        urls = [group[0] for group in mirrors.groups]
+    for url in urls:
         LOG_Q.info(f"-> SITE_Q {url}")
+        if jobs:
+            jobs.site(url)
         SITE_Q.put(url)
         GUI_Q.put({"site": 1})
 
@@ -215,40 +495,131 @@ def main(args):
     updater_t.append(Updater(GUI_Q, SIG_Q, LOG_Q))
     updater_t[-1].start()
 
-    LOG_Q.info("Starting SiteScrubber thread")
+    matcher = LinkMatcher(args.pattern, args.exclude)
+
+    def scrubber():
+        return SiteScrubber(
+            SITE_Q,
+            LINK_Q,
+            LOG_Q,
+            SIG_Q,
+            GUI_Q,
+            args.recursive,
+            site_seen,
+            link_seen,
+            guard,
+            jobs,
+            args.idle,
+        )
+
+    verify_q = VERIFY_Q if args.verify else None
+
+    def linkfilter():
+        return LinkFilter(
+            LINK_Q,
+            FETCH_Q,
+            LOG_Q,
+            SIG_Q,
+            GUI_Q,
+            matcher,
+            jobs,
+            verify_q,
+            mirrors,
+            args.idle,
+        )
+
+    def fetcher():
+        return LinkFetcher(
+            FETCH_Q,
+            LOG_Q,
+            SIG_Q,
+            GUI_Q,
+            args.trim_lead,
+            args.buffer_size,
+            args.manifest,
+            args.fresh,
+            jobs,
+            args.segments,
+            args.segment_size,
+            store,
+            verify_q,
+            mirrors,
+            args.idle,
+        )
+
+    if args.profile:
+        # the Supervisor's threads come from these too
+        scrubber = profiling(scrubber, args.profile)
+        linkfilter = profiling(linkfilter, args.profile)
+        fetcher = profiling(fetcher, args.profile)
+
+    LOG_Q.info(f"Starting {args.scrubbers} SiteScrubber thread(s)")
     link_t = []
-    for i in range(1):
-        link_t.append(SiteScrubber(SITE_Q, LINK_Q, LOG_Q, SIG_Q, GUI_Q, args.recursive))
+    for i in range(args.scrubbers):
+        link_t.append(scrubber())
         link_t[-1].start()
 
-    LOG_Q.info("Starting LinkFilter thread")
+    LOG_Q.info(f"Starting {args.filters} LinkFilter thread(s)")
     proxy_t = []
-    for i in range(1):
-        proxy_t.append(LinkFilter(LINK_Q, FETCH_Q, LOG_Q, SIG_Q, GUI_Q, args.pattern))
+    for i in range(args.filters):
+        proxy_t.append(linkfilter())
         proxy_t[-1].start()
 
-    LOG_Q.info("Starting LinkFetcher thread")
+    LOG_Q.info(f"Starting {args.fetchers} LinkFetcher thread(s)")
     fetch_t = []
-    for i in range(1):
-        fetch_t.append(LinkFetcher(FETCH_Q, LOG_Q, SIG_Q, GUI_Q, args.trim_lead))
+    for i in range(args.fetchers):
+        fetch_t.append(fetcher())
         fetch_t[-1].start()
 
+    verify_t = []
+    if args.verify:
+        LOG_Q.info(f"Starting Verifier thread, {args.verify_workers} hashing processes")
+        verify_t.append(
+            Verifier(
+                VERIFY_Q, FETCH_Q, LOG_Q, SIG_Q, GUI_Q, args.verify_workers, store, jobs
+            )
+        )
+        if args.profile:
+            profiled(verify_t[-1], args.profile)
+        verify_t[-1].start()
+
+    supervisor = None
+    if args.autoscale:
+        LOG_Q.info(f"Starting Supervisor thread (max {args.max_workers} per stage)")
+        supervisor = Supervisor(LOG_Q)
+        supervisor.add_stage(
+            "scrubber", SITE_Q, scrubber, link_t, args.scrubbers, args.max_workers
+        )
+        supervisor.add_stage(
+            "filter", LINK_Q, linkfilter, proxy_t, args.filters, args.max_workers
+        )
+        supervisor.add_stage(
+            "fetcher",
+            FETCH_Q,
+            fetcher,
+            fetch_t,
+            args.fetchers,
+            args.max_workers,
+            "transferred",
+        )
+        supervisor.start()
+
     if args.tui:
         tui_t = curses.wrapper(tui)
     else:
         while True:
             st = time.time()
             try:
-                GUI_Q.get(True, 15)
+                GUI_Q.get(True, args.idle)
                 GUI_Q.task_done()
             except Empty:
-                if time.time() - st >= 15:
+                if time.time() - st >= args.idle:
                     LOG_Q.info("main program exiting.")
                     break
                 st = time.time()
 
     # Give the threads a bit to get started
-    time.sleep(2)
+    time.sleep(min(2, args.idle))
     try:
 
         LOG_Q.warning("SITE_Q.join()")
@@ -257,17 +628,71 @@ def main(args):
         LINK_Q.join()
         LOG_Q.warning("FETCH_Q.join()")
         FETCH_Q.join()
+        if verify_t:
+            LOG_Q.warning("VERIFY_Q.join()")
+            # files that fail go back to FETCH_Q, so go round until neither
+            # has work left; the fetchers may have idled out meanwhile
+            while True:
+                VERIFY_Q.join()
+                if not FETCH_Q.unfinished_tasks:
+                    break
+                if not any(t.is_alive() for t in fetch_t):
+                    fetch_t.append(fetcher())
+                    fetch_t[-1].start()
+                FETCH_Q.join()
+        took = time.time() - started
         if args.tui:
             tui_t.join()
 
+        if supervisor:
+            supervisor.stop()
+            LOG_Q.info(f"Supervisor: {supervisor.stats()}")
         SIG_Q.put(True)
 
-        # Wait for the threads to exit
-        for grp in (link_t, proxy_t, fetch_t, updater_t):
+        # Wait for the threads to exit, the display last, once nothing is
+        # left to report
+        for grp in (link_t, proxy_t, fetch_t, verify_t):
             for t in grp:
                 t.join()
+        GUI_Q.put(True)
+        for t in updater_t:
+            t.join()
+
+        LOG_Q.info(f"Connection pool: {POOL.stats()}")
+        LOG_Q.info(f"FTP pool: {FTP_POOL.stats()}")
+        log_dedup(site_seen, link_seen)
+        log_throughput()
+        if jobs:
+            LOG_Q.info(f"Job store: {jobs.stats()}")
+            jobs.close()
+        if mirrors:
+            log_mirrors(mirrors)
+        if verify_t:
+            log_verify(verify_t[0], time.time() - started)
+        if store:
+            LOG_Q.info(f"Object store: {store.stats()}")
+            store.close()
+        if args.profile:
+            LOG_Q.info(f"Profile summary: {profile_summary(args.profile)}")
+        if args.stats_json:
+            # the stages' own counters, every update may not reach STATS
+            write_stats(
+                args.stats_json,
+                "threads",
+                started,
+                took,
+                sum(t.processed for t in link_t),
+                sum(t.processed for t in proxy_t),
+                sum(t.processed for t in fetch_t),
+                sum(t.transferred for t in fetch_t),
+            )
+        POOL.close()
+        FTP_POOL.close()
+        Manifest.close_all()
 
     except:
+        if supervisor:
+            supervisor.stop()
         SIG_Q.put(True)
         SITE_Q.join()
         LINK_Q.join()
@@ -275,11 +700,18 @@ def main(args):
         if args.tui:
             tui_t.join()
 
-        # Wait for the threads to exit
-        for grp in (link_t, proxy_t, fetch_t, updater_t):
+        # Wait for the threads to exit, the display last, once nothing is
+        # left to report
+        for grp in (link_t, proxy_t, fetch_t, verify_t):
             for t in grp:
                 t.join()
+        GUI_Q.put(True)
+        for t in updater_t:
+            t.join()
 
+        if jobs:
+            jobs.close()
+        Manifest.close_all()
         sys.exit(1)
 
 
@@ -295,9 +727,33 @@ if __name__ == "__main__":
         nargs="+",
         help="Specify a pattern to match against links.",
     )
+    parser.add_argument(
+        "-x",
+        "--exclude",
+        metavar="RE",
+        type=str,
+        default=False,
+        nargs="+",
+        help="Skip links matching any of these patterns, even if -p matched.",
+    )
     parser.add_argument(
         "-d", "--debug", action="store_true", help="Enable debug output."
     )
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Write the run's counts, rates and peak memory as JSON to FILE (- for stdout).",
+    )
+    parser.add_argument(
+        "--trace",
+        metavar="FILE",
+        help="Time network calls, listing parses, filter matches, disk writes and queue waits, and write them to FILE as Chrome trace JSON (for ui.perfetto.dev).",
+    )
+    parser.add_argument(
+        "--profile",
+        metavar="DIR",
+        help="Run each pipeline thread under cProfile, writing its stats and a summary.txt per stage to DIR.",
+    )
     parser.add_argument(
         "-r",
         "--recursive",
@@ -311,6 +767,226 @@ if __name__ == "__main__":
         metavar="N",
         help="Strip `N` leading components from the output path.",
     )
+    parser.add_argument(
+        "-B",
+        "--buffer-size",
+        type=int,
+        metavar="BYTES",
+        default=BUFSIZE,
+        help="Read buffer size per download, bounds memory used per fetcher.",
+    )
+    parser.add_argument(
+        "-S",
+        "--segments",
+        type=int,
+        metavar="N",
+        default=1,
+        help="Fetch large files over up to `N` parallel ranged connections each.",
+    )
+    parser.add_argument(
+        "--segment-size",
+        type=int,
+        metavar="BYTES",
+        default=SEGMENT_SIZE,
+        help="With --segments, smallest range per connection; smaller files use one.",
+    )
+    parser.add_argument(
+        "-M",
+        "--manifest",
+        action="store_true",
+        help="Revalidate existing files with conditional requests, using a manifest kept in each mirror root.",
+    )
+    parser.add_argument(
+        "-F",
+        "--fresh",
+        type=int,
+        metavar="SECS",
+        default=0,
+        help="With --manifest, trust files checked less than `SECS` ago without asking the server.",
+    )
+    parser.add_argument(
+        "-J",
+        "--job",
+        metavar="FILE",
+        help="Record crawl progress in a SQLite job store, so the run can be resumed.",
+    )
+    parser.add_argument(
+        "-R",
+        "--resume",
+        action="store_true",
+        help="With --job, continue the run recorded there instead of starting over.",
+    )
+    parser.add_argument(
+        "--store",
+        metavar="DIR",
+        help="Keep one copy of each file by content in DIR, linked into the mirror trees.",
+    )
+    parser.add_argument(
+        "--store-link",
+        choices=LINK_MODES,
+        default="hardlink",
+        help="With --store, how files are linked in. Copies are made where that can't work.",
+    )
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="Check files fetched against the checksum files found, refetching bad ones.",
+    )
+    parser.add_argument(
+        "--verify-workers",
+        type=int,
+        metavar="N",
+        default=2,
+        help="With --verify, processes hashing files that couldn't be hashed in flight.",
+    )
+    parser.add_argument(
+        "--mirror-group",
+        nargs="+",
+        action="append",
+        metavar="URL",
+        help="Base URLs holding the same files, fetched from whichever is fastest and "
+        "saved under the first. Repeat for more groups.",
+    )
+    parser.add_argument(
+        "-e",
+        "--engine",
+        choices=("threads", "async"),
+        default="threads",
+        help="Pipeline implementation to run, a thread per stage or a single asyncio loop.",
+    )
+    parser.add_argument(
+        "-c",
+        "--concurrency",
+        type=int,
+        metavar="N",
+        default=64,
+        help="With --engine async, requests in flight per stage.",
+    )
+    parser.add_argument(
+        "-W",
+        "--worker",
+        metavar="ADDR",
+        help="Fetch for the megamaid-grabber coordinator at HOST:PORT or socket path, "
+        "with --fetchers threads.",
+    )
+
+    dedup = parser.add_argument_group("Dedup")
+    dedup.add_argument(
+        "--dedup",
+        choices=("exact", "bloom", "off"),
+        default="exact",
+        help="How visited URLs and listings are remembered: exact sets, or Bloom filters for huge crawls.",
+    )
+    dedup.add_argument(
+        "--bloom-capacity",
+        type=int,
+        metavar="N",
+        default=10000000,
+        help="With --dedup bloom, number of URLs to size the filter for.",
+    )
+    dedup.add_argument(
+        "--bloom-error",
+        type=float,
+        metavar="P",
+        default=0.001,
+        help="With --dedup bloom, false positive rate (URLs wrongly skipped) at capacity.",
+    )
+
+    bandwidth = parser.add_argument_group("Bandwidth")
+    bandwidth.add_argument(
+        "--limit-rate",
+        metavar="RATE",
+        help="Cap total download speed, in bytes/sec (K, M and G suffixes work).",
+    )
+    bandwidth.add_argument(
+        "--host-limit",
+        metavar="[HOST=]RATE",
+        nargs="+",
+        help="Cap download speed per host, or for HOST only.",
+    )
+    bandwidth.add_argument(
+        "--schedule",
+        metavar="HH:MM-HH:MM=RATE",
+        nargs="+",
+        help="Replace --limit-rate with RATE between these local times.",
+    )
+
+    order = parser.add_argument_group("Fetch order")
+    order.add_argument(
+        "--priority",
+        choices=POLICIES,
+        default="fifo",
+        help="Order downloads by discovery, smallest or largest first, by the sizes listings give (1 MiB if none).",
+    )
+    order.add_argument(
+        "--weight",
+        metavar="RE=N",
+        nargs="+",
+        help="Move links matching RE `N` ranks ahead, the first matching pattern counts.",
+    )
+    order.add_argument(
+        "--aging",
+        type=float,
+        metavar="SECS",
+        default=60.0,
+        help="Waiting this long is worth one rank, so nothing starves. 0 disables aging.",
+    )
+
+    workers = parser.add_argument_group("Workers")
+    workers.add_argument(
+        "--scrubbers",
+        type=int,
+        metavar="N",
+        default=1,
+        help="SiteScrubber (listing) threads to start.",
+    )
+    workers.add_argument(
+        "--filters",
+        type=int,
+        metavar="N",
+        default=1,
+        help="LinkFilter threads to start.",
+    )
+    workers.add_argument(
+        "--fetchers",
+        type=int,
+        metavar="N",
+        default=1,
+        help="LinkFetcher (download) threads to start.",
+    )
+    workers.add_argument(
+        "--ftp-connections",
+        type=int,
+        metavar="N",
+        default=4,
+        help="Most FTP logins per host, shared by listing and downloads. 0 for no limit.",
+    )
+    workers.add_argument(
+        "-a",
+        "--autoscale",
+        action="store_true",
+        help="Grow and shrink each stage with its queue depth and throughput.",
+    )
+    workers.add_argument(
+        "--max-workers",
+        type=int,
+        metavar="N",
+        default=8,
+        help="With --autoscale, most threads to run per stage.",
+    )
+    workers.add_argument(
+        "--idle",
+        type=float,
+        metavar="SECS",
+        default=IDLE,
+        help="Seconds without work before the threads call the run done.",
+    )
+    parser.add_argument(
+        "-C",
+        "--config",
+        metavar="FILE",
+        help="JSON file of option defaults, keyed by long option name (e.g. max_workers).",
+    )
 
     # compress = parser.add_mutually_exclusive_group("Compression")
     # compress.add_argument(
@@ -336,16 +1012,98 @@ if __name__ == "__main__":
     # )
 
     parser.add_argument(
-        "urls", type=str, metavar="URL", nargs="+", help="URL(s) to traverse."
+        "urls", type=str, metavar="URL", nargs="*", help="URL(s) to traverse."
     )
 
+    # Options given in a config file become defaults the command line overrides
+    conf, _ = parser.parse_known_args()
+    if conf.config:
+        with open(conf.config) as fp:
+            parser.set_defaults(**json.load(fp))
+
     args = parser.parse_args()
+    if args.engine == "async" and args.manifest:
+        parser.error("--manifest is only supported by the threads engine")
+    if args.engine == "async" and args.job:
+        parser.error("--job is only supported by the threads engine")
+    if args.engine == "async" and args.store:
+        parser.error("--store is only supported by the threads engine")
+    if args.engine == "async" and args.mirror_group:
+        parser.error("--mirror-group is only supported by the threads engine")
+    if args.engine == "async" and args.verify:
+        parser.error("--verify is only supported by the threads engine")
+    if args.engine == "async" and args.segments > 1:
+        parser.error("--segments is only supported by the threads engine")
+    if args.engine == "async" and (args.priority != "fifo" or args.weight):
+        parser.error("--priority and --weight are only supported by the threads engine")
+    if args.engine == "async" and (args.trace or args.profile):
+        parser.error("--trace and --profile are only supported by the threads engine")
+    try:
+        FetchPriority(args.priority, [parse_weight(w) for w in args.weight or []])
+    except (ValueError, re.error) as e:
+        parser.error(f"bad --weight: {e}")
+    if args.worker and (
+        args.urls or args.job or args.store or args.verify or args.mirror_group
+    ):
+        parser.error(
+            "--worker takes its work from the coordinator, not URLs, --job, --store, "
+            "--verify or --mirror-group"
+        )
+    if args.worker and args.stats_json:
+        parser.error("--stats-json isn't supported with --worker")
+    if args.worker and args.profile:
+        parser.error("--profile isn't supported with --worker")
+    if args.worker and args.engine == "async":
+        parser.error("--worker is only supported by the threads engine")
+    if args.resume and not args.job:
+        parser.error("--resume needs --job")
+    if not args.urls and not args.resume and not args.mirror_group and not args.worker:
+        parser.error("at least one URL is required")
+    for group in args.mirror_group or []:
+        try:
+            parse_group(group)
+        except ValueError as e:
+            parser.error(f"bad --mirror-group: {e}")
+    try:
+        configure_throttle(vars(args))
+    except ValueError as e:
+        parser.error(f"bad bandwidth option: {e}")
+    if args.profile:
+        os.makedirs(args.profile, exist_ok=True)
+    FTP_POOL.limit = args.ftp_connections
+    FTP_POOL.maxsize = max(FTP_POOL.maxsize, args.ftp_connections)
     if args.debug:
         logging.basicConfig(filename="megamaid.log", level=logging.DEBUG)
     else:
         logging.basicConfig(filename="megamaid.log", level=logging.INFO)
 
-    main(args)
+    # SIGHUP re-reads the bandwidth options from the config file
+    if args.config and hasattr(signal, "SIGHUP"):
+
+        def reload_throttle(signum, frame):
+            opts = vars(args).copy()
+            try:
+                with open(args.config) as fp:
+                    opts.update(json.load(fp))
+                configure_throttle(opts)
+                LOG_Q.info(f"Reloaded bandwidth options from {args.config}")
+            except (OSError, ValueError) as e:
+                LOG_Q.error(f"Can't reload {args.config}: {e}")
+
+        signal.signal(signal.SIGHUP, reload_throttle)
+
+    if args.trace:
+        start_trace()
+    try:
+        if args.worker:
+            main_worker(args)
+        elif args.engine == "async":
+            main_async(args)
+        else:
+            main(args)
+    finally:
+        if args.trace:
+            save_trace(args.trace)
 
     # If we aren't debugging get rid of the log
     if not args.debug:
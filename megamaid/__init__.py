@@ -4,9 +4,27 @@
 
 from megamaid.apgen import *
 from megamaid.edict import *
+from megamaid.pool import *
+from megamaid.throttle import *
+from megamaid.trace import *
 from megamaid.utils import *
+from megamaid.manifest import *
+from megamaid.segment import *
+from megamaid.jobstore import *
+from megamaid.objstore import *
+from megamaid.dedup import *
+from megamaid.matcher import *
+from megamaid.pqueue import *
+from megamaid.listing import *
+from megamaid.mirrors import *
 from megamaid.fetcher import *
+from megamaid.verify import *
 from megamaid.grabber import *
+from megamaid.asyncengine import *
+from megamaid.supervisor import *
+from megamaid.server import *
+from megamaid.aserver import *
+from megamaid.coordinator import *
 
 # interface imports
 # from megamaid.tui import *
@@ -37,10 +37,14 @@ def apgen(d):
         - groups: A list of dictionaries, each representing an argument group with keys:
             - title: The title of the group.
             - description: The description of the group.
+            - mutually_exclusive: True if at most one of its arguments may be
+              given.
             - arguments: A list of dictionaries, each representing an argument with keys:
                 - short: The short option (e.g., '-h').
                 - long: The long option (e.g., '--help').
                 - type: The type of the argument (e.g., 'int').
+                - positional: The name of a positional argument, instead of
+                  short and long.
                 - Other argparse-specific keyword arguments.
 
     Returns:
@@ -58,6 +62,7 @@ def apgen(d):
                 "title", "parent"
             )  # Get group title or default to 'parent'
             g_desc = group.pop("description", False)  # Get group description
+            g_mutex = group.pop("mutually_exclusive", False)
 
             frameinfo = getframeinfo(currentframe())
             g = None
@@ -74,12 +79,15 @@ def apgen(d):
             else:
                 frameinfo = getframeinfo(currentframe())
                 g = parser  # Use parser directly if no group name or description
+            if g_mutex:
+                g = g.add_mutually_exclusive_group()  # At most one of the group
 
             for arg in group["arguments"]:
                 frameinfo = getframeinfo(currentframe())
                 t_short = arg.pop("short", False)  # Get short option
                 t_long = arg.pop("long", False)  # Get long option
                 t_type = arg.pop("type", False)  # Get type
+                t_name = arg.pop("positional", False)  # Get positional name
 
                 frameinfo = getframeinfo(currentframe())
                 if t_short and t_short[0] != "-":
@@ -98,9 +106,8 @@ def apgen(d):
                     arg["type"] = eval(t_type)  # Evaluate type string to actual type
 
                 frameinfo = getframeinfo(currentframe())
-                g.add_argument(
-                    o_short, o_long, **arg
-                )  # Add argument to group or parser
+                names = [t_name] if t_name else [o for o in (o_short, o_long) if o]
+                g.add_argument(*names, **arg)  # Add argument to group or parser
     except Exception as e:
         print(f"{frameinfo.filename}, {frameinfo.lineno}: {e}")
         raise  # Re-raise exception after printing error details
@@ -0,0 +1,285 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+asyncio socket servers for MegaMaid. They speak the same newline framed JSON
+as the servers in megamaid.server, with the same handlers, but every client
+is a task on one event loop, so thousands of workers and monitors can stay
+connected. Clients can also subscribe to topics and have events pushed to
+them as they happen.
+"""
+
+# Stdlib imports
+import os
+import json
+import asyncio
+import logging
+
+# Internal imports
+from megamaid.utils import log_setup
+from megamaid.server import MAX_LINE, RECV_SIZE, MaidServer
+
+
+# Bytes of events a subscriber may leave unread before it's dropped
+MAX_BEHIND = 4 * 1024 * 1024
+
+
+class _Conn:
+    __slots__ = ("writer", "addr", "topics")
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+        self.topics = set()
+
+
+class AsyncMaidServer(MaidServer):
+    """
+    Base asyncio server class. Handlers are added and called as with
+    MaidServer, on the event loop's thread, and get the client's _Conn for
+    the connection. Two commands are built in:
+
+        subscribe: {"topics": [...]} streams the events published to those
+            topics, each a line {"event": topic, ...}.
+        unsubscribe: {"topics": [...]} stops them, all of them if no topics
+            are given.
+
+    Events are written without waiting on the subscriber. One that can't
+    keep up is unsubscribed, with an {"event": "dropped"} line, once its
+    backlog passes a limit, rather than let it grow without bound.
+    """
+
+    def __init__(self, name, behind=MAX_BEHIND):
+        """
+        Initialize the AsyncMaidServer.
+
+        Args:
+            name (str): The name of the server, for its log.
+            behind (int, optional): Bytes of events a subscriber may leave
+            unread. Defaults to MAX_BEHIND.
+        """
+
+        self._name = name
+        self._behind = behind
+        self._cbmap = {}
+        self._clmap = {}
+        self._subs = {}
+        self._tickers = []
+        self._loop = None
+        self._log = log_setup(name.lower(), logging.DEBUG)
+        self.add_handler("subscribe", self._subscribe)
+        self.add_handler("unsubscribe", self._unsubscribe)
+
+    async def _listen(self):
+        raise NotImplementedError
+
+    def run(self):
+        """
+        Run the server, until interrupted.
+        """
+
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        server = await self._listen()
+        for secs, topic, fn in self._tickers:
+            self._loop.create_task(self._tick(secs, topic, fn))
+        async with server:
+            await server.serve_forever()
+
+    async def _client(self, reader, writer):
+        conn = self._clmap[writer] = _Conn(writer)
+        self._log.debug(f"Accepted new connection from: {conn.addr}")
+        buf = bytearray()
+        try:
+            while True:
+                data = await reader.read(RECV_SIZE)
+                if not data:
+                    break
+                replies = self._feed(conn, buf, data)
+                if replies is None:
+                    self._log.error(f"Request from {conn.addr} over {MAX_LINE} bytes")
+                    break
+                if replies:
+                    writer.write(replies)
+                    # a client that doesn't read its replies isn't read either
+                    await writer.drain()
+        except OSError as e:
+            self._log.error(f"Error handling client connection: {e}")
+        finally:
+            self._unsubscribe(conn, {})
+            del self._clmap[writer]
+            writer.close()
+            self._log.debug(f"Connection closed: {conn.addr}")
+
+    def _subscribe(self, conn, data):
+        topics = data.get("topics")
+        if not isinstance(topics, list) or not topics:
+            raise ValueError("subscribe needs a list of topics")
+        for topic in topics:
+            conn.topics.add(topic)
+            self._subs.setdefault(topic, set()).add(conn)
+        return {"ok": True, "topics": sorted(conn.topics)}
+
+    def _unsubscribe(self, conn, data):
+        for topic in data.get("topics") or list(conn.topics):
+            conn.topics.discard(topic)
+            subs = self._subs.get(topic)
+            if subs:
+                subs.discard(conn)
+                if not subs:
+                    del self._subs[topic]
+        return {"ok": True, "topics": sorted(conn.topics)}
+
+    def publish(self, topic, event):
+        """
+        Send an event to a topic's subscribers. Safe to call from any thread.
+
+        Args:
+            topic (str): The topic.
+            event (dict): The event, sent as a JSON line with "event" set to
+            the topic.
+        """
+
+        if self._loop is not None and topic in self._subs:
+            self._loop.call_soon_threadsafe(self._publish, topic, event)
+
+    def _publish(self, topic, event):
+        subs = self._subs.get(topic)
+        if not subs:
+            return
+        # encoded once, whatever the number of subscribers
+        line = json.dumps(dict(event, event=topic)).encode() + b"\n"
+        for conn in list(subs):
+            # what the socket hasn't taken yet waits in the transport
+            if conn.writer.transport.get_write_buffer_size() > self._behind:
+                self._log.warning(f"Dropping {conn.addr}, too far behind")
+                self._unsubscribe(conn, {})
+                conn.writer.write(b'{"event": "dropped"}\n')
+            else:
+                conn.writer.write(line)
+
+    def every(self, secs, topic, fn):
+        """
+        Publish an event to a topic periodically, while it has subscribers.
+
+        Args:
+            secs (float): Seconds between events.
+            topic (str): The topic.
+            fn (callable): Makes the event, called on the event loop's thread.
+        """
+
+        self._tickers.append((secs, topic, fn))
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(
+                self._loop.create_task, self._tick(secs, topic, fn)
+            )
+
+    async def _tick(self, secs, topic, fn):
+        while True:
+            await asyncio.sleep(secs)
+            if topic in self._subs:
+                try:
+                    self._publish(topic, fn())
+                except Exception as e:
+                    self._log.error(f"Error making {topic} event: {e}")
+
+
+class AsyncTcpServer(AsyncMaidServer):
+    """
+    asyncio TCP server class that extends AsyncMaidServer.
+    """
+
+    def __init__(self, host=False, port=9765, name="tcpserver", conns=1024):
+        """
+        Initialize the AsyncTcpServer.
+
+        Args:
+            host (str, optional): The address to bind. Defaults to
+            "localhost".
+            port (int, optional): The port to bind. Defaults to 9765.
+            name (str, optional): The name of the server. Defaults to
+            "tcpserver".
+            conns (int, optional): Listen backlog. Defaults to 1024.
+        """
+
+        AsyncMaidServer.__init__(self, name)
+        self._host = host or "localhost"
+        self._port = port
+        self._conns = conns
+
+    async def _listen(self):
+        server = await asyncio.start_server(
+            self._client,
+            self._host,
+            self._port,
+            backlog=self._conns,
+            reuse_address=True,
+        )
+        self._log.debug(f"Listening on {self._host}:{self._port}")
+        return server
+
+
+class AsyncSockServer(AsyncMaidServer):
+    """
+    asyncio Unix domain socket server class that extends AsyncMaidServer.
+    """
+
+    SOCK_FILE = "/tmp/megamaid-{name}.sock"
+
+    def __init__(self, name=False, listeners=1024, path=None):
+        """
+        Initialize the AsyncSockServer.
+
+        Args:
+            name (str, optional): The name of the server. Defaults to
+            "unixserver".
+            listeners (int, optional): Listen backlog. Defaults to 1024.
+            path (str, optional): The socket file, instead of the one named
+            after the server.
+        """
+
+        AsyncMaidServer.__init__(self, name or "unixserver")
+        self._sock_name = path
+        self._listeners = listeners
+
+    @property
+    def sock_name(self):
+        """
+        Get the formatted socket file path.
+
+        Returns:
+            str: The formatted socket file path.
+        """
+
+        return self._sock_name or self.SOCK_FILE.format(name=self._name)
+
+    async def _listen(self):
+        try:
+            os.unlink(self.sock_name)
+        except OSError:
+            if os.path.exists(self.sock_name):
+                raise
+        server = await asyncio.start_unix_server(
+            self._client, self.sock_name, backlog=self._listeners
+        )
+        self._log.debug(f"Server bound to: {self.sock_name}")
+        return server
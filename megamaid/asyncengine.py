@@ -0,0 +1,612 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+asyncio crawl and fetch engine for MegaMaid. Runs the same SITE -> LINK ->
+FETCH stages as the thread pipeline, but with many requests in flight on a
+single event loop, using a small stdlib only HTTP/1.1 client.
+"""
+
+# Stdlib imports
+import os
+import ssl
+import time
+import asyncio
+
+from contextlib import asynccontextmanager
+from urllib.parse import urlparse
+
+# Internal imports
+from megamaid.edict import Edict
+from megamaid.utils import *
+from megamaid.grabber import LinkParser, FtpWalker
+from megamaid.fetcher import LinkFetcher, progress_reporter, stamp_mtime
+from megamaid.matcher import LinkMatcher
+from megamaid.listing import as_record, is_current
+
+
+class _Collector(list):
+    """
+    A list that quacks like a queue, so LinkParser and FtpWalker can hand us
+    their results without touching the event loop.
+    """
+
+    put = list.append
+
+
+class AsyncResponse:
+    """
+    A response read from an asyncio stream. The body must be consumed (or the
+    response abandoned) before the connection is reused.
+    """
+
+    def __init__(self, reader, method, status, reason, headers):
+        """
+        Initialize the AsyncResponse.
+
+        Args:
+            reader (asyncio.StreamReader): The connection's reader.
+            method (str): The request method.
+            status (int): The HTTP status code.
+            reason (str): The HTTP reason phrase.
+            headers (dict): Response headers, with lowercased names.
+        """
+
+        self._reader = reader
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.chunked = "chunked" in headers.get("transfer-encoding", "").lower()
+        self.will_close = headers.get("connection", "").lower() == "close"
+        self.length = None
+        self.done = False
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            self.length = 0
+        elif not self.chunked and headers.get("content-length", "").isdigit():
+            self.length = int(headers["content-length"])
+        elif not self.chunked:
+            # body runs until the server closes the connection
+            self.will_close = True
+        if self.length == 0:
+            self.done = True
+
+    def getheader(self, name, default=None):
+        """
+        Get a response header.
+
+        Args:
+            name (str): The header name (case insensitive).
+            default (optional): Returned if the header is missing.
+
+        Returns:
+            str: The header value.
+        """
+
+        return self.headers.get(name.lower(), default)
+
+    async def iter_chunks(self, bufsize=BUFSIZE):
+        """
+        Yield the response body in chunks of at most `bufsize` bytes.
+        """
+
+        reader = self._reader
+        if self.done:
+            return
+        if self.chunked:
+            while True:
+                line = await reader.readline()
+                size = int(line.split(b";")[0].strip() or b"0", 16)
+                if size == 0:
+                    # skip any trailers
+                    while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                        pass
+                    break
+                while size:
+                    data = await reader.read(min(bufsize, size))
+                    if not data:
+                        raise ConnectionResetError("connection closed mid-chunk")
+                    size -= len(data)
+                    yield data
+                await reader.readexactly(2)
+        elif self.length is not None:
+            remaining = self.length
+            while remaining:
+                data = await reader.read(min(bufsize, remaining))
+                if not data:
+                    raise ConnectionResetError("connection closed mid-body")
+                remaining -= len(data)
+                yield data
+        else:
+            while True:
+                data = await reader.read(bufsize)
+                if not data:
+                    break
+                yield data
+        self.done = True
+
+    async def read(self):
+        """
+        Read the whole response body.
+
+        Returns:
+            bytes: The body.
+        """
+
+        return b"".join([c async for c in self.iter_chunks()])
+
+
+class AsyncHttpClient:
+    """
+    Minimal HTTP/1.1 client over asyncio.open_connection with keep-alive
+    connection reuse, proxy support (http_proxy) and chunked decoding.
+    """
+
+    # Errors meaning a pooled connection was closed by the server while idle
+    STALE_ERRORS = (ConnectionError, asyncio.IncompleteReadError)
+
+    def __init__(self, maxsize=8, idle=10.0):
+        """
+        Initialize the AsyncHttpClient.
+
+        Args:
+            maxsize (int, optional): Idle connections kept per host. Defaults
+            to 8.
+            idle (float, optional): Seconds before an idle connection is
+            evicted. Defaults to 10.0.
+        """
+
+        self.maxsize = maxsize
+        self.idle = idle
+        self._pool = {}
+        self._ssl = ssl.create_default_context()
+        self._stats = Edict(new=0, reused=0, retried=0, evicted=0, discarded=0)
+
+    async def _connect(self, key, proxy):
+        scheme, host, port, _ = key
+        self._stats.new += 1
+        if proxy and scheme == "https":
+            reader, writer = await asyncio.open_connection(proxy.hostname, proxy.port)
+            writer.write(
+                f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n\r\n".encode()
+            )
+            await writer.drain()
+            status = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            if status.split()[1:2] != [b"200"]:
+                writer.close()
+                raise ConnectionError(f"proxy CONNECT failed: {status!r}")
+            await writer.start_tls(self._ssl, server_hostname=host)
+            return (reader, writer)
+        if proxy:
+            return await asyncio.open_connection(proxy.hostname, proxy.port)
+        if scheme == "https":
+            return await asyncio.open_connection(
+                host, port, ssl=self._ssl, server_hostname=host
+            )
+        return await asyncio.open_connection(host, port)
+
+    async def _acquire(self, key, proxy):
+        now = time.monotonic()
+        idle = self._pool.get(key, [])
+        while idle:
+            reader, writer, stamp = idle.pop()
+            if now - stamp <= self.idle and not reader.at_eof():
+                self._stats.reused += 1
+                return (reader, writer, True)
+            self._stats.evicted += 1
+            writer.close()
+        reader, writer = await self._connect(key, proxy)
+        return (reader, writer, False)
+
+    def _release(self, key, reader, writer):
+        idle = self._pool.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append((reader, writer, time.monotonic()))
+        else:
+            self._stats.discarded += 1
+            writer.close()
+
+    def _discard(self, writer):
+        self._stats.discarded += 1
+        writer.close()
+
+    async def _roundtrip(self, reader, writer, method, target, headers):
+        lines = [f"{method} {target} HTTP/1.1"]
+        lines.extend(f"{k}: {v}" for k, v in headers.items())
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await writer.drain()
+
+        status = await reader.readline()
+        if not status:
+            raise ConnectionResetError("connection closed before response")
+        parts = status.decode("latin-1").rstrip("\r\n").split(" ", 2)
+        hdrs = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            hdrs[name.strip().lower()] = value.strip()
+        reason = parts[2] if len(parts) > 2 else ""
+        resp = AsyncResponse(reader, method, int(parts[1]), reason, hdrs)
+        if parts[0] == "HTTP/1.0" and hdrs.get("connection", "").lower() != "keep-alive":
+            resp.will_close = True
+        return resp
+
+    @asynccontextmanager
+    async def open(self, site, method="GET", headers=None):
+        """
+        Send a request and yield the response. The connection goes back to
+        the pool if the body was fully read.
+
+        Args:
+            site (str): The URL.
+            method (str, optional): The request method. Defaults to "GET".
+            headers (dict, optional): Extra request headers.
+
+        Yields:
+            AsyncResponse: The response.
+        """
+
+        url = urlparse(site)
+        proxy = None
+        if len(os.getenv("http_proxy", "")) > 0:
+            proxy = urlparse(os.getenv("http_proxy"))
+
+        hdrs = dict(HEADERS)
+        hdrs["Host"] = url.netloc
+        if headers:
+            hdrs.update(headers)
+
+        if proxy and url.scheme == "http":
+            target = site
+        else:
+            target = url.path or "/"
+            if url.query:
+                target = f"{target}?{url.query}"
+
+        key = POOL.key(url, proxy)
+        reader, writer, reused = await self._acquire(key, proxy)
+        try:
+            resp = await self._roundtrip(reader, writer, method, target, hdrs)
+        except self.STALE_ERRORS:
+            self._discard(writer)
+            if not reused:
+                raise
+            self._stats.retried += 1
+            reader, writer = await self._connect(key, proxy)
+            try:
+                resp = await self._roundtrip(reader, writer, method, target, hdrs)
+            except BaseException:
+                self._discard(writer)
+                raise
+        except BaseException:
+            self._discard(writer)
+            raise
+
+        try:
+            yield resp
+        except BaseException:
+            self._discard(writer)
+            raise
+        else:
+            if resp.done and not resp.will_close:
+                self._release(key, reader, writer)
+            else:
+                self._discard(writer)
+
+    def stats(self):
+        """
+        Get the connection counters.
+
+        Returns:
+            Edict: new, reused, retried, evicted, discarded and idle counts.
+        """
+
+        retv = Edict(**self._stats)
+        retv.idle = sum(len(v) for v in self._pool.values())
+        return retv
+
+    def close(self):
+        """
+        Close every idle connection.
+        """
+
+        for idle in self._pool.values():
+            for _, writer, _ in idle:
+                writer.close()
+        self._pool = {}
+
+
+class AsyncEngine:
+    """
+    Crawl and fetch engine running every stage on one asyncio event loop.
+    Progress is reported through `gui_q` with the same counters the thread
+    pipeline uses.
+    """
+
+    def __init__(
+        self,
+        urls,
+        log_q,
+        gui_q,
+        pattern=False,
+        recursive=False,
+        chop_l=False,
+        bufsize=BUFSIZE,
+        concurrency=64,
+        site_seen=None,
+        link_seen=None,
+        guard=None,
+    ):
+        """
+        Initialize the AsyncEngine.
+
+        Args:
+            urls (list): The URLs to traverse.
+            log_q (logging.Logger): The logger.
+            gui_q (queue.Queue): Queue receiving progress updates.
+            pattern (LinkMatcher, optional): Decides which links to fetch, a
+            list of regular expressions is also accepted.
+            recursive (bool, optional): Descend into subdirectories.
+            chop_l (int, optional): Leading path components to strip.
+            bufsize (int, optional): Read buffer size per download.
+            concurrency (int, optional): In-flight requests per stage.
+            Defaults to 64.
+            site_seen (UrlSet, optional): Visited directory URLs.
+            link_seen (UrlSet, optional): Visited file URLs.
+            guard (ListingGuard, optional): Symlink loop detection.
+        """
+
+        self.urls = urls
+        self.log_q = log_q
+        self.gui_q = gui_q
+        if isinstance(pattern, LinkMatcher):
+            self.pattern = pattern
+        else:
+            self.pattern = LinkMatcher(pattern)
+        self.recursive = recursive
+        self.chop_l = chop_l if chop_l and type(chop_l) is int else False
+        self.bufsize = bufsize
+        self.concurrency = concurrency
+        self.site_seen = site_seen
+        self.link_seen = link_seen
+        self.guard = guard
+        self.client = None
+        self.listed = 0
+
+    def run(self):
+        """
+        Run the engine until every queue has drained.
+        """
+
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.client = AsyncHttpClient(maxsize=self.concurrency)
+        self.site_q = asyncio.Queue()
+        self.link_q = asyncio.Queue()
+        self.fetch_q = asyncio.Queue()
+        for url in self.urls:
+            self.site_q.put_nowait(url)
+
+        workers = [asyncio.create_task(self._filter())]
+        for _ in range(self.concurrency):
+            workers.append(asyncio.create_task(self._scrubber()))
+            workers.append(asyncio.create_task(self._fetcher()))
+
+        await self.site_q.join()
+        await self.link_q.join()
+        await self.fetch_q.join()
+
+        for w in workers:
+            w.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        self.log_q.info(f"AsyncEngine connections: {self.client.stats()}")
+        self.client.close()
+
+    async def _scrubber(self):
+        while True:
+            site = await self.site_q.get()
+            try:
+                await self.scrub(site)
+                self.listed += 1
+            except Exception as e:
+                self.log_q.critical(f"Error: {site}: {e}")
+            finally:
+                self.site_q.task_done()
+
+    async def scrub(self, site):
+        """
+        List one site, queueing the links and subdirectories found on it.
+
+        Args:
+            site (str): The URL of the listing.
+        """
+
+        sites = _Collector()
+        links = _Collector()
+        scheme = urlparse(site).scheme
+        if scheme in ("http", "https"):
+            parser = LinkParser()
+            parser.site = site
+            parser.site_q = sites
+            parser.link_q = links
+            parser.log_q = self.log_q
+            parser.gui_q = self.gui_q
+            parser.recursive = self.recursive
+            parser.site_seen = self.site_seen
+            parser.link_seen = self.link_seen
+            parser.guard = self.guard
+            # links go out as the listing streams in
+            host = urlparse(site).hostname
+            async with self.client.open(site) as resp:
+                async for chunk in resp.iter_chunks(self.bufsize):
+                    await THROTTLE.aconsume(host, len(chunk))
+                    parser.parse(chunk)
+                    for l in links:
+                        self.link_q.put_nowait(l)
+                    links.clear()
+            parser.close()
+        elif scheme == "ftp":
+            worker = FtpWalker(
+                site,
+                sites,
+                links,
+                self.log_q,
+                self.gui_q,
+                self.recursive,
+                self.site_seen,
+                self.link_seen,
+                self.guard,
+            )
+            await asyncio.to_thread(worker.walk)
+
+        for s in sites:
+            self.site_q.put_nowait(s)
+        for l in links:
+            self.link_q.put_nowait(l)
+
+    async def _filter(self):
+        while True:
+            link = await self.link_q.get()
+            try:
+                link = as_record(link)
+                if link and self.pattern.match(link.url):
+                    self.log_q.debug(f"AsyncEngine._filter(): -> fetch_q {link.url}")
+                    self.fetch_q.put_nowait(link)
+                    self.gui_q.put({"match": 1})
+            finally:
+                self.link_q.task_done()
+
+    async def _fetcher(self):
+        while True:
+            site = await self.fetch_q.get()
+            try:
+                res = await self.fetch(site)
+                if res:
+                    out, ex = res
+                    sz = os.stat(out).st_size
+                    tag = "(pre)" if ex else "(new)"
+                    self.gui_q.put(
+                        {
+                            "size": sz,
+                            "have": 1,
+                            "filename": f"{out} ({humanize_bytes(sz)}) {tag}",
+                        }
+                    )
+            except Exception as e:
+                self.log_q.critical(f"Error: {as_record(site).url}: {e}")
+            finally:
+                self.fetch_q.task_done()
+
+    async def fetch(self, site):
+        """
+        Fetch one file, skipping it if the local copy is already complete.
+
+        Args:
+            site (LinkRecord or str): The file.
+
+        Returns:
+            tuple: (local path, existed) or False on failure.
+        """
+
+        record = as_record(site)
+        site = record.url
+        url = urlparse(site)
+        if url.scheme == "ftp":
+            fetcher = LinkFetcher(
+                None, self.log_q, None, self.gui_q, self.chop_l, self.bufsize
+            )
+            return await asyncio.to_thread(fetcher.fetch, record)
+
+        ofn = output_path(url, self.chop_l)
+        os.makedirs(os.path.dirname(ofn) or ".", exist_ok=True)
+
+        if os.path.isfile(ofn):
+            current = is_current(record, ofn)
+            if current is None:
+                async with self.client.open(site, "HEAD") as resp:
+                    con_l = resp.getheader("Content-Length")
+                current = con_l is not None and int(con_l) == os.stat(ofn).st_size
+            if current:
+                return (ofn, True)
+
+        meta = await self._download(site, ofn)
+        stamp_mtime(ofn, record.mtime, meta.get("modified"))
+        return (ofn, False)
+
+    async def _download(self, site, ofn):
+        part = f"{ofn}.part"
+        offset = 0
+        meta = load_part_meta(part) if os.path.isfile(part) else {}
+        if meta.get("url") == site:
+            offset = os.stat(part).st_size
+
+        headers = {}
+        validator = meta.get("etag") or meta.get("modified")
+        if offset and validator:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        else:
+            offset = 0
+
+        host = urlparse(site).hostname
+        start, update, finish = progress_reporter(self.gui_q, ofn)
+        try:
+            async with self.client.open(site, headers=headers) as resp:
+                if resp.status == 416:
+                    total = resp.getheader("Content-Range", "").rpartition("/")[2]
+                    if not (total.isdigit() and int(total) == offset):
+                        raise IOError(f"{site}: range {offset}- not satisfiable")
+                elif resp.status >= 400:
+                    raise IOError(f"{site}: HTTP {resp.status} {resp.reason}")
+                else:
+                    if resp.status != 206:
+                        offset = 0
+                    etag = resp.getheader("ETag")
+                    save_part_meta(
+                        part,
+                        {
+                            "url": site,
+                            "etag": etag if etag and not etag.startswith("W/") else None,
+                            "modified": resp.getheader("Last-Modified"),
+                        },
+                    )
+                    total = resp.length
+                    if total is not None:
+                        total += offset
+                    with open(part, "ab+") as fp:
+                        fp.seek(offset)
+                        fp.truncate()
+                        start(offset)
+                        async for chunk in resp.iter_chunks(self.bufsize):
+                            fp.write(chunk)
+                            await THROTTLE.aconsume(host, len(chunk))
+                            update(len(chunk), total)
+        finally:
+            finish()
+
+        meta = load_part_meta(part)
+        os.replace(part, ofn)
+        os.unlink(f"{part}.meta")
+        return meta
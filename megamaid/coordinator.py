@@ -0,0 +1,638 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Distributed crawling for MegaMaid. A Coordinator, served by megamaid-grabber,
+owns the crawl: the sites left to list, the links left to fetch and what has
+been seen. Workers (megamaid.py --worker) lease batches of that work, report
+each result and send heartbeats; work leased to a worker that goes quiet is
+handed out again.
+"""
+
+# Stdlib imports
+import os
+import json
+import time
+import socket
+import itertools
+import threading
+
+from queue import Queue
+from collections import deque
+
+# Internal imports
+from megamaid.edict import Edict
+from megamaid.dedup import UrlSet
+from megamaid.matcher import LinkMatcher
+from megamaid.listing import LinkRecord, as_record
+from megamaid.grabber import SiteScrubber
+
+
+# Seconds a lease lasts without a heartbeat
+LEASE_TTL = 60.0
+
+# Times a failed site or link is handed out again
+RETRIES = 3
+
+# Seconds between "stats" events
+STATS_EVERY = 1.0
+
+
+class Coordinator:
+    """
+    The crawl state behind the coordinator's commands, all JSON objects with
+    a "command" key:
+
+        add: {"urls": [...]} seeds sites to list.
+        lease: {"worker": name, "max": n} hands out up to n items, each
+            {"kind": "site" or "fetch", "url": ..., "size": ..., "mtime": ...},
+            as {"lease": id, "items": [...], "ttl": secs, "done": bool}.
+        result: {"worker": name, "lease": id, "url": ..., "ok": bool} reports
+            an item; a listed site also carries "sites" and "links" (lists of
+            [url, size, mtime, exact]), a failure carries "error".
+        heartbeat: {"worker": name, "leases": [id, ...]} extends the leases
+            the worker says it holds; one whose answer never reached it
+            expires and its work is handed out again.
+        status: gets the counters.
+
+    On a server that takes subscriptions, each result is published to the
+    "progress" topic and the counters to "stats", every STATS_EVERY seconds.
+
+    The server runs commands one at a time, so no locking is needed.
+    """
+
+    def __init__(
+        self,
+        pattern=False,
+        exclude=None,
+        recursive=False,
+        ttl=LEASE_TTL,
+        retries=RETRIES,
+        jobs=None,
+        log_q=None,
+    ):
+        """
+        Initialize the Coordinator.
+
+        Args:
+            pattern (list, optional): Patterns a link must match to be fetched.
+            exclude (list, optional): Patterns that rule a link out.
+            recursive (bool, optional): Follow the subdirectories workers find.
+            ttl (float, optional): Seconds a lease lasts without a heartbeat.
+            Defaults to LEASE_TTL.
+            retries (int, optional): Times a failed item is handed out again.
+            Defaults to RETRIES.
+            jobs (JobStore, optional): Records the crawl, so it can be resumed.
+            log_q (logging.Logger, optional): The logger.
+        """
+
+        self.matcher = LinkMatcher(pattern, exclude)
+        self.recursive = recursive
+        self.ttl = ttl
+        self.retries = retries
+        self.jobs = jobs
+        self.log_q = log_q
+        self._sites = deque()
+        self._fetch = deque()
+        self._leases = {}
+        self._ids = itertools.count(1)
+        self._site_seen = UrlSet()
+        self._link_seen = UrlSet()
+        self._tries = {}
+        self._workers = {}
+        self._done = False
+        self._publish = None
+        self._stats = Edict(
+            sites=0,
+            links=0,
+            matched=0,
+            fetched=0,
+            bytes=0,
+            failed=0,
+            leases=0,
+            expired=0,
+            retried=0,
+        )
+
+    def attach(self, server):
+        """
+        Register the commands with a server.
+
+        Args:
+            server (MaidServer): A TcpServer or SockServer, or their asyncio
+            counterparts.
+        """
+
+        server.add_handler("add", self._add)
+        server.add_handler("lease", self._lease)
+        server.add_handler("result", self._result)
+        server.add_handler("heartbeat", self._heartbeat)
+        server.add_handler("status", self._status)
+        if hasattr(server, "publish"):
+            self._publish = server.publish
+            server.every(STATS_EVERY, "stats", lambda: dict(self.stats()))
+
+    def add(self, url):
+        """
+        Queue a site to list, unless it was seen already.
+
+        Args:
+            url (str): The site URL.
+        """
+
+        if not self._site_seen.add(url):
+            return
+        if self.jobs:
+            self.jobs.site(url)
+        self._sites.append({"kind": "site", "url": url})
+        self._done = False
+
+    def resume(self):
+        """
+        Requeue the work an earlier run recorded in the job store left.
+        """
+
+        for url in self.jobs.known("sites"):
+            self._site_seen.add(url)
+        for url in self.jobs.known("links"):
+            self._link_seen.add(url)
+        pending = self.jobs.pending()
+        for url in pending.sites:
+            self._sites.append({"kind": "site", "url": url})
+        for url in pending.links:
+            self._offer(LinkRecord(url, None, None, False))
+        for url in pending.matched:
+            self._fetch.append({"kind": "fetch", "url": url})
+        if self.log_q:
+            self.log_q.info(
+                f"Coordinator(): resuming {len(pending.sites)} sites, "
+                f"{len(pending.links)} links, {len(pending.matched)} matched links"
+            )
+
+    def _offer(self, record):
+        # Filter a link a worker found, matches are queued for fetching
+        if self.matcher.match(record.url):
+            self._stats.matched += 1
+            if self.jobs:
+                self.jobs.matched(record.url)
+            self._fetch.append(
+                {
+                    "kind": "fetch",
+                    "url": record.url,
+                    "size": record.size,
+                    "mtime": record.mtime,
+                    "exact": record.exact,
+                }
+            )
+        elif self.jobs:
+            self.jobs.skipped(record.url)
+
+    def _reap(self):
+        # Hand out again whatever is leased to workers that went quiet
+        now = time.monotonic()
+        for lid, lease in list(self._leases.items()):
+            if lease.expires > now:
+                continue
+            del self._leases[lid]
+            self._stats.expired += 1
+            if self.log_q:
+                self.log_q.warning(
+                    f"Coordinator(): lease {lid} of {lease.worker} expired, "
+                    f"requeueing {len(lease.work)} items"
+                )
+            for item in lease.work.values():
+                self._requeue(item, front=True)
+
+    def _requeue(self, item, front=False):
+        queue = self._sites if item["kind"] == "site" else self._fetch
+        if front:
+            queue.appendleft(item)
+        else:
+            queue.append(item)
+
+    def _add(self, conn, data):
+        for url in data.get("urls", []):
+            self.add(url)
+        return {"ok": True}
+
+    def _lease(self, conn, data):
+        self._reap()
+        worker = data.get("worker", "?")
+        self._workers[worker] = time.monotonic()
+        items = []
+        # sites first, they make more work for everyone
+        for queue in (self._sites, self._fetch):
+            while queue and len(items) < data.get("max", 1):
+                items.append(queue.popleft())
+        if not items:
+            done = not self._leases
+            if done and not self._done and self.log_q:
+                self.log_q.info(f"Coordinator(): crawl done, {self.stats()}")
+            self._done = done
+            return {"lease": None, "items": [], "ttl": self.ttl, "done": done}
+
+        lid = next(self._ids)
+        self._leases[lid] = Edict(
+            worker=worker,
+            expires=time.monotonic() + self.ttl,
+            work={item["url"]: item for item in items},
+        )
+        self._stats.leases += 1
+        return {"lease": lid, "items": items, "ttl": self.ttl, "done": False}
+
+    def _result(self, conn, data):
+        worker = data.get("worker", "?")
+        self._workers[worker] = time.monotonic()
+        lease = self._leases.get(data.get("lease"))
+        item = lease.work.pop(data.get("url"), None) if lease else None
+        if item is None:
+            # the lease expired and the item went to someone else meanwhile
+            return {"ok": False, "error": "not leased"}
+        if not lease.work:
+            del self._leases[data["lease"]]
+
+        url = item["url"]
+        if self._publish:
+            self._publish(
+                "progress",
+                {
+                    "worker": worker,
+                    "kind": item["kind"],
+                    "url": url,
+                    "ok": bool(data.get("ok")),
+                    "bytes": data.get("bytes", 0),
+                },
+            )
+        if not data.get("ok"):
+            tries = self._tries[url] = self._tries.get(url, 0) + 1
+            if tries <= self.retries:
+                self._stats.retried += 1
+                self._requeue(item)
+            else:
+                self._stats.failed += 1
+                if self.log_q:
+                    self.log_q.error(
+                        f"Coordinator(): {url}: {data.get('error')}, giving up"
+                    )
+            return {"ok": True}
+
+        if item["kind"] == "site":
+            self._stats.sites += 1
+            if self.jobs:
+                self.jobs.site_done(url)
+            if self.recursive:
+                for site in data.get("sites", []):
+                    self.add(site)
+            for link in data.get("links", []):
+                record = LinkRecord(*link)
+                if not self._link_seen.add(record.url):
+                    continue
+                self._stats.links += 1
+                if self.jobs:
+                    self.jobs.link(record.url)
+                self._offer(record)
+        else:
+            self._stats.fetched += 1
+            self._stats.bytes += data.get("bytes", 0)
+            if self.jobs:
+                self.jobs.fetched(url)
+        return {"ok": True}
+
+    def _heartbeat(self, conn, data):
+        worker = data.get("worker", "?")
+        now = time.monotonic()
+        self._workers[worker] = now
+        for lid in data.get("leases", []):
+            lease = self._leases.get(lid)
+            if lease and lease.worker == worker:
+                lease.expires = now + self.ttl
+        self._reap()
+        return {"ok": True, "ttl": self.ttl}
+
+    def _status(self, conn, data):
+        return dict(self.stats())
+
+    def stats(self):
+        """
+        Get the crawl's counters.
+
+        Returns:
+            Edict: sites listed, links found, matched and fetched, bytes
+            fetched, items that failed for good, leases handed out, leases
+            that expired, failed items retried, work queued and leased, and
+            workers seen.
+        """
+
+        retv = Edict(**self._stats)
+        retv.queued = len(self._sites) + len(self._fetch)
+        retv.leased = sum(len(lease.work) for lease in self._leases.values())
+        retv.workers = len(self._workers)
+        return retv
+
+
+class CoordinatorClient:
+    """
+    A connection to a coordinator, safe to share between threads. Each call
+    sends one JSON line, a batch sends one line holding several requests, and
+    either waits for the JSON line that answers it.
+    """
+
+    def __init__(self, addr, timeout=30.0):
+        """
+        Initialize the CoordinatorClient.
+
+        Args:
+            addr (str): HOST:PORT, or the path of a UNIX domain socket.
+            timeout (float, optional): Seconds to wait for an answer.
+        """
+
+        self.addr = addr
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._sock = None
+        self._buf = b""
+
+    def _connect(self):
+        if "/" in self.addr:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.addr)
+        else:
+            host, _, port = self.addr.rpartition(":")
+            sock = socket.create_connection((host, int(port)), self.timeout)
+        self._sock = sock
+        self._buf = b""
+
+    def call(self, command, **kwargs):
+        """
+        Run a command on the coordinator, reconnecting once if the
+        connection dropped.
+
+        Args:
+            command (str): The command.
+            **kwargs: Its arguments.
+
+        Returns:
+            dict: The answer.
+        """
+
+        return self._send(dict(kwargs, command=command))
+
+    def batch(self, calls):
+        """
+        Run several commands in one round trip, in order.
+
+        Args:
+            calls (list): (command, arguments dict) tuples.
+
+        Returns:
+            list: The answers, in the same order.
+        """
+
+        return self._send([dict(kw, command=cmd) for cmd, kw in calls])
+
+    def _send(self, req):
+        data = json.dumps(req).encode() + b"\n"
+        with self._lock:
+            for attempt in (1, 2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    self._sock.sendall(data)
+                    return self._readline()
+                except OSError:
+                    self.close()
+                    if attempt == 2:
+                        raise
+
+    def _readline(self):
+        while b"\n" not in self._buf:
+            chunk = self._sock.recv(65536)
+            if not chunk:
+                raise ConnectionResetError("coordinator hung up")
+            self._buf += chunk
+        line, _, self._buf = self._buf.partition(b"\n")
+        return json.loads(line)
+
+    def subscribe(self, topics):
+        """
+        Follow events, on a connection of their own. Needs a coordinator
+        served with asyncio.
+
+        Args:
+            topics (list): The topics, "progress" and/or "stats".
+
+        Yields:
+            dict: Each event, with "event" set to its topic, until the
+            coordinator hangs up.
+        """
+
+        conn = CoordinatorClient(self.addr, None)
+        try:
+            reply = conn.call("subscribe", topics=list(topics))
+            if not isinstance(reply, dict) or "error" in reply:
+                raise ValueError(f"can't subscribe: {reply}")
+            while True:
+                try:
+                    yield conn._readline()
+                except ConnectionResetError:
+                    return
+        finally:
+            conn.close()
+
+    def close(self):
+        """
+        Close the connection.
+        """
+
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+
+class Worker:
+    """
+    Leases work from a coordinator and does it: lists sites with a
+    SiteScrubber, fetches links with a LinkFetcher, on a number of threads,
+    while another keeps the leases alive.
+    """
+
+    def __init__(self, client, fetcher, log_q, name=None, threads=1, batch=4):
+        """
+        Initialize the Worker.
+
+        Args:
+            client (CoordinatorClient): The coordinator.
+            fetcher (callable): Makes a LinkFetcher, one per thread.
+            log_q (logging.Logger): The logger.
+            name (str, optional): How the coordinator knows this worker.
+            Defaults to the host name and process id.
+            threads (int, optional): Items worked on at once. Defaults to 1.
+            batch (int, optional): Items leased at a time per thread.
+            Defaults to 4.
+        """
+
+        self.client = client
+        self.fetcher = fetcher
+        self.log_q = log_q
+        self.name = name or f"{socket.gethostname()}:{os.getpid()}"
+        self.threads = threads
+        self.batch = batch
+        self._stop = threading.Event()
+        self._ttl = LEASE_TTL
+        self._lock = threading.Lock()
+        self._held = set()
+        self._stats = Edict(sites=0, fetched=0, failed=0)
+
+    def run(self):
+        """
+        Work until the coordinator has nothing left.
+        """
+
+        self._ttl = self._beat()
+        beat = threading.Thread(target=self._heartbeat, daemon=True)
+        beat.start()
+        threads = [
+            threading.Thread(target=self._work, daemon=True)
+            for _ in range(self.threads)
+        ]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self._stop.set()
+        beat.join()
+
+    def _heartbeat(self):
+        while not self._stop.wait(self._ttl / 3):
+            try:
+                self._ttl = self._beat()
+            except OSError as e:
+                self.log_q.warning(f"Worker(): heartbeat failed: {e}")
+
+    def _beat(self):
+        # Keep alive only the leases this worker got the answer for
+        with self._lock:
+            held = list(self._held)
+        return self.client.call("heartbeat", worker=self.name, leases=held)["ttl"]
+
+    def _report(self, result):
+        # Send a result, waiting out the coordinator being unreachable for as
+        # long as the lease can last, after that its work is someone else's.
+        # A resend of one that did arrive is answered "not leased", harmlessly.
+        deadline = time.monotonic() + self._ttl
+        while True:
+            try:
+                return self.client.call("result", **result)
+            except OSError as e:
+                self.log_q.error(f"Worker(): can't reach the coordinator: {e}")
+            if time.monotonic() >= deadline or self._stop.wait(5):
+                self.log_q.warning(
+                    f"Worker(): lease {result['lease']} has expired, "
+                    f"dropping {result['url']}"
+                )
+                return None
+
+    def _work(self):
+        fetcher = self.fetcher()
+        last = None
+        while True:
+            lease = {"worker": self.name, "max": self.batch}
+            try:
+                if last is None:
+                    reply = self.client.call("lease", **lease)
+                else:
+                    # a lease's last result goes with the ask for the next one
+                    reply = self.client.batch([("result", last), ("lease", lease)])[1]
+                    with self._lock:
+                        self._held.discard(last["lease"])
+                    last = None
+            except OSError as e:
+                self.log_q.error(f"Worker(): can't reach the coordinator: {e}")
+                if self._stop.wait(5):
+                    return
+                continue
+            if "error" in reply:
+                self.log_q.error(f"Worker(): the coordinator said {reply['error']}")
+                if self._stop.wait(5):
+                    return
+                continue
+            self._ttl = reply.get("ttl", self._ttl)
+            if not reply["items"]:
+                if reply["done"]:
+                    return
+                # others still hold leases that may come back
+                time.sleep(1)
+                continue
+            with self._lock:
+                self._held.add(reply["lease"])
+            for i, item in enumerate(reply["items"], 1):
+                result = self._do(fetcher, item)
+                result.update(worker=self.name, lease=reply["lease"])
+                if i == len(reply["items"]):
+                    last = result
+                elif self._report(result) is None:
+                    # the rest of the lease went back to the coordinator too
+                    with self._lock:
+                        self._held.discard(reply["lease"])
+                    break
+
+    def _do(self, fetcher, item):
+        url = item["url"]
+        try:
+            if item["kind"] == "site":
+                sites, links = Queue(), Queue()
+                scrubber = SiteScrubber(sites, links, self.log_q, None, Queue(), True)
+                scrubber.scrub(url)
+                with self._lock:
+                    self._stats.sites += 1
+                return {
+                    "url": url,
+                    "ok": True,
+                    "sites": list(sites.queue),
+                    "links": [list(as_record(link)) for link in links.queue],
+                }
+            record = LinkRecord(
+                url, item.get("size"), item.get("mtime"), item.get("exact", False)
+            )
+            res = fetcher.fetch(record)
+            if not res:
+                raise IOError("fetch failed")
+            with self._lock:
+                self._stats.fetched += 1
+            out, existed = res
+            size = 0 if existed else os.path.getsize(out)
+            return {"url": url, "ok": True, "bytes": size}
+        except Exception as e:
+            self.log_q.error(f"Worker(): {url}: {e}")
+            with self._lock:
+                self._stats.failed += 1
+            return {"url": url, "ok": False, "error": str(e)}
+
+    def stats(self):
+        """
+        Get what this worker did.
+
+        Returns:
+            Edict: sites listed, links fetched and items that failed.
+        """
+
+        with self._lock:
+            return Edict(**self._stats)
@@ -0,0 +1,305 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Visited URL tracking for MegaMaid. Keeps the crawler from listing a directory
+or queueing a file more than once, and from following symlink loops.
+"""
+
+# Stdlib imports
+import re
+import math
+import hashlib
+import posixpath
+import threading
+
+from urllib.parse import urlsplit, urlunsplit, quote
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+DEFAULT_PORTS = {"http": 80, "https": 443, "ftp": 21}
+
+# Characters a percent-escape can be swapped for without changing the URL
+UNRESERVED = frozenset(
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~"
+)
+
+_ESCAPE = re.compile(r"%([0-9A-Fa-f]{2})")
+
+# A % that doesn't start an escape
+_STRAY = re.compile(r"%(?![0-9A-Fa-f]{2})")
+
+
+def _unescape(m):
+    char = chr(int(m.group(1), 16))
+    return char if char in UNRESERVED else f"%{m.group(1).upper()}"
+
+
+def canonical_url(url):
+    """
+    Normalize a URL for comparison: lowercase scheme and host, no default
+    port, no fragment, no empty or dot path segments and consistent
+    percent-encoding. Escaped unreserved characters are decoded, and other
+    escapes get upper case hex but stay escaped, since `%2F` is not `/`. A
+    trailing slash is kept, it marks a directory.
+
+    Args:
+        url (str): The URL.
+
+    Returns:
+        str: The canonical form of `url`.
+    """
+
+    parts = urlsplit(url)
+    scheme = parts.scheme.lower()
+    netloc = (parts.hostname or "").lower()
+    if parts.port and parts.port != DEFAULT_PORTS.get(scheme):
+        netloc = f"{netloc}:{parts.port}"
+
+    path = parts.path or "/"
+    trailing = path.endswith("/")
+    if "%" in path:
+        path = _ESCAPE.sub(_unescape, _STRAY.sub("%25", path))
+    path = posixpath.normpath(path)
+    if path.startswith("//"):
+        path = path[1:]
+    if trailing and path != "/":
+        path += "/"
+    path = quote(path, safe="/:@!$&'()*+,;=-._~%")
+
+    return urlunsplit((scheme, netloc, path, parts.query, ""))
+
+
+class UrlSet:
+    """
+    Exact set of canonical URLs.
+    """
+
+    def __init__(self):
+        """
+        Initialize the UrlSet.
+        """
+
+        self._lock = threading.Lock()
+        self._seen = set()
+        self._hits = 0
+        self._misses = 0
+
+    def add(self, url):
+        """
+        Mark a URL as seen.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            bool: True if the URL had not been seen before.
+        """
+
+        key = canonical_url(url)
+        with self._lock:
+            if key in self._seen:
+                self._hits += 1
+                return False
+            self._seen.add(key)
+            self._misses += 1
+            return True
+
+    def __contains__(self, url):
+        with self._lock:
+            return canonical_url(url) in self._seen
+
+    def __len__(self):
+        return self._misses
+
+    def stats(self):
+        """
+        Get the dedup counters.
+
+        Returns:
+            Edict: unique (URLs added), hits (duplicates dropped) and rate
+            (fraction of lookups that were duplicates).
+        """
+
+        with self._lock:
+            total = self._hits + self._misses
+            return Edict(
+                unique=self._misses,
+                hits=self._hits,
+                rate=self._hits / total if total else 0.0,
+            )
+
+
+class BloomFilter(UrlSet):
+    """
+    Memory bounded stand-in for UrlSet. False positives (a new URL reported as
+    seen, and so skipped) happen at roughly the configured error rate once
+    `capacity` URLs have been added; there are no false negatives.
+    """
+
+    def __init__(self, capacity=10000000, error=0.001):
+        """
+        Initialize the BloomFilter.
+
+        Args:
+            capacity (int, optional): Expected number of URLs. Defaults to
+            10,000,000.
+            error (float, optional): Target false positive rate at capacity.
+            Defaults to 0.001.
+        """
+
+        UrlSet.__init__(self)
+        self._seen = None
+        self.bits = max(8, int(-capacity * math.log(error) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._array = bytearray((self.bits + 7) // 8)
+
+    def _positions(self, key):
+        # Kirsch-Mitzenmacher double hashing off one 128 bit digest
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def add(self, url):
+        return self._add(canonical_url(url))
+
+    def __contains__(self, url):
+        return self._has(canonical_url(url))
+
+    def _add(self, key):
+        positions = self._positions(key)
+        array = self._array
+        with self._lock:
+            new = False
+            for pos in positions:
+                byte, bit = divmod(pos, 8)
+                if not array[byte] & (1 << bit):
+                    array[byte] |= 1 << bit
+                    new = True
+            if new:
+                self._misses += 1
+            else:
+                self._hits += 1
+            return new
+
+    def _has(self, key):
+        array = self._array
+        with self._lock:
+            return all(
+                array[pos // 8] & (1 << (pos % 8)) for pos in self._positions(key)
+            )
+
+
+class ListingGuard:
+    """
+    Detects directory listings that repeat one of their ancestors, which is
+    what a symlink back up the tree looks like from the outside.
+    """
+
+    def __init__(self, bloom=None):
+        """
+        Initialize the ListingGuard.
+
+        Args:
+            bloom (BloomFilter, optional): Keeps the fingerprints in bounded
+            memory, a false positive skips a directory that isn't a loop.
+            Defaults to a dict of every listing's fingerprint.
+        """
+
+        self._lock = threading.Lock()
+        self._prints = {}
+        self._bloom = bloom
+
+    def check(self, url, hrefs):
+        """
+        Record a listing and decide whether to descend into it.
+
+        Args:
+            url (str): The URL of the listing.
+            hrefs (iterable): The entries found on it.
+
+        Returns:
+            bool: False if an ancestor directory had the very same entries.
+        """
+
+        key = canonical_url(url)
+        digest = hashlib.sha1("\n".join(sorted(set(hrefs))).encode()).hexdigest()
+        parts = urlsplit(key)
+        path = parts.path.rstrip("/")
+        if self._bloom is not None:
+            self._bloom._add(f"{key} {digest}")
+            while path:
+                path = path.rpartition("/")[0]
+                parent = urlunsplit((parts.scheme, parts.netloc, f"{path}/", "", ""))
+                if self._bloom._has(f"{parent} {digest}"):
+                    return False
+            return True
+
+        with self._lock:
+            self._prints[key] = digest
+            while path:
+                path = path.rpartition("/")[0]
+                parent = urlunsplit((parts.scheme, parts.netloc, f"{path}/", "", ""))
+                if self._prints.get(parent) == digest:
+                    return False
+        return True
+
+
+def make_seen(mode="exact", capacity=10000000, error=0.001):
+    """
+    Build the visited set for a dedup mode.
+
+    Args:
+        mode (str, optional): "exact", "bloom" or "off". Defaults to "exact".
+        capacity (int, optional): Bloom filter capacity.
+        error (float, optional): Bloom filter false positive rate.
+
+    Returns:
+        UrlSet: The set, or None when dedup is off.
+    """
+
+    if mode == "bloom":
+        return BloomFilter(capacity, error)
+    if mode == "exact":
+        return UrlSet()
+    return None
+
+
+def make_guard(mode="exact", capacity=10000000, error=0.001):
+    """
+    Build the symlink loop guard for a dedup mode.
+
+    Args:
+        mode (str, optional): "exact", "bloom" or "off". Defaults to "exact".
+        capacity (int, optional): Bloom filter capacity, in directories.
+        error (float, optional): Bloom filter false positive rate.
+
+    Returns:
+        ListingGuard: The guard, or None when dedup is off.
+    """
+
+    if mode == "bloom":
+        return ListingGuard(BloomFilter(capacity, error))
+    if mode == "exact":
+        return ListingGuard()
+    return None
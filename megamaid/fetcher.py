@@ -9,67 +9,486 @@ from urllib.parse import urlparse
 # Internal imports
 from megamaid.utils import *
 from megamaid.edict import *
+from megamaid.trace import span
+from megamaid.manifest import Manifest
+from megamaid.objstore import HashingWriter
+from megamaid.listing import as_record, is_current, parse_modified
+from megamaid.segment import SEGMENT_SIZE, SegmentError, SegmentedDownload
+from megamaid.segment import completed, plan
+
+
+def progress_reporter(gui_q, ofn, every=0.5):
+    # Build callbacks that batch byte counts into periodic gui updates
+    state = {"done": 0, "sent": 0, "stamp": time.time()}
+
+    def _start(offset):
+        state["done"] = offset
+        state["sent"] = offset
+
+    def _update(n, total=None):
+        state["done"] += n
+        now = time.time()
+        if now - state["stamp"] >= every:
+            gui_q.put(
+                {
+                    "bytes": state["done"] - state["sent"],
+                    "progress": (ofn, state["done"], total),
+                }
+            )
+            state["sent"] = state["done"]
+            state["stamp"] = now
+
+    def _finish():
+        gui_q.put(
+            {"bytes": state["done"] - state["sent"], "progress": (ofn, None, None)}
+        )
+
+    return (_start, _update, _finish)
+
+
+def stamp_mtime(ofn, mtime, modified=None):
+    # Give a fetched file the listing's time for it, or failing that the
+    # server's, so is_current() compares like with like next time
+    if mtime is None:
+        mtime = parse_modified(modified)
+    if mtime is not None:
+        os.utime(ofn, (time.time(), mtime))
 
 
 class LinkFetcher(threading.Thread):
 
-    def __init__(self, fetch_q, log_q, sig_q, gui_q, chop_l=False):
+    # Seconds between live progress updates sent to the gui queue
+    PROGRESS_EVERY = 0.5
+
+    def __init__(
+        self,
+        fetch_q,
+        log_q,
+        sig_q,
+        gui_q,
+        chop_l=False,
+        bufsize=BUFSIZE,
+        manifest=False,
+        fresh=0,
+        jobs=None,
+        segments=1,
+        segment_size=SEGMENT_SIZE,
+        store=None,
+        verify_q=None,
+        mirrors=None,
+        idle=IDLE,
+    ):
         threading.Thread.__init__(self, daemon=True)
         self.fetch_q = fetch_q
         self.log_q = log_q
         self.sig_q = sig_q
         self.gui_q = gui_q
+        self.bufsize = bufsize
+        self.manifest = manifest
+        self.fresh = fresh
+        self.jobs = jobs
+        self.segments = segments
+        self.segment_size = segment_size
+        self.store = store
+        self.verify_q = verify_q
+        self.mirrors = mirrors
+        self.idle = idle
+        # sha256 of the last file downloaded, when it was hashed on the way in
+        self.digest = None
+        self.processed = 0
+        self.transferred = 0
+        self.retiring = False
         if chop_l and type(chop_l) is int:
             self.chop_l = chop_l
         else:
             self.chop_l = False
 
+    def retire(self):
+        # Exit once the current item is done (used by the Supervisor)
+        self.retiring = True
+
+    def _progress(self, ofn):
+        start, update, finish = progress_reporter(
+            self.gui_q, ofn, self.PROGRESS_EVERY
+        )
+
+        def _update(n, total=None):
+            self.transferred += n
+            update(n, total)
+
+        return (start, _update, finish)
+
+    def _http_fetch(self, site, fp, offset, meta, start, update, cond=None):
+        headers = dict(cond or {})
+        validator = meta.get("etag") or meta.get("modified")
+        other = meta.get("url") != site
+        if offset and validator and not other:
+            headers["Range"] = f"bytes={offset}-"
+            headers["If-Range"] = validator
+        elif offset and other and meta.get("size"):
+            # picking up where another mirror stopped, its validators mean
+            # nothing here so the size has to match instead
+            headers["Range"] = f"bytes={offset}-"
+        else:
+            offset = 0
+
+        with http_open(site, headers=headers) as resp:
+            if resp.status == 304:
+                return None
+            if resp.status == 416:
+                # nothing left past our offset, the partial is already whole
+                total = resp.getheader("Content-Range", "").rpartition("/")[2]
+                if total.isdigit() and int(total) == offset:
+                    return meta
+                raise IOError(f"{site}: range {offset}- not satisfiable")
+            if resp.status >= 400:
+                raise IOError(f"{site}: HTTP {resp.status} {resp.reason}")
+            if resp.status != 206:
+                # the server ignored the range, or the If-Range check failed
+                offset = 0
+            elif "If-Range" not in headers:
+                total = resp.getheader("Content-Range", "").rpartition("/")[2]
+                if total != str(meta["size"]):
+                    raise IOError(f"{site}: not the size the other mirror had")
+
+            etag = resp.getheader("ETag")
+            meta = {
+                "url": site,
+                # weak validators can't be used with If-Range
+                "etag": etag if etag and not etag.startswith("W/") else None,
+                "modified": resp.getheader("Last-Modified"),
+                "size": None if resp.length is None else resp.length + offset,
+            }
+            save_part_meta(fp.name, meta)
+            fp.seek(offset)
+            fp.truncate()
+            start(offset)
+
+            total = resp.length
+            if (
+                self.segments > 1
+                and resp.status == 200
+                and total
+                and (meta["etag"] or meta["modified"])
+                and resp.getheader("Accept-Ranges", "").lower() == "bytes"
+            ):
+                segments = plan(total, self.segments, self.segment_size)
+                if len(segments) > 1:
+                    meta.update(size=total, segments=segments)
+                    return self._segmented(site, fp.name, meta, update, resp)
+            if total is not None:
+                total += offset
+            host = urlparse(site).hostname
+            for chunk in iter_response(resp, self.bufsize, host):
+                with span("write", "disk", bytes=len(chunk)):
+                    fp.write(chunk)
+                update(len(chunk), total)
+        return meta
+
+    def _segmented(self, site, part, meta, update, resp=None):
+        # Fetch the rest of a segmented download, its ranges are kept in meta
+        def _checkpoint(segments):
+            save_part_meta(part, meta)
+
+        dl = SegmentedDownload(
+            site,
+            part,
+            meta["size"],
+            meta.get("etag") or meta.get("modified"),
+            meta["segments"],
+            self.bufsize,
+            update,
+            _checkpoint,
+            log_q=self.log_q,
+        )
+        self.log_q.debug(
+            f"LinkFetcher(): {site} in {len(meta['segments'])} segments, "
+            f"{completed(meta['segments'])} of {meta['size']} bytes done"
+        )
+        dl.run(resp)
+        return meta
+
+    def _mirrored(self, site, fp, meta, start, update, cond=None):
+        # Fetch from the mirror measuring best, carrying on from the next one
+        # where it stopped if it fails
+        error = None
+        for base, src in self.mirrors.candidates(site, ("http", "https")):
+            fp.flush()
+            offset = os.path.getsize(fp.name)
+            got = 0
+            st = time.monotonic()
+
+            def _update(n, total=None):
+                nonlocal got
+                got += n
+                update(n, total)
+
+            try:
+                meta = self._http_fetch(src, fp, offset, meta, start, _update, cond)
+                self.mirrors.record(base, got, time.monotonic() - st)
+                return meta
+            except SegmentError:
+                raise
+            except Exception as e:
+                self.mirrors.failed(base, got, time.monotonic() - st)
+                error = e
+                meta = load_part_meta(fp.name)
+                if meta.get("segments"):
+                    # the ranges are tied to that mirror's validator
+                    raise
+                self.log_q.warning(f"LinkFetcher(): {src}: {e}, trying the next mirror")
+        raise error
+
+    def _download(self, site, url, ofn, cond=None):
+        part = f"{ofn}.part"
+        offset = 0
+        meta = {}
+        if os.path.isfile(part):
+            meta = load_part_meta(part)
+            if meta.get("url") == site or (
+                self.mirrors and self.mirrors.canonical(meta.get("url", "")) == site
+            ):
+                offset = os.stat(part).st_size
+            else:
+                meta = {}
+
+        start, update, finish = self._progress(ofn)
+        try:
+            with open(part, "ab+") as fp:
+                if self.store or self.verify_q:
+                    # hash as the bytes arrive, rather than reading it all back
+                    fp = HashingWriter(fp)
+                if url.scheme in ("http", "https"):
+                    try:
+                        if meta.get("segments"):
+                            start(completed(meta["segments"]))
+                            meta = self._segmented(meta["url"], part, meta, update)
+                        elif self.mirrors:
+                            meta = self._mirrored(site, fp, meta, start, update, cond)
+                        else:
+                            meta = self._http_fetch(
+                                site, fp, offset, meta, start, update, cond
+                            )
+                    except SegmentError as e:
+                        self.log_q.warning(f"LinkFetcher(): {e}, starting over")
+                        meta = self._http_fetch(site, fp, 0, {}, start, update, cond)
+                elif url.scheme == "ftp":
+
+                    def _on_start(offset, mdtm):
+                        meta.update(url=site, modified=mdtm)
+                        save_part_meta(part, meta)
+                        start(offset)
+
+                    ftp_get(
+                        site,
+                        fp,
+                        self.bufsize,
+                        update,
+                        offset,
+                        meta.get("modified"),
+                        _on_start,
+                    )
+                if isinstance(fp, HashingWriter) and meta is not None:
+                    # the verifier hashes it in its pool if we can't
+                    meta["digest"] = fp.digest(fallback=bool(self.store))
+        finally:
+            finish()
+
+        if meta is None:
+            # not modified, drop the empty partial we opened
+            if os.path.getsize(part) == 0 and not os.path.isfile(f"{part}.meta"):
+                os.unlink(part)
+            return None
+
+        os.replace(part, ofn)
+        os.unlink(f"{part}.meta")
+        return meta
+
+    def _revalidate(self, site, url, ofn):
+        # Check a local file against the manifest, returns (fetch, cond headers)
+        if self.chop_l:
+            manifest = Manifest.open(".")
+            rel = os.path.relpath(ofn, ".")
+        else:
+            manifest = Manifest.open(url.hostname)
+            rel = os.path.relpath(ofn, url.hostname)
+        entry = manifest.get(rel)
+        now = time.time()
+
+        if not os.path.isfile(ofn):
+            return (True, None, manifest, rel)
+
+        loc_l = os.stat(ofn).st_size
+        if not entry or entry.get("size") != loc_l or entry.get("url") != site:
+            # no usable record, fall back to comparing sizes once
+            if url.scheme in ("http", "https"):
+                resp = http_head(site)
+                con_l = resp.getheader("Content-Length")
+                if con_l is not None and int(con_l) == loc_l:
+                    manifest.set(
+                        rel,
+                        url=site,
+                        etag=resp.getheader("ETag"),
+                        modified=resp.getheader("Last-Modified"),
+                        size=loc_l,
+                        checked=now,
+                    )
+                    return (False, None, manifest, rel)
+            return (True, None, manifest, rel)
+
+        if self.fresh and now - entry.get("checked", 0) < self.fresh:
+            return (False, None, manifest, rel)
+
+        if url.scheme == "ftp":
+            size, mdtm = ftp_stat(site)
+            if size == loc_l and mdtm and mdtm == entry.get("modified"):
+                manifest.touch(rel, now)
+                return (False, None, manifest, rel)
+            return (True, None, manifest, rel)
+
+        cond = {}
+        if entry.get("etag"):
+            cond["If-None-Match"] = entry["etag"]
+        if entry.get("modified"):
+            cond["If-Modified-Since"] = entry["modified"]
+        return (True, cond, manifest, rel)
+
+    def _recall(self, site, url, record, ofn):
+        # Place a file from the object store instead of fetching it, if the
+        # store has what this URL held and it still holds the same
+        known = self.store.lookup(site)
+        if not known:
+            return None
+        if record.exact:
+            same = record.size == known.size and (
+                record.mtime is None
+                or known.mtime is None
+                or record.mtime == known.mtime
+            )
+        elif url.scheme == "ftp":
+            size, mdtm = ftp_stat(site)
+            same = size == known.size and mdtm is not None and mdtm == known.modified
+        else:
+            resp = http_head(site)
+            con_l = resp.getheader("Content-Length")
+            etag = resp.getheader("ETag")
+            modified = resp.getheader("Last-Modified")
+            same = (con_l is None or int(con_l) == known.size) and bool(
+                (etag and etag == known.etag)
+                or (modified and modified == known.modified)
+            )
+        if same and self.store.materialize(known.digest, ofn):
+            self.log_q.debug(f"LinkFetcher(): {site} recalled from the store")
+            return known
+        return None
+
     def fetch(self, site):
         _fetch = True
         exists = False
         ofn = ""
+        self.digest = None
+        record = as_record(site)
+        site = record.url
         try:
             url = urlparse(site)
         except TypeError:
             self.log_q.error(f"Failed to parse {site}")
             return False
 
-        if self.chop_l:
-            tfn = url.hostname + url.path
-            ofn = f'./{"/".join(tfn.split("/")[self.chop_l:])}'
-        else:
-            ofn = url.hostname + url.path
+        ofn = output_path(url, self.chop_l)
 
-        if not os.path.exists(os.path.dirname(ofn)):
-            os.makedirs(os.path.dirname(ofn))
+        # other fetchers may be making the same directory
+        os.makedirs(os.path.dirname(ofn), exist_ok=True)
 
-        if os.path.isfile(ofn):
-            if url.scheme in ("http", "https"):
-                con_l = int(http_head(site).getheader("Content-Length"))
+        cond = None
+        if self.manifest:
+            try:
+                _fetch, cond, manifest, rel = self._revalidate(site, url, ofn)
+            except Exception as e:
+                self.log_q.critical(f"Error: {e}")
+                return False
+            exists = not _fetch
+        elif os.path.isfile(ofn):
+            # the listing usually settles it, without asking the server
+            current = is_current(record, ofn)
+            if current is None and url.scheme in ("http", "https"):
+                try:
+                    con_l = http_head(site).getheader("Content-Length")
+                except Exception as e:
+                    # fetching it again will say whether the server is there
+                    self.log_q.warning(f"LinkFetcher(): HEAD {site}: {e}")
+                    con_l = None
                 loc_l = int(os.stat(ofn).st_size)
-                if con_l == loc_l:
-                    _fetch = False
-                    exists = True
+                current = con_l is not None and int(con_l) == loc_l
+            if current:
+                _fetch = False
+                exists = True
+
+        if _fetch and self.store and not os.path.isfile(ofn):
+            try:
+                known = self._recall(site, url, record, ofn)
+            except Exception as e:
+                self.log_q.error(f"LinkFetcher(): {site}: {e}, fetching instead")
+                known = None
+            if known:
+                _fetch = False
+                exists = True
+                if self.manifest:
+                    manifest.set(
+                        rel,
+                        url=site,
+                        etag=known.etag,
+                        modified=known.modified,
+                        size=known.size,
+                        checked=time.time(),
+                    )
 
         if _fetch:
             try:
-                with open(ofn, "wb+") as fp:
-                    if url.scheme in ("http", "https"):
-                        fp.write(http_get(site))
-                    elif url.scheme == "ftp":
-                        ftp_get(site, fp)
+                meta = self._download(site, url, ofn, cond)
+                if meta is not None:
+                    self.digest = meta.get("digest")
+                    stamp_mtime(ofn, record.mtime, meta.get("modified"))
             except Exception as e:
                 self.log_q.critical(f"Error: {e}")
                 return False
+            if meta is not None and self.store:
+                try:
+                    self.store.add(
+                        ofn,
+                        meta["digest"],
+                        site,
+                        record.mtime,
+                        meta.get("etag"),
+                        meta.get("modified"),
+                    )
+                except Exception as e:
+                    # the file is fetched all the same, only not deduplicated
+                    self.log_q.error(f"LinkFetcher(): can't store {ofn}: {e}")
+            if meta is None and self.manifest:
+                manifest.touch(rel, time.time())
+                exists = True
+            elif self.manifest:
+                manifest.set(
+                    rel,
+                    url=site,
+                    etag=meta.get("etag"),
+                    modified=meta.get("modified"),
+                    size=os.stat(ofn).st_size,
+                    checked=time.time(),
+                )
         return (ofn, exists)
 
     def run(self):
         while True:
+            if self.retiring:
+                self.log_q.info("LinkFetcher() thread retired")
+                return
+
             try:
                 self.sig_q.get(False)
                 self.log_q.info("LinkFetcher() thread exit")
                 self.sig_q.task_done()
-                self.gui_q.put(True)
                 self.sig_q.put(True)
                 return
             except Empty:
@@ -77,9 +496,15 @@ class LinkFetcher(threading.Thread):
 
             st = time.time()
             try:
-                site = self.fetch_q.get(True, 15)
-                if type(site) is str:
-                    out, ex = self.fetch(site)
+                with span("wait", "queue", queue="fetch_q"):
+                    site = self.fetch_q.get(True, self.idle)
+                link = as_record(site)
+                with span("fetch", "fetch", url=link.url if link else None):
+                    res = self.fetch(site) if link else False
+                if res:
+                    out, ex = res
+                    if self.jobs:
+                        self.jobs.fetched(as_record(site).url)
                     # self.log_q.info(f"LinkFetcher().fetch(): Saved {out}")
                     sz = os.stat(out).st_size
                     tag = "(pre)" if ex else "(new)"
@@ -90,10 +515,15 @@ class LinkFetcher(threading.Thread):
                             "filename": f"{out} ({humanize_bytes(sz)}) {tag}",
                         }
                     )
+                    if self.verify_q and not ex:
+                        # last, the verifier may remove it
+                        self.verify_q.put(
+                            ("file", as_record(site).url, out, self.digest)
+                        )
+                self.processed += 1
                 self.fetch_q.task_done()
             except Empty:
-                if time.time() - st >= 15:
+                if time.time() - st >= self.idle:
                     self.log_q.info("No work left. LinkFetcher thread exiting.")
-                    self.gui_q.put(True)
                     return
                 st = time.time()
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 # Stdlib imports
-import re
 import time
+import codecs
 import threading
 from queue import Empty
 
@@ -11,11 +11,15 @@ from urllib.parse import urlparse
 from html.parser import HTMLParser
 
 # network clients
-from ftplib import FTP, error_reply
-from http.client import HTTPSConnection
+from ftplib import error_perm
 
 # Internal imports
 from megamaid.utils import *
+from megamaid.trace import span
+from megamaid.matcher import LinkMatcher
+from megamaid.listing import DETECT_BYTES, LinkRecord, as_record
+from megamaid.listing import detect_format, extract, parse_list, parse_mlsd
+from megamaid.verify import is_checksum_file
 
 
 class LinkParser(HTMLParser):
@@ -26,72 +30,260 @@ class LinkParser(HTMLParser):
     log_q = None
     gui_q = None
     recursive = False
+    site_seen = None
+    link_seen = None
+    guard = None
+    jobs = None
+
+    def reset(self):
+        HTMLParser.reset(self)
+        self.dirs = []
+        self.hrefs = []
+        # listing format, None until enough of the page arrived to tell
+        self.format = None
+        self._pending = bytearray()
+        # rows the fast path found, and the page it has read while there are
+        # none, for the HTML parser to take over if the format was misread
+        self.rows = 0
+        self._page = bytearray()
+        self._decoder = codecs.getincrementaldecoder("utf-8")("replace")
 
     def handle_starttag(self, tag, attrs):
         if tag == "a":
-            if attrs[0][1].endswith("/") and attrs[0][1] not in ("/", "../"):
-                if (
-                    self.recursive
-                    and not attrs[0][1].startswith("/")
-                    and not attrs[0][1].startswith("http")
-                    and not attrs[0][1].startswith("mailto")
-                    and not attrs[0][1].startswith("ftp")
-                ):
-                    s = normalize_url(f"{self.site}/{attrs[0][1]}")
-                    self.site_q.put(s)
+            href = dict(attrs).get("href")
+            if href:
+                self.route(href)
+
+    def route(self, href, size=None, mtime=None, exact=False):
+        # Send one listing entry to the site queue (directories) or link queue,
+        # files go as a LinkRecord with whatever the listing said about them
+        if href.startswith(("?", "#")) or href in ("/", "../"):
+            # column sorting, page anchors and the parent directory
+            return
+        self.hrefs.append(href)
+        if href.endswith("/"):
+            if (
+                self.recursive
+                and not href.startswith("/")
+                and not href.startswith("http")
+                and not href.startswith("mailto")
+                and not href.startswith("ftp")
+            ):
+                # queued in close(), once we know this isn't a symlink loop
+                self.dirs.append(normalize_url(f"{self.site}/{href}"))
+        else:
+            url = normalize_url(f"{self.site}/{href}")
+            if self.link_seen is not None and not self.link_seen.add(url):
+                return
+            if self.jobs:
+                self.jobs.link(url)
+            self.link_q.put(LinkRecord(url, size, mtime, exact))
+            self.log_q.debug(f"LinkParser().route(): {url}")
+            self.gui_q.put({"link": 1})
+
+    def parse(self, data):
+        # Feed part of a page, as it arrives. close() flushes the rest.
+        if self.format is None:
+            self._pending += data
+            if len(self._pending) < DETECT_BYTES:
+                return
+            self._detect()
+            data = bytes(self._pending)
+            self._pending = bytearray()
+        if self.format:
+            # known autoindex formats skip the HTML parser, a row at a time
+            cut = data.rfind(b"\n") + 1
+            if not cut:
+                self._pending += data
+                return
+            rows = bytes(self._pending) + data[:cut]
+            self._pending = bytearray(data[cut:])
+            self._extract(rows)
+        else:
+            self.feed(self._decoder.decode(data))
+
+    def _detect(self):
+        # Settle on a format from the start of the page
+        self.format = detect_format(self._pending) or ""
+        self.log_q.debug(f"LinkParser(): {self.site} is {self.format or 'html'}")
+
+    def _extract(self, rows):
+        entries = extract(rows, self.format)
+        if not self.rows:
+            if entries:
+                self._page = bytearray()
             else:
-                url = normalize_url(f"{self.site}/{attrs[0][1]}")
-                self.link_q.put(url)
-                self.log_q.debug(f"LinkParser().handle_starttag(): {url}")
-                self.gui_q.put({"link": 1})
+                self._page += rows
+        self.rows += len(entries)
+        for entry in entries:
+            self.route(entry.href, entry.size, entry.mtime, entry.exact)
+
+    def close(self):
+        if self.format is None:
+            self._detect()
+        if self.format:
+            self._extract(bytes(self._pending))
+            if not self.rows and b"<a href" in self._page.lower():
+                # looked like a known listing, but none of it read as one
+                self.log_q.info(
+                    f"LinkParser(): no {self.format} rows in {self.site}, "
+                    "using the HTML parser"
+                )
+                self.format = ""
+                self.feed(self._page.decode("utf-8", "replace"))
+            self._page = bytearray()
+        else:
+            self.feed(self._decoder.decode(bytes(self._pending), True))
+        self._pending = bytearray()
+        HTMLParser.close(self)
+        if self.guard and not self.guard.check(self.site, self.hrefs):
+            self.log_q.info(f"LinkParser(): {self.site} repeats a parent, skipping")
+            return
+        for s in self.dirs:
+            if self.site_seen is None or self.site_seen.add(s):
+                if self.jobs:
+                    self.jobs.site(s)
+                self.site_q.put(s)
 
 
 class FtpWalker:
 
-    def __init__(self, uri, link_q, log_q, gui_q):
+    def __init__(
+        self,
+        uri,
+        site_q,
+        link_q,
+        log_q,
+        gui_q,
+        recursive=False,
+        site_seen=None,
+        link_seen=None,
+        guard=None,
+        jobs=None,
+    ):
         self.uri = uri
+        self.site_q = site_q
+        self.link_q = link_q
         self.log_q = log_q
         self.gui_q = gui_q
-        self.link_q = link_q
+        self.recursive = recursive
+        self.site_seen = site_seen
+        self.link_seen = link_seen
+        self.guard = guard
+        self.jobs = jobs
 
     def walk(self):
+        # List one directory. Subdirectories go back on the site queue, so
+        # other scrubbers can walk them on control connections of their own.
         parsed = urlparse(self.uri)
-        ftp = FTP(parsed.netloc)
-        ftp.login()
-        ftp.cwd(parsed.path)
-        self._walk(ftp)
-        ftp.quit()
-
-    def _walk(self, ftp):
-        for item in ftp.nlst():
-            try:
-                ftp.cwd(item)
-                self._walk(ftp)
-            except error_reply:
+        base = f"ftp://{parsed.netloc}"
+        path = parsed.path.rstrip("/")
+        features = FTP_POOL.features(FTP_POOL.key(parsed))
+        entries = []
+        with ftp_open(self.uri) as ftp:
+            for entry in self._list(ftp, features, path):
+                if entry and entry.kind == "link":
+                    # a symlink could point at either, only the server knows
+                    try:
+                        ftp.cwd(f"{path}/{entry.name}")
+                        entry = entry._replace(kind="dir")
+                    except error_perm:
+                        entry = entry._replace(kind="file")
+                if entry:
+                    entries.append(entry)
+
+        dirs = []
+        hrefs = []
+        for entry in entries:
+            url = f"{base}{path}/{entry.name}"
+            if entry.kind == "dir":
+                hrefs.append(f"{entry.name}/")
+                dirs.append(f"{url}/")
                 continue
-            except Exception as e:
-                self.log_q.debug(
-                    f"FtpWalker().walk(): ftp://{ftp.host}{ftp.pwd()}/{item}"
-                )
-                self.link_q.put(f"ftp://{ftp.host}{ftp.pwd()}/{item}")
-                self.gui_q.put({"link": 1})
+            hrefs.append(entry.name)
+            if self.link_seen is not None and not self.link_seen.add(url):
                 continue
-            ftp.cwd("..")
+            self.log_q.debug(f"FtpWalker().walk(): {url}")
+            if self.jobs:
+                self.jobs.link(url)
+            # MLSD and LIST sizes are byte counts, never rounded
+            self.link_q.put(
+                LinkRecord(url, entry.size, entry.mtime, entry.size is not None)
+            )
+            self.gui_q.put({"link": 1})
+
+        if not self.recursive:
+            return
+        if self.guard and not self.guard.check(f"{base}{path}/", hrefs):
+            self.log_q.info(f"FtpWalker(): {self.uri} repeats a parent, skipping")
+            return
+        for s in dirs:
+            if self.site_seen is None or self.site_seen.add(s):
+                if self.jobs:
+                    self.jobs.site(s)
+                self.site_q.put(s)
+
+    def _list(self, ftp, features, path):
+        # One listing call per directory: MLSD where the server has it,
+        # LIST parsing otherwise
+        if features.get("mlsd", True):
+            try:
+                with span("mlsd", "net", url=self.uri):
+                    return [parse_mlsd(n, f) for n, f in ftp.mlsd(path or "/")]
+            except error_perm as e:
+                if not str(e).startswith("50"):
+                    raise
+                self.log_q.info(f"FtpWalker(): {ftp.host} has no MLSD, using LIST")
+                features["mlsd"] = False
+        lines = []
+        with span("list", "net", url=self.uri):
+            ftp.retrlines(f"LIST {path or '/'}", lines.append)
+        with span("parse", "parse", lines=len(lines)):
+            return [parse_list(line) for line in lines]
 
 
 class LinkFilter(threading.Thread):
 
-    def __init__(self, link_q, fetch_q, log_q, sig_q, gui_q, pattern=False):
+    def __init__(
+        self,
+        link_q,
+        fetch_q,
+        log_q,
+        sig_q,
+        gui_q,
+        pattern=False,
+        jobs=None,
+        verify_q=None,
+        mirrors=None,
+        idle=IDLE,
+    ):
         threading.Thread.__init__(self, daemon=True)
         self.link_q = link_q
         self.fetch_q = fetch_q
         self.log_q = log_q
         self.sig_q = sig_q
         self.gui_q = gui_q
-        self.pattern = pattern
+        if isinstance(pattern, LinkMatcher):
+            self.pattern = pattern
+        else:
+            self.pattern = LinkMatcher(pattern)
+        self.jobs = jobs
+        self.verify_q = verify_q
+        self.mirrors = mirrors
+        self.idle = idle
+        self.processed = 0
+        self.retiring = False
+
+    def retire(self):
+        # Exit once the current item is done (used by the Supervisor)
+        self.retiring = True
 
     def run(self):
         while True:
+            if self.retiring:
+                self.log_q.info("LinkFilter() thread retired")
+                return
+
             try:
                 sig = self.sig_q.get(False)
                 self.log_q.info("LinkFilter() thread exit")
@@ -103,30 +295,65 @@ class LinkFilter(threading.Thread):
 
             st = time.time()
             try:
-                link = self.link_q.get(True, 10)
-                shipit = False
-                if self.pattern:
-                    for patt in self.pattern:
-                        if re.compile(patt).match(link):
-                            shipit = True
-                elif not self.pattern:
-                    shipit = True
-
-                if shipit and type(link) == str:
-                    self.log_q.debug(f"LinkFilter().run()[1]: -> FETCH_Q {link}")
-                    self.fetch_q.put(link)
-                    self.gui_q.put({"match": 1})
-                self.link_q.task_done()
+                with span("wait", "queue", queue="link_q"):
+                    item = self.link_q.get(True, min(10, self.idle))
+                try:
+                    self.route(as_record(item))
+                except Exception as e:
+                    # one bad link costs itself, not the thread
+                    self.log_q.critical(f"Error: {item}: {e}")
+                finally:
+                    self.processed += 1
+                    self.link_q.task_done()
             except Empty:
-                if time.time() - st >= 15:
+                if time.time() - st >= self.idle:
                     self.log_q.info("No more work left. LinkFilter thread exiting.")
                     return
                 st = time.time()
 
+    def route(self, link):
+        # Send one link to the fetch queue if it matches, the size the listing
+        # gave goes along (the fetcher finds out the real one)
+        if link and self.mirrors:
+            # one fetch per file however many mirrors list it, under
+            # its URL on the group's first mirror
+            found, url = link.url, self.mirrors.canonical(link.url)
+            claimed = self.mirrors.claim(url)
+            if self.jobs and (url != found or not claimed):
+                self.jobs.skipped(found)
+            link = link._replace(url=url) if claimed else None
+        if link and self.verify_q and is_checksum_file(link.url):
+            # read whether or not it matches, to check what does
+            self.verify_q.put(("sums", link.url))
+        with span("match", "filter", url=link.url if link else None) as sp:
+            matched = bool(link and self.pattern.match(link.url))
+            sp.set(matched=matched)
+        if matched:
+            self.log_q.debug(f"LinkFilter().route(): -> FETCH_Q {link.url}")
+            if self.jobs:
+                self.jobs.matched(link.url)
+            self.fetch_q.put(link)
+            self.gui_q.put({"match": 1})
+        elif self.jobs and link:
+            self.jobs.skipped(link.url)
+
 
 class SiteScrubber(threading.Thread):
 
-    def __init__(self, site_q, link_q, log_q, sig_q, gui_q, recursive=False):
+    def __init__(
+        self,
+        site_q,
+        link_q,
+        log_q,
+        sig_q,
+        gui_q,
+        recursive=False,
+        site_seen=None,
+        link_seen=None,
+        guard=None,
+        jobs=None,
+        idle=IDLE,
+    ):
         threading.Thread.__init__(self, daemon=True)
         self.site_q = site_q
         self.link_q = link_q
@@ -134,9 +361,60 @@ class SiteScrubber(threading.Thread):
         self.sig_q = sig_q
         self.gui_q = gui_q
         self.recursive = recursive
+        self.site_seen = site_seen
+        self.link_seen = link_seen
+        self.guard = guard
+        self.jobs = jobs
+        self.idle = idle
+        self.processed = 0
+        self.retiring = False
+
+    def retire(self):
+        # Exit once the current item is done (used by the Supervisor)
+        self.retiring = True
+
+    def scrub(self, site):
+        # List one site, its links and subdirectories go to link_q and site_q
+        scheme = urlparse(site).scheme
+        if scheme in ("http", "https"):
+            parser = LinkParser()
+            parser.site = site
+            parser.site_q = self.site_q
+            parser.link_q = self.link_q
+            parser.log_q = self.log_q
+            parser.gui_q = self.gui_q
+            parser.recursive = self.recursive
+            parser.site_seen = self.site_seen
+            parser.link_seen = self.link_seen
+            parser.guard = self.guard
+            parser.jobs = self.jobs
+            # links go out as the listing streams in
+            with http_open(site) as resp:
+                for chunk in iter_response(resp, host=urlparse(site).hostname):
+                    with span("parse", "parse", bytes=len(chunk)):
+                        parser.parse(bytes(chunk))
+            with span("parse", "parse", close=True):
+                parser.close()
+        elif scheme == "ftp":
+            worker = FtpWalker(
+                site,
+                self.site_q,
+                self.link_q,
+                self.log_q,
+                self.gui_q,
+                self.recursive,
+                self.site_seen,
+                self.link_seen,
+                self.guard,
+                self.jobs,
+            )
+            worker.walk()
 
     def run(self):
         while True:
+            if self.retiring:
+                self.log_q.info("SiteScrubber() thread retired")
+                return
 
             try:
                 sig = self.sig_q.get(False)
@@ -150,23 +428,22 @@ class SiteScrubber(threading.Thread):
             st = time.time()
             try:
                 st = time.time()
-                site = self.site_q.get(True, 5)
-                scheme = urlparse(site).scheme
-                if scheme in ("http", "https"):
-                    parser = LinkParser()
-                    parser.site = site
-                    parser.site_q = self.site_q
-                    parser.link_q = self.link_q
-                    parser.log_q = self.log_q
-                    parser.gui_q = self.gui_q
-                    parser.recursive = self.recursive
-                    parser.feed(http_get(site).decode("utf-8"))
-                elif scheme == "ftp":
-                    worker = FtpWalker(site, self.link_q, self.log_q, self.gui_q)
-                    worker.walk()
-                self.site_q.task_done()
+                with span("wait", "queue", queue="site_q"):
+                    site = self.site_q.get(True, min(5, self.idle))
+                try:
+                    with span("scrub", "list", url=site):
+                        self.scrub(site)
+                    if self.jobs:
+                        self.jobs.site_done(site)
+                except Exception as e:
+                    # a refused or unreachable directory loses its own
+                    # listing, not the thread; a resumed job tries it again
+                    self.log_q.critical(f"Error: {site}: {e}")
+                finally:
+                    self.processed += 1
+                    self.site_q.task_done()
             except Empty:
-                if time.time() - st >= 15:
+                if time.time() - st >= self.idle:
                     self.log_q.info("No work left. SiteScrubber thread exiting.")
                     return
                 st = time.time()
@@ -0,0 +1,314 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Persistent crawl state for MegaMaid. Records the site frontier and every link
+as it moves through the pipeline in a SQLite database, so an interrupted run
+can be resumed without listing or checking anything twice.
+"""
+
+# Stdlib imports
+import sqlite3
+import threading
+
+from queue import Queue, Empty
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+# Site states
+QUEUED = 0
+DONE = 2
+
+# Link states, QUEUED links haven't been through the LinkFilter yet
+MATCHED = 1
+FETCHED = 2
+SKIPPED = 3
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS sites (url TEXT PRIMARY KEY, state INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS links (url TEXT PRIMARY KEY, state INTEGER NOT NULL)",
+)
+
+_ADD_SITE = "INSERT OR IGNORE INTO sites (url, state) VALUES (?, ?)"
+_SET_SITE = (
+    "INSERT INTO sites (url, state) VALUES (?, ?) "
+    "ON CONFLICT (url) DO UPDATE SET state = excluded.state"
+)
+_ADD_LINK = "INSERT OR IGNORE INTO links (url, state) VALUES (?, ?)"
+_SET_LINK = (
+    "INSERT INTO links (url, state) VALUES (?, ?) "
+    "ON CONFLICT (url) DO UPDATE SET state = excluded.state"
+)
+
+
+class JobStore:
+    """
+    SQLite job store. Updates are queued and written by a single background
+    thread in batched transactions, in the order they were made, so the
+    database never shows a site done without the links found on it.
+    """
+
+    def __init__(self, path, reset=False, batch=1000, interval=1.0, log_q=None):
+        """
+        Initialize the JobStore.
+
+        Args:
+            path (str): The database file.
+            reset (bool, optional): Forget any state already in the file.
+            Defaults to False.
+            batch (int, optional): Most updates per transaction. Defaults to
+            1000.
+            interval (float, optional): Most seconds an update waits before
+            being committed. Defaults to 1.0.
+            log_q (logging.Logger, optional): Where failed writes are logged.
+        """
+
+        self.path = path
+        self.batch = batch
+        self.interval = interval
+        self.log_q = log_q
+        self.writes = 0
+        self.commits = 0
+        self.lost = 0
+        self._ops = Queue()
+
+        db = self._connect()
+        with db:
+            for stmt in _SCHEMA:
+                db.execute(stmt)
+            if reset:
+                db.execute("DELETE FROM sites")
+                db.execute("DELETE FROM links")
+        db.close()
+
+        self._writer = threading.Thread(target=self._write, daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only risks the last commits on power loss
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _write(self):
+        db = self._connect()
+        while True:
+            try:
+                ops = [self._ops.get(True, self.interval)]
+            except Empty:
+                continue
+            while len(ops) < self.batch:
+                try:
+                    ops.append(self._ops.get(False))
+                except Empty:
+                    break
+
+            # consecutive updates of the same kind go in one executemany()
+            waiters = []
+            runs = []
+            for op in ops:
+                if op is None or isinstance(op, threading.Event):
+                    waiters.append(op)
+                elif runs and runs[-1][0] == op[0]:
+                    runs[-1][1].append(op[1])
+                else:
+                    runs.append((op[0], [op[1]]))
+            if runs:
+                try:
+                    with db:
+                        for sql, rows in runs:
+                            db.executemany(sql, rows)
+                    self.writes += len(ops) - len(waiters)
+                    self.commits += 1
+                except sqlite3.Error as e:
+                    # a locked or full database costs this batch, not the
+                    # writer; a resumed run redoes the work it recorded
+                    self.lost += len(ops) - len(waiters)
+                    if self.log_q:
+                        self.log_q.error(
+                            f"JobStore(): {self.path}: {e}, "
+                            f"{len(ops) - len(waiters)} updates lost"
+                        )
+
+            for w in waiters:
+                if w is None:
+                    db.close()
+                    return
+                w.set()
+
+    def site(self, url):
+        """
+        Record a site put on the frontier.
+
+        Args:
+            url (str): The listing URL.
+        """
+
+        self._ops.put((_ADD_SITE, (url, QUEUED)))
+
+    def site_done(self, url):
+        """
+        Record a site as listed, everything found on it has been recorded.
+
+        Args:
+            url (str): The listing URL.
+        """
+
+        self._ops.put((_SET_SITE, (url, DONE)))
+
+    def link(self, url):
+        """
+        Record a newly discovered link.
+
+        Args:
+            url (str): The link URL.
+        """
+
+        self._ops.put((_ADD_LINK, (url, QUEUED)))
+
+    def matched(self, url):
+        """
+        Record a link as accepted by the LinkFilter.
+
+        Args:
+            url (str): The link URL.
+        """
+
+        self._ops.put((_SET_LINK, (url, MATCHED)))
+
+    def skipped(self, url):
+        """
+        Record a link as rejected by the LinkFilter.
+
+        Args:
+            url (str): The link URL.
+        """
+
+        self._ops.put((_SET_LINK, (url, SKIPPED)))
+
+    def fetched(self, url):
+        """
+        Record a link as fetched, or found up to date on disk.
+
+        Args:
+            url (str): The link URL.
+        """
+
+        self._ops.put((_SET_LINK, (url, FETCHED)))
+
+    def flush(self):
+        """
+        Wait until every update made so far is committed.
+        """
+
+        done = threading.Event()
+        self._ops.put(done)
+        while not done.wait(1):
+            if not self._writer.is_alive():
+                raise RuntimeError(f"JobStore(): {self.path}: the writer died")
+
+    def pending(self):
+        """
+        Get the work an earlier run left unfinished.
+
+        Returns:
+            Edict: sites (not yet listed), links (not yet filtered) and
+            matched (not yet fetched), each a list of URLs.
+        """
+
+        self.flush()
+        db = self._connect()
+        try:
+            return Edict(
+                sites=self._urls(db, "sites", QUEUED),
+                links=self._urls(db, "links", QUEUED),
+                matched=self._urls(db, "links", MATCHED),
+            )
+        finally:
+            db.close()
+
+    def _urls(self, db, table, state):
+        rows = db.execute(f"SELECT url FROM {table} WHERE state = ?", (state,))
+        return [url for (url,) in rows]
+
+    def known(self, table):
+        """
+        Iterate over every URL recorded, whatever its state.
+
+        Args:
+            table (str): "sites" or "links".
+
+        Yields:
+            str: The URLs.
+        """
+
+        self.flush()
+        db = self._connect()
+        try:
+            for (url,) in db.execute(f"SELECT url FROM {table}"):
+                yield url
+        finally:
+            db.close()
+
+    def stats(self):
+        """
+        Get the job's progress and the writer's counters.
+
+        Returns:
+            Edict: sites and links, each a dict of URLs per state name, plus
+            writes (updates committed), commits (transactions) and lost
+            (updates whose transaction failed).
+        """
+
+        self.flush()
+        db = self._connect()
+        try:
+            names = {
+                "sites": {QUEUED: "queued", DONE: "done"},
+                "links": {
+                    QUEUED: "queued",
+                    MATCHED: "matched",
+                    FETCHED: "fetched",
+                    SKIPPED: "skipped",
+                },
+            }
+            retv = Edict(writes=self.writes, commits=self.commits, lost=self.lost)
+            for table, states in names.items():
+                counts = dict(
+                    db.execute(f"SELECT state, COUNT(*) FROM {table} GROUP BY state")
+                )
+                retv[table] = Edict(
+                    **{name: counts.get(st, 0) for st, name in states.items()}
+                )
+            return retv
+        finally:
+            db.close()
+
+    def close(self):
+        """
+        Commit outstanding updates and stop the writer.
+        """
+
+        if self._writer.is_alive():
+            self._ops.put(None)
+            self._writer.join()
@@ -0,0 +1,369 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Directory listing parsers for MegaMaid. Recognizes the autoindex pages served
+by Apache, nginx and lighttpd and pulls the entries straight out of the raw
+bytes, along with each entry's size and modification time. Also reads FTP
+MLSD facts and LIST lines, in the Unix and DOS styles.
+"""
+
+# Stdlib imports
+import os
+import re
+import html
+import time
+import calendar
+
+from collections import namedtuple
+from email.utils import parsedate_to_datetime
+
+
+# One directory entry. `size` is in bytes, or None when the listing doesn't
+# say; `exact` is False when the listing only gave a rounded size like "1.2G".
+# `mtime` is epoch seconds, read as UTC since listings don't carry a zone.
+ListEntry = namedtuple("ListEntry", "href size mtime exact")
+
+# A link on its way through the queues, with whatever the listing said about
+# it. Fields are as for ListEntry; a bare URL string is accepted everywhere a
+# LinkRecord is, see as_record().
+LinkRecord = namedtuple("LinkRecord", "url size mtime exact")
+
+# One FTP directory entry. `kind` is "file", "dir" or "link" (a symlink,
+# which could be either), `size` in bytes and `mtime` in epoch seconds, None
+# when the server didn't say.
+FtpEntry = namedtuple("FtpEntry", "name kind size mtime")
+
+# Listings give times in the server's own zone, which we can't know
+MTIME_SLACK = 86400
+
+# Listings round times to the minute
+MTIME_ROUNDING = 60
+
+# Only this much of a page is looked at to tell which server made it
+DETECT_BYTES = 4096
+
+_MONTHS = {
+    m.encode().lower(): n
+    for n, m in enumerate(
+        ("jan", "feb", "mar", "apr", "may", "jun")
+        + ("jul", "aug", "sep", "oct", "nov", "dec"),
+        1,
+    )
+}
+
+_UNITS = {b"K": 1024, b"M": 1024**2, b"G": 1024**3, b"T": 1024**4, b"P": 1024**5}
+
+_SPLIT = re.compile(rb"[^0-9A-Za-z]+")
+
+# Apache mod_autoindex with HTMLTable (the 2.4 default)
+_APACHE_TABLE = re.compile(
+    rb'<td><a href="([^"]*)">.*?</a>\s*</td>\s*<td align="right">([^<]*)</td>'
+    rb'\s*<td align="right">([^<]*)</td>'
+)
+
+# Apache FancyIndexing without tables, and nginx autoindex
+_PRE = re.compile(
+    rb'<a href="([^"]*)">[^<]*</a>[ \t]+'
+    rb"(\d\d-[A-Za-z]{3}-\d{4} \d\d:\d\d(?::\d\d)?|\d{4}-\d\d-\d\d \d\d:\d\d(?::\d\d)?)"
+    rb"[ \t]+([-0-9.]+[KMGTP]?)"
+)
+
+# lighttpd mod_dirlisting
+_LIGHTTPD = re.compile(
+    rb'<td class="n"><a href="([^"]*)">.*?</td>\s*<td class="m">([^<]*)</td>'
+    rb'\s*<td class="s">([^<]*)</td>'
+)
+
+# `ls -l` style LIST output, the group column is missing on some servers
+_LIST_UNIX = re.compile(
+    r"^([-dl])\S{9}\S*\s+\d+\s+(?:\S+\s+){1,2}?(\d+)\s+"
+    r"([A-Za-z]{3})\s+(\d{1,2})\s+(\d{1,2}:\d\d|\d{4})\s(.*)$"
+)
+
+# IIS and other DOS style LIST output
+_LIST_DOS = re.compile(
+    r"^(\d\d)-(\d\d)-(\d\d(?:\d\d)?)\s+(\d\d):(\d\d)\s*([AP]M)?\s+"
+    r"(<DIR>|\d+)\s+(.*)$"
+)
+
+FORMATS = {
+    "apache-table": _APACHE_TABLE,
+    "pre": _PRE,
+    "lighttpd": _LIGHTTPD,
+}
+
+
+def detect_format(data):
+    """
+    Guess which server generated a listing page.
+
+    Args:
+        data (bytes): The start of the page (DETECT_BYTES is enough).
+
+    Returns:
+        str: "apache-table", "pre" (Apache FancyIndexing or nginx) or
+        "lighttpd", or None if the page isn't a known autoindex format.
+    """
+
+    head = data[:DETECT_BYTES]
+    if b'<td class="n">' in head or (b"lighttpd" in head and b'class="list"' in head):
+        return "lighttpd"
+    if b"?C=N;O=" in head:
+        if b"<table" in head:
+            return "apache-table"
+        if b"<pre" in head:
+            return "pre"
+    if b"<h1>Index of" in head and b"<pre><a href=" in head:
+        # nginx
+        return "pre"
+    return None
+
+
+def parse_size(raw):
+    """
+    Parse a listing's size column.
+
+    Args:
+        raw (bytes): The column, like b"123456", b"1.2G" or b"-".
+
+    Returns:
+        tuple: (size, exact), size is None for directories and blanks.
+    """
+
+    raw = raw.replace(b"&nbsp;", b"").strip()
+    if not raw or raw == b"-":
+        return (None, False)
+    if raw.isdigit():
+        return (int(raw), True)
+    unit = _UNITS.get(raw[-1:].upper())
+    try:
+        if unit:
+            return (int(float(raw[:-1]) * unit), False)
+        return (int(float(raw)), False)
+    except ValueError:
+        return (None, False)
+
+
+def parse_mtime(raw):
+    """
+    Parse a listing's date column, in any of the formats Apache, nginx and
+    lighttpd use (2024-01-31 12:00, 31-Jan-2024 12:00, 2024-Jan-31 12:00:00).
+
+    Args:
+        raw (bytes): The column.
+
+    Returns:
+        int: Epoch seconds, or None if the date can't be read.
+    """
+
+    parts = _SPLIT.split(raw.strip())
+    if len(parts) < 5:
+        return None
+    try:
+        if len(parts[0]) == 4:
+            year, month, day = parts[0], parts[1], parts[2]
+        else:
+            day, month, year = parts[0], parts[1], parts[2]
+        month = int(month) if month.isdigit() else _MONTHS[month.lower()]
+        sec = int(parts[5]) if len(parts) > 5 else 0
+        return calendar.timegm(
+            (int(year), month, int(day), int(parts[3]), int(parts[4]), sec)
+        )
+    except (KeyError, ValueError):
+        return None
+
+
+def _href(raw):
+    href = raw.decode("utf-8", "replace")
+    if "&" in href:
+        href = html.unescape(href)
+    return href
+
+
+def extract(data, fmt):
+    """
+    Pull every entry out of an autoindex page.
+
+    Args:
+        data (bytes): The page, or any run of complete rows from it.
+        fmt (str): The format, as returned by detect_format().
+
+    Returns:
+        list: ListEntry tuples, in page order. Empty if nothing in `data`
+        reads as `fmt`, in which case the HTML parser is the fallback.
+    """
+
+    retv = []
+    for href, mtime, size in FORMATS[fmt].findall(data):
+        size, exact = parse_size(size)
+        retv.append(ListEntry(_href(href), size, parse_mtime(mtime), exact))
+    return retv
+
+
+def as_record(item):
+    """
+    Turn a queue item into a LinkRecord.
+
+    Args:
+        item (LinkRecord or str): The item, a URL string carries no metadata.
+
+    Returns:
+        LinkRecord: The record, or None if `item` isn't a link.
+    """
+
+    if type(item) is LinkRecord:
+        return item
+    if type(item) is str:
+        return LinkRecord(item, None, None, False)
+    return None
+
+
+def is_current(record, path):
+    """
+    Decide from listing metadata alone whether a local copy is up to date.
+    Fetched files are stamped with the listing's time for them, so the zone
+    it is in doesn't matter, only its rounding.
+
+    Args:
+        record (LinkRecord): The link.
+        path (str): The local copy, which must exist.
+
+    Returns:
+        bool: True if it is, False if it is stale, or None if the listing
+        didn't give an exact size and the server has to be asked.
+    """
+
+    if record.size is None or not record.exact:
+        return None
+    st = os.stat(path)
+    if st.st_size != record.size:
+        return False
+    # modified again since the time our copy was stamped with
+    if record.mtime is not None and record.mtime > st.st_mtime + MTIME_ROUNDING:
+        return False
+    return True
+
+
+def parse_mlsd(name, facts):
+    """
+    Read one entry of an FTP MLSD listing.
+
+    Args:
+        name (str): The entry name.
+        facts (dict): Its facts, as yielded by ftplib.FTP.mlsd().
+
+    Returns:
+        FtpEntry: The entry, or None for the directory itself and its parent.
+    """
+
+    kind = facts.get("type", "").lower()
+    if kind in ("cdir", "pdir") or name in (".", ".."):
+        return None
+    if kind not in ("dir", "file"):
+        # OS.unix=symlink, OS.unix=slink:/target and anything else unusual
+        kind = "link"
+
+    size = facts.get("size") or facts.get("sizd")
+    mtime = parse_modified(facts.get("modify", ""))
+    return FtpEntry(name, kind, int(size) if size and size.isdigit() else None, mtime)
+
+
+def parse_modified(raw):
+    """
+    Parse a modification time a server gave for one file: an HTTP
+    Last-Modified date, or an FTP MDTM or MLSD modify stamp.
+
+    Args:
+        raw (str): The time.
+
+    Returns:
+        int: Epoch seconds, or None if the time can't be read.
+    """
+
+    if not raw:
+        return None
+    if len(raw) >= 14 and raw[:14].isdigit():
+        # always UTC, fractions of a second are allowed
+        return calendar.timegm(
+            (
+                int(raw[:4]),
+                int(raw[4:6]),
+                int(raw[6:8]),
+                int(raw[8:10]),
+                int(raw[10:12]),
+                int(raw[12:14]),
+            )
+        )
+    try:
+        return int(parsedate_to_datetime(raw).timestamp())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_list(line, now=None):
+    """
+    Read one line of an FTP LIST listing, for servers without MLSD.
+
+    Args:
+        line (str): The line.
+        now (float, optional): Epoch seconds, for placing the dates of recent
+        files that `ls -l` gives without a year. Defaults to time.time().
+
+    Returns:
+        FtpEntry: The entry, or None for "total" lines, the directory itself,
+        its parent and anything that can't be read.
+    """
+
+    m = _LIST_UNIX.match(line)
+    if m:
+        kind, size, month, day, clock, name = m.groups()
+        kind = {"-": "file", "d": "dir", "l": "link"}[kind]
+        if kind == "link":
+            name = name.split(" -> ", 1)[0]
+        try:
+            month = _MONTHS[month.encode().lower()]
+        except KeyError:
+            return None
+        if ":" in clock:
+            hour, minute = (int(x) for x in clock.split(":"))
+            now = time.time() if now is None else now
+            year = time.gmtime(now).tm_year
+            mtime = calendar.timegm((year, month, int(day), hour, minute, 0))
+            if mtime > now + MTIME_SLACK:
+                # no year means the last six months, so this was last year
+                mtime = calendar.timegm((year - 1, month, int(day), hour, minute, 0))
+        else:
+            mtime = calendar.timegm((int(clock), month, int(day), 0, 0, 0))
+    else:
+        m = _LIST_DOS.match(line)
+        if not m:
+            return None
+        month, day, year, hour, minute, ampm, size, name = m.groups()
+        year = int(year)
+        if year < 100:
+            year += 2000 if year < 70 else 1900
+        hour = int(hour) % 12 + (12 if ampm == "PM" else 0) if ampm else int(hour)
+        mtime = calendar.timegm((year, int(month), int(day), hour, int(minute), 0))
+        kind = "dir" if size == "<DIR>" else "file"
+
+    if name in (".", ".."):
+        return None
+    return FtpEntry(name, kind, int(size) if kind == "file" else None, mtime)
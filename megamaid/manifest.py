@@ -0,0 +1,166 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Revalidation manifests for MegaMaid. Each mirror root gets a sidecar file
+recording the URL, ETag, Last-Modified and size of every file fetched into it,
+so re-runs can revalidate with conditional requests instead of HEAD checks.
+"""
+
+# Stdlib imports
+import os
+import json
+import time
+import threading
+
+
+class Manifest:
+    """
+    Append-only, JSON lines manifest for one mirror root. Updates are written
+    as they happen and replayed (last entry wins) when the manifest is loaded.
+    """
+
+    FILE_NAME = ".megamaid-manifest"
+
+    # Flush the journal after this many seconds of buffered updates
+    FLUSH_EVERY = 5.0
+
+    _open = {}
+    _open_lock = threading.Lock()
+
+    def __init__(self, root):
+        """
+        Initialize the Manifest, loading any existing journal.
+
+        Args:
+            root (str): The mirror root directory.
+        """
+
+        self.root = root
+        self.path = os.path.join(root, self.FILE_NAME)
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._lines = 0
+        self._stamp = time.monotonic()
+
+        if os.path.isfile(self.path):
+            with open(self.path) as fp:
+                for line in fp:
+                    try:
+                        entry = json.loads(line)
+                        self._entries[entry.pop("path")] = entry
+                        self._lines += 1
+                    except (ValueError, KeyError):
+                        # a torn write at the end of the journal
+                        continue
+        # compact heavily rewritten journals before appending to them
+        if self._lines > 2 * len(self._entries) + 1024:
+            self._compact()
+        os.makedirs(root, exist_ok=True)
+        self._fp = open(self.path, "a")
+
+    @classmethod
+    def open(cls, root):
+        """
+        Get the shared Manifest for a mirror root, loading it on first use.
+
+        Args:
+            root (str): The mirror root directory.
+
+        Returns:
+            Manifest: The manifest for `root`.
+        """
+
+        with cls._open_lock:
+            if root not in cls._open:
+                cls._open[root] = cls(root)
+            return cls._open[root]
+
+    @classmethod
+    def close_all(cls):
+        """
+        Flush and close every open manifest.
+        """
+
+        with cls._open_lock:
+            for manifest in cls._open.values():
+                manifest.close()
+            cls._open = {}
+
+    def get(self, path):
+        """
+        Get the entry recorded for a file.
+
+        Args:
+            path (str): File path relative to the mirror root.
+
+        Returns:
+            dict: The entry, or None if the file is not in the manifest.
+        """
+
+        with self._lock:
+            return self._entries.get(path)
+
+    def set(self, path, **entry):
+        """
+        Record a file's validators.
+
+        Args:
+            path (str): File path relative to the mirror root.
+            entry: url, etag, modified, size and checked (epoch seconds).
+        """
+
+        with self._lock:
+            self._entries[path] = entry
+            self._fp.write(json.dumps(dict(path=path, **entry)) + "\n")
+            self._lines += 1
+            now = time.monotonic()
+            if now - self._stamp >= self.FLUSH_EVERY:
+                self._fp.flush()
+                self._stamp = now
+
+    def touch(self, path, checked):
+        """
+        Update the time a file was last confirmed fresh.
+
+        Args:
+            path (str): File path relative to the mirror root.
+            checked (float): Epoch seconds of the check.
+        """
+
+        entry = self.get(path)
+        if entry:
+            self.set(path, **dict(entry, checked=checked))
+
+    def _compact(self):
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as fp:
+            for path, entry in self._entries.items():
+                fp.write(json.dumps(dict(path=path, **entry)) + "\n")
+        os.replace(tmp, self.path)
+        self._lines = len(self._entries)
+
+    def close(self):
+        """
+        Flush the journal and close it.
+        """
+
+        with self._lock:
+            self._fp.close()
@@ -0,0 +1,238 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Link matching for MegaMaid. Compiles the `-p` and `-x` patterns once, into a
+literal suffix index, suffix guarded regular expressions and a single combined
+regular expression for everything else.
+"""
+
+# Stdlib imports
+import re
+
+
+# Characters that make a pattern something other than a literal string
+_META = set(".^$*+?{}[]|()")
+
+
+def _tokens(s):
+    """
+    Split a regex fragment into characters, literal ones as themselves and
+    anything with a special meaning as None.
+
+    Args:
+        s (str): The fragment.
+
+    Returns:
+        list: One entry per (possibly escaped) character.
+    """
+
+    retv = []
+    chars = iter(s)
+    for c in chars:
+        if c == "\\":
+            c = next(chars, None)
+            # \d, \w, backreferences and friends aren't literals
+            retv.append(None if c is None or c.isalnum() else c)
+        elif c in _META:
+            retv.append(None)
+        else:
+            retv.append(c)
+    return retv
+
+
+def _literal(s):
+    """
+    Unescape a regex fragment that is a plain string.
+
+    Args:
+        s (str): The fragment.
+
+    Returns:
+        str: The literal it matches, or None if it is not a literal.
+    """
+
+    tokens = _tokens(s)
+    if None in tokens:
+        return None
+    return "".join(tokens)
+
+
+def suffixes(pattern):
+    """
+    Work out how a link must end for a pattern to match it, for patterns
+    anchored with `$` like `.*\\.iso$` or `^.*install[0-9]+\\.(iso|img)$`.
+
+    Args:
+        pattern (str): The regular expression.
+
+    Returns:
+        tuple: (suffixes, exact) where suffixes is a tuple of strings one of
+        which every matching link ends with (or None if there is no such
+        tuple), and exact is True when ending with one of them is also enough
+        to match.
+    """
+
+    # inline flags like (?i) change what the literals match
+    if re.search(r"\(\?[^:]", pattern):
+        return (None, False)
+    body = pattern[1:] if pattern.startswith("^") else pattern
+    if not body.endswith("$") or body.endswith("\\$"):
+        return (None, False)
+    body = body[:-1]
+
+    # a top level `|` means the `$` only anchors the last alternative
+    depth = 0
+    klass = False
+    chars = iter(body)
+    for c in chars:
+        if c == "\\":
+            next(chars, None)
+        elif klass:
+            klass = c != "]"
+        elif c == "[":
+            klass = True
+        elif c == "(":
+            depth += 1
+        elif c == ")":
+            depth -= 1
+        elif c == "|" and depth == 0:
+            return (None, False)
+
+    # a trailing group of plain alternatives: prefix(alt|alt|...)
+    alts = [""]
+    if body.endswith(")") and not body.endswith("\\)"):
+        start = body.rfind("(")
+        if start == -1 or (start and body[start - 1] == "\\"):
+            return (None, False)
+        group = body[start + 1 : -1]
+        if group.startswith("?:"):
+            group = group[2:]
+        alts = [_literal(a) for a in group.split("|")]
+        body = body[:start]
+        if None in alts:
+            return (None, False)
+
+    exact = body.startswith(".*") and _literal(body[2:]) is not None
+    if exact:
+        tail = _literal(body[2:])
+    else:
+        tokens = _tokens(body)
+        run = []
+        for tok in reversed(tokens):
+            if tok is None:
+                break
+            run.append(tok)
+        tail = "".join(reversed(run))
+
+    retv = tuple(tail + a for a in alts)
+    # `.*` can't match a newline, so neither may the suffix
+    if not all(retv) or any("\n" in s for s in retv):
+        return (None, False)
+    return (retv, exact)
+
+
+class LinkMatcher:
+    """
+    Decides which links get fetched. Links must match (re.match semantics) at
+    least one include pattern, or any link if there are none, and no exclude
+    pattern.
+    """
+
+    def __init__(self, patterns=False, excludes=False):
+        """
+        Initialize the LinkMatcher.
+
+        Args:
+            patterns (list, optional): Include patterns. Defaults to none,
+            which accepts every link.
+            excludes (list, optional): Exclude patterns.
+        """
+
+        self.patterns = list(patterns or [])
+        self.excludes = list(excludes or [])
+        self._include = self._build(self.patterns)
+        self._exclude = self._build(self.excludes)
+
+    def _build(self, patterns):
+        # Sort patterns into a suffix index, suffix guarded regexes and the rest
+        ends = []
+        guarded = {}
+        rest = []
+        for patt in patterns:
+            sfx, exact = suffixes(patt)
+            if sfx and exact:
+                ends.extend(sfx)
+            elif sfx:
+                guarded.setdefault(sfx, []).append(patt)
+            else:
+                rest.append(patt)
+
+        return (
+            tuple(ends),
+            [(sfx, self._compile(patts)) for sfx, patts in guarded.items()],
+            self._compile(rest),
+        )
+
+    def _compile(self, patterns):
+        # One alternation for all of `patterns` when that is safe to build
+        if not patterns:
+            return []
+        try:
+            combined = "|".join(f"(?:{p})" for p in patterns)
+            # numbered backreferences would point at the wrong group
+            if len(patterns) > 1 and re.search(r"\\[1-9]|\(\?P=", combined):
+                raise re.error("backreferences")
+            return [re.compile(combined)]
+        except re.error:
+            return [re.compile(p) for p in patterns]
+
+    def _any(self, table, link):
+        ends, guarded, compiled = table
+        if ends and link.endswith(ends):
+            return True
+        for sfx, regexes in guarded:
+            if link.endswith(sfx):
+                for regex in regexes:
+                    if regex.match(link):
+                        return True
+        for regex in compiled:
+            if regex.match(link):
+                return True
+        return False
+
+    def match(self, link):
+        """
+        Test a link.
+
+        Args:
+            link (str): The link URL.
+
+        Returns:
+            bool: True if the link should be fetched.
+        """
+
+        if self.patterns and not self._any(self._include, link):
+            return False
+        if self.excludes and self._any(self._exclude, link):
+            return False
+        return True
+
+    __call__ = match
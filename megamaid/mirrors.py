@@ -0,0 +1,257 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Mirror groups for MegaMaid. Base URLs declared equivalent are one file set:
+each file is fetched once, into the tree of the group's first mirror, from
+whichever mirror is measuring fastest, and moves to the next mirror part way
+through if that one fails.
+"""
+
+# Stdlib imports
+import time
+import threading
+
+from urllib.parse import urlparse
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+# Weight of the newest transfer in a mirror's speed and error averages
+ALPHA = 0.3
+
+# Longest a failing mirror is passed over, in seconds
+MAX_BACKOFF = 300.0
+
+
+def parse_group(bases):
+    """
+    Normalize the base URLs of a mirror group.
+
+    Args:
+        bases (list): The base URLs, the first is where files are saved.
+
+    Returns:
+        tuple: The base URLs, each ending in "/".
+    """
+
+    retv = []
+    for base in bases:
+        if urlparse(base).scheme not in ("http", "https", "ftp"):
+            raise ValueError(f"{base}: not an http, https or ftp URL")
+        retv.append(base if base.endswith("/") else f"{base}/")
+    if len(retv) < 2:
+        raise ValueError("a mirror group needs at least two base URLs")
+    return tuple(retv)
+
+
+class Mirrors:
+    """
+    The mirror groups of a run, and what each mirror's transfers measured:
+    an exponentially weighted average of throughput and of the error rate.
+    A mirror ranks by speed times success rate; one never tried ranks first,
+    so each gets measured, and one that keeps failing sits out a while.
+    """
+
+    def __init__(self, groups=None, alpha=ALPHA):
+        """
+        Initialize the Mirrors.
+
+        Args:
+            groups (list, optional): Lists of equivalent base URLs.
+            alpha (float, optional): Weight of the newest transfer in the
+            averages. Defaults to ALPHA.
+        """
+
+        self.alpha = alpha
+        self.groups = []
+        self._lock = threading.Lock()
+        self._mirrors = {}
+        self._claimed = set()
+        for bases in groups or []:
+            self.add(bases)
+
+    def add(self, bases):
+        """
+        Declare a mirror group.
+
+        Args:
+            bases (list): The base URLs, the first is where files are saved.
+        """
+
+        group = parse_group(bases)
+        with self._lock:
+            self.groups.append(group)
+            for base in group:
+                self._mirrors.setdefault(
+                    base,
+                    Edict(
+                        speed=None,
+                        errors=0.0,
+                        streak=0,
+                        down=0.0,
+                        ok=0,
+                        failed=0,
+                        bytes=0,
+                    ),
+                )
+
+    def _find(self, url):
+        for group in self.groups:
+            for base in group:
+                if url.startswith(base):
+                    return (group, url[len(base) :])
+        return (None, None)
+
+    def canonical(self, url):
+        """
+        Map a URL on any mirror to the group's first mirror.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            str: The URL on the first mirror, or `url` if no group has it.
+        """
+
+        group, rel = self._find(url)
+        return url if group is None else f"{group[0]}{rel}"
+
+    def claim(self, url):
+        """
+        Take a file for fetching, so finding it on another mirror of the
+        group doesn't fetch it again.
+
+        Args:
+            url (str): The URL, on any mirror.
+
+        Returns:
+            bool: False if the file was already claimed.
+        """
+
+        url = self.canonical(url)
+        with self._lock:
+            if url in self._claimed:
+                return False
+            self._claimed.add(url)
+            return True
+
+    def _score(self, base, now):
+        st = self._mirrors[base]
+        if st.down > now:
+            return -1.0
+        if st.speed is None:
+            return float("inf")
+        return st.speed * (1.0 - st.errors)
+
+    def candidates(self, url, schemes=None):
+        """
+        List where a file can be fetched from, best first.
+
+        Args:
+            url (str): The URL, on any mirror.
+            schemes (tuple, optional): Only mirrors with these URL schemes.
+
+        Returns:
+            list: (base, URL) tuples, just (None, `url`) if no group has it.
+        """
+
+        group, rel = self._find(url)
+        if group is None:
+            return [(None, url)]
+        now = time.monotonic()
+        with self._lock:
+            bases = [
+                b for b in group if not schemes or urlparse(b).scheme in schemes
+            ]
+            bases.sort(key=lambda b: self._score(b, now), reverse=True)
+        return [(b, f"{b}{rel}") for b in bases]
+
+    def record(self, base, nbytes, secs):
+        """
+        Note a transfer that completed.
+
+        Args:
+            base (str): The mirror.
+            nbytes (int): Bytes it sent.
+            secs (float): How long that took.
+        """
+
+        if base is None:
+            return
+        with self._lock:
+            st = self._mirrors[base]
+            self._sample(st, nbytes, secs)
+            st.errors *= 1.0 - self.alpha
+            st.streak = 0
+            st.ok += 1
+
+    def failed(self, base, nbytes=0, secs=0.0):
+        """
+        Note a transfer that failed, the mirror sits out 2**N seconds after
+        N failures in a row (up to MAX_BACKOFF).
+
+        Args:
+            base (str): The mirror.
+            nbytes (int, optional): Bytes it sent before failing.
+            secs (float, optional): How long that took.
+        """
+
+        if base is None:
+            return
+        with self._lock:
+            st = self._mirrors[base]
+            self._sample(st, nbytes, secs)
+            st.errors = st.errors * (1.0 - self.alpha) + self.alpha
+            st.streak += 1
+            st.failed += 1
+            st.down = time.monotonic() + min(2.0**st.streak, MAX_BACKOFF)
+
+    def _sample(self, st, nbytes, secs):
+        st.bytes += nbytes
+        if nbytes and secs > 0:
+            rate = nbytes / secs
+            if st.speed is None:
+                st.speed = rate
+            else:
+                st.speed += self.alpha * (rate - st.speed)
+
+    def stats(self):
+        """
+        Get each mirror's measurements.
+
+        Returns:
+            dict: Base URL to Edicts of speed (bytes/sec average, None if
+            never measured), errors (average error rate), ok and failed
+            transfers and bytes fetched.
+        """
+
+        with self._lock:
+            return {
+                base: Edict(
+                    speed=st.speed,
+                    errors=st.errors,
+                    ok=st.ok,
+                    failed=st.failed,
+                    bytes=st.bytes,
+                )
+                for base, st in self._mirrors.items()
+            }
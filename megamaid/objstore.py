@@ -0,0 +1,393 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Content addressed storage for MegaMaid. Every file fetched is stored once
+under its SHA-256 digest and appears in the mirror trees as a hardlink or
+reflink to that copy, and an index of what each URL held lets a repeat
+download be served from the store instead of the network.
+"""
+
+# Stdlib imports
+import os
+import errno
+import shutil
+import sqlite3
+import hashlib
+import threading
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+LINK_MODES = ("hardlink", "reflink")
+
+# Linux ioctl that makes `dst` share `src`'s extents (btrfs, XFS, ...)
+_FICLONE = 0x40049409
+
+# Errors meaning the filesystem can't link, so a copy has to do
+_NO_LINK = (
+    errno.EXDEV,
+    errno.EMLINK,
+    errno.EPERM,
+    errno.EOPNOTSUPP,
+    errno.EINVAL,
+    errno.ENOTTY,
+)
+
+_SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS objects "
+    "(digest TEXT PRIMARY KEY, size INTEGER NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS urls (url TEXT PRIMARY KEY, digest TEXT NOT NULL, "
+    "size INTEGER NOT NULL, mtime INTEGER, etag TEXT, modified TEXT)",
+)
+
+_ADD_OBJECT = "INSERT OR IGNORE INTO objects (digest, size) VALUES (?, ?)"
+_SET_URL = (
+    "INSERT INTO urls (url, digest, size, mtime, etag, modified) "
+    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (url) DO UPDATE SET "
+    "digest = excluded.digest, size = excluded.size, mtime = excluded.mtime, "
+    "etag = excluded.etag, modified = excluded.modified"
+)
+
+
+def hash_file(path, bufsize=1024 * 1024):
+    """
+    Hash a file already on disk.
+
+    Args:
+        path (str): The file.
+        bufsize (int, optional): Read size.
+
+    Returns:
+        str: The hex SHA-256 digest.
+    """
+
+    digest = hashlib.sha256()
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    with open(path, "rb", buffering=0) as fp:
+        while True:
+            n = fp.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+
+class HashingWriter:
+    """
+    Wraps a download's output file, hashing the bytes as they are written.
+    Seeking to resume part way in hashes what is already on disk first; if
+    the file was also written some other way (segmented downloads write at
+    offsets), digest() notices and hashes it from disk instead.
+    """
+
+    def __init__(self, fp):
+        """
+        Initialize the HashingWriter.
+
+        Args:
+            fp (file): The output file, opened for appending.
+        """
+
+        self.fp = fp
+        self._hash = hashlib.sha256()
+        self._count = 0
+
+    def __getattr__(self, name):
+        return getattr(self.fp, name)
+
+    def write(self, data):
+        n = self.fp.write(data)
+        self._hash.update(data)
+        self._count += len(data)
+        return n
+
+    def seek(self, pos, whence=os.SEEK_SET):
+        retv = self.fp.seek(pos, whence)
+        # only rewinds before a (re)start of the transfer are expected
+        self._hash = hashlib.sha256()
+        self._count = 0
+        if retv:
+            self.fp.flush()
+            with open(self.fp.name, "rb") as src:
+                while self._count < retv:
+                    data = src.read(min(1024 * 1024, retv - self._count))
+                    if not data:
+                        break
+                    self._hash.update(data)
+                    self._count += len(data)
+        return retv
+
+    def digest(self, fallback=True):
+        """
+        Get the digest of the file as it now stands.
+
+        Args:
+            fallback (bool, optional): Hash the file from disk if the bytes
+            written don't cover it. Defaults to True.
+
+        Returns:
+            str: The hex SHA-256 digest, or None without `fallback` when the
+            bytes written don't cover the file.
+        """
+
+        self.fp.flush()
+        if os.path.getsize(self.fp.name) != self._count:
+            return hash_file(self.fp.name) if fallback else None
+        return self._hash.hexdigest()
+
+
+class ObjectStore:
+    """
+    Directory of files named by digest, with a SQLite index of the objects
+    and of which URL held what, behind validators (size, listing mtime,
+    ETag, Last-Modified or MDTM) that tell whether it still does.
+    """
+
+    def __init__(self, root, link="hardlink", log_q=None):
+        """
+        Initialize the ObjectStore.
+
+        Args:
+            root (str): The store directory, created if need be.
+            link (str, optional): How objects appear in mirror trees,
+            "hardlink" or "reflink". Either falls back to a plain copy where
+            the filesystem can't. Defaults to "hardlink".
+            log_q (logging.Logger, optional): The logger.
+        """
+
+        if link not in LINK_MODES:
+            raise ValueError(f"unknown link mode {link}")
+        self.root = root
+        self.link = link
+        self.log_q = log_q
+        self._lock = threading.Lock()
+        self._warned = False
+        self._stats = Edict(stored=0, deduped=0, recalled=0, copied=0, saved=0)
+
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(root, "index.db"), check_same_thread=False
+        )
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        with self._db:
+            for stmt in _SCHEMA:
+                self._db.execute(stmt)
+
+    def path(self, digest):
+        """
+        Get where an object lives.
+
+        Args:
+            digest (str): The hex SHA-256 digest.
+
+        Returns:
+            str: The object's path.
+        """
+
+        return os.path.join(self.root, "objects", digest[:2], digest)
+
+    def lookup(self, url):
+        """
+        Find what the store last got from a URL.
+
+        Args:
+            url (str): The URL.
+
+        Returns:
+            Edict: digest, size, mtime, etag and modified, or None if the URL
+            was never stored.
+        """
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT digest, size, mtime, etag, modified FROM urls WHERE url = ?",
+                (url,),
+            ).fetchone()
+        if row is None:
+            return None
+        keys = ("digest", "size", "mtime", "etag", "modified")
+        return Edict(**dict(zip(keys, row)))
+
+    def add(self, path, digest, url, mtime=None, etag=None, modified=None):
+        """
+        Store a freshly fetched file. New content is adopted into the store
+        where it lies; content already stored replaces the file with a link
+        to the stored copy.
+
+        Args:
+            path (str): The file, in its mirror tree.
+            digest (str): Its hex SHA-256 digest.
+            url (str): Where it came from.
+            mtime (int, optional): Its mtime according to the listing.
+            etag (str, optional): Its ETag.
+            modified (str, optional): Its Last-Modified date or MDTM.
+
+        Returns:
+            bool: True if the content was already in the store.
+        """
+
+        size = os.path.getsize(path)
+        obj = self.path(digest)
+        known = os.path.isfile(obj)
+        if not known:
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            try:
+                self._link(path, obj)
+            except FileExistsError:
+                # another fetcher stored the same content first
+                known = True
+        if known:
+            self._place(obj, path)
+        with self._lock:
+            with self._db:
+                self._db.execute(_ADD_OBJECT, (digest, size))
+                self._db.execute(_SET_URL, (url, digest, size, mtime, etag, modified))
+            if known:
+                self._stats.deduped += 1
+                self._stats.saved += size
+            else:
+                self._stats.stored += 1
+        return known
+
+    def forget(self, url):
+        """
+        Drop what the store knows a URL held, so the next fetch of it goes to
+        the network. The object stays, other URLs may still hold it.
+
+        Args:
+            url (str): The URL.
+        """
+
+        with self._lock:
+            with self._db:
+                self._db.execute("DELETE FROM urls WHERE url = ?", (url,))
+
+    def materialize(self, digest, path):
+        """
+        Put a stored object at a path in a mirror tree, without fetching it.
+
+        Args:
+            digest (str): The hex SHA-256 digest.
+            path (str): Where it goes.
+
+        Returns:
+            bool: False if the object is no longer in the store.
+        """
+
+        obj = self.path(digest)
+        if not os.path.isfile(obj):
+            return False
+        self._place(obj, path)
+        with self._lock:
+            self._stats.recalled += 1
+            self._stats.saved += os.path.getsize(obj)
+        return True
+
+    def _place(self, obj, path):
+        # Link the object in next to `path`, then swap it in atomically
+        tmp = f"{path}.link"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        self._link(obj, tmp)
+        os.replace(tmp, path)
+
+    def _link(self, src, dst):
+        # Hard link `src` to `dst`, or reflink or copy it under a temporary
+        # name and move that into place, so `dst` is never half written.
+        # FileExistsError if `dst` is there already.
+        if self.link == "hardlink":
+            try:
+                os.link(src, dst)
+                return
+            except OSError as e:
+                if e.errno not in _NO_LINK:
+                    raise
+                self._fallback(src, dst, e)
+        tmp = f"{dst}.{threading.get_ident()}.tmp"
+        try:
+            self._clone(src, tmp)
+            try:
+                os.link(tmp, dst)
+            except FileExistsError:
+                raise
+            except OSError:
+                # no hard links here, settle for replacing
+                os.replace(tmp, dst)
+        finally:
+            if os.path.lexists(tmp):
+                os.unlink(tmp)
+
+    def _clone(self, src, dst):
+        # Reflink `src` to a new `dst` where that's asked for and works, copy
+        # it otherwise
+        if self.link == "reflink":
+            try:
+                import fcntl
+
+                with open(src, "rb") as s, open(dst, "wb") as d:
+                    fcntl.ioctl(d.fileno(), _FICLONE, s.fileno())
+                return
+            except (ImportError, OSError) as e:
+                if isinstance(e, OSError) and e.errno not in _NO_LINK:
+                    raise
+                self._fallback(src, dst, e)
+        shutil.copyfile(src, dst)
+        with self._lock:
+            self._stats.copied += 1
+
+    def _fallback(self, src, dst, e):
+        if self.log_q and not self._warned:
+            self._warned = True
+            self.log_q.warning(
+                f"ObjectStore(): can't {self.link} {src} to {dst} ({e}), "
+                "copying instead"
+            )
+
+    def stats(self):
+        """
+        Get the store's size and what it saved this run.
+
+        Returns:
+            Edict: objects and bytes in the store, urls indexed, plus this
+            run's stored (new objects), deduped (fetched content already
+            stored), recalled (files placed without fetching), copied (links
+            that fell back to copies) and saved (bytes not stored twice or
+            not fetched) counters.
+        """
+
+        with self._lock:
+            retv = Edict(**self._stats)
+            retv.objects, retv.bytes = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM objects"
+            ).fetchone()
+            (retv.urls,) = self._db.execute("SELECT COUNT(*) FROM urls").fetchone()
+        return retv
+
+    def close(self):
+        """
+        Close the index.
+        """
+
+        with self._lock:
+            self._db.close()
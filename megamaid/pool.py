@@ -0,0 +1,476 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Connection pooling for MegaMaid. Keeps HTTP/1.1 connections alive between
+requests so that DNS, TCP, TLS and proxy CONNECT setup is paid once per host
+instead of once per file, and does the same for logged in FTP control
+connections.
+"""
+
+# Stdlib imports
+import time
+import threading
+
+from ftplib import FTP, all_errors
+from http.client import HTTPConnection, HTTPSConnection
+
+# Internal imports
+from megamaid.edict import Edict
+from megamaid.trace import span
+
+
+class _Connection(HTTPConnection):
+    # Traced connect, the span covers the DNS lookup and TCP handshake (and a
+    # proxy CONNECT)
+
+    def connect(self):
+        with span("connect", "net", host=self.host, port=self.port):
+            super().connect()
+
+
+class _SecureConnection(HTTPSConnection, _Connection):
+    # The tls span holds the connect span, the rest of it is the handshake
+
+    def connect(self):
+        with span("tls", "net", host=self.host, port=self.port):
+            super().connect()
+
+
+class ConnectionPool:
+    """
+    Thread safe pool of idle keep-alive connections, keyed by
+    (scheme, host, port, proxy). Only idle connections are capped, there is
+    no limit on those open per key: a segmented download holds its first
+    connection while it opens the others, so a limit could leave it waiting
+    on itself. Open connections are bounded by the fetcher threads and the
+    segments each may use instead.
+    """
+
+    def __init__(self, maxsize=8, idle=10.0, timeout=None):
+        """
+        Initialize the ConnectionPool.
+
+        Args:
+            maxsize (int, optional): Idle connections kept per key. Defaults
+            to 8.
+            idle (float, optional): Seconds an idle connection may sit in the
+            pool before it is evicted. Defaults to 10.0. Stale connections
+            are also swept out of the pool this often, as others come back.
+            timeout (float, optional): Socket timeout for new connections.
+            Defaults to None (blocking).
+        """
+
+        self.maxsize = maxsize
+        self.idle = idle
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._pool = {}
+        self._swept = time.monotonic()
+        self._stats = Edict(new=0, reused=0, retried=0, evicted=0, discarded=0)
+
+    def key(self, url, proxy=None):
+        """
+        Build the pool key for a parsed URL.
+
+        Args:
+            url (urllib.parse.ParseResult): The target URL.
+            proxy (urllib.parse.ParseResult, optional): The proxy URL.
+
+        Returns:
+            tuple: (scheme, host, port, proxy netloc)
+        """
+
+        port = url.port or (443 if url.scheme == "https" else 80)
+        return (url.scheme, url.hostname, port, proxy.netloc if proxy else None)
+
+    def connect(self, key, proxy=None):
+        """
+        Open a new connection for a pool key.
+
+        Args:
+            key (tuple): A key as returned by key().
+            proxy (urllib.parse.ParseResult, optional): The proxy URL.
+
+        Returns:
+            http.client.HTTPConnection: The (not yet connected) connection.
+        """
+
+        scheme, host, port, _ = key
+        kwargs = {}
+        if self.timeout is not None:
+            kwargs["timeout"] = self.timeout
+        if proxy:
+            if scheme == "https":
+                conn = _SecureConnection(proxy.hostname, proxy.port, **kwargs)
+                conn.set_tunnel(host, port)
+            else:
+                conn = _Connection(proxy.hostname, proxy.port, **kwargs)
+        elif scheme == "https":
+            conn = _SecureConnection(host, port, **kwargs)
+        else:
+            conn = _Connection(host, port, **kwargs)
+        with self._lock:
+            self._stats.new += 1
+        return conn
+
+    def acquire(self, key, proxy=None):
+        """
+        Take an idle connection for `key` out of the pool, or open a new one.
+
+        Args:
+            key (tuple): A key as returned by key().
+            proxy (urllib.parse.ParseResult, optional): The proxy URL.
+
+        Returns:
+            tuple: (connection, reused) where reused is True if the connection
+            came out of the pool.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            idle = self._pool.get(key, [])
+            while idle:
+                conn, stamp = idle.pop()
+                if now - stamp <= self.idle:
+                    self._stats.reused += 1
+                    return (conn, True)
+                self._stats.evicted += 1
+                conn.close()
+        return (self.connect(key, proxy), False)
+
+    def release(self, key, conn):
+        """
+        Hand a connection back to the pool once its response has been read.
+
+        Args:
+            key (tuple): The key the connection was acquired with.
+            conn (http.client.HTTPConnection): The connection.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            idle = self._pool.setdefault(key, [])
+            keep = len(idle) < self.maxsize
+            if keep:
+                idle.append((conn, now))
+            else:
+                self._stats.discarded += 1
+            # connections to hosts nobody asks for any more only go this way
+            sweep = now - self._swept >= self.idle
+            if sweep:
+                self._swept = now
+        if not keep:
+            conn.close()
+        if sweep:
+            self.evict()
+
+    def discard(self, conn):
+        """
+        Close a connection that can not be reused.
+
+        Args:
+            conn (http.client.HTTPConnection): The connection.
+        """
+
+        with self._lock:
+            self._stats.discarded += 1
+        conn.close()
+
+    def mark_retry(self):
+        """
+        Count a request that was retried after a stale pooled connection.
+        """
+
+        with self._lock:
+            self._stats.retried += 1
+
+    def evict(self):
+        """
+        Close every idle connection that has outlived the idle timeout.
+
+        Returns:
+            int: The number of connections evicted.
+        """
+
+        now = time.monotonic()
+        stale = []
+        with self._lock:
+            for key, idle in list(self._pool.items()):
+                keep = [(c, s) for c, s in idle if now - s <= self.idle]
+                stale.extend(c for c, s in idle if now - s > self.idle)
+                if keep:
+                    self._pool[key] = keep
+                else:
+                    del self._pool[key]
+            self._stats.evicted += len(stale)
+        for conn in stale:
+            conn.close()
+        return len(stale)
+
+    def stats(self):
+        """
+        Get the pool counters.
+
+        Returns:
+            Edict: new, reused, retried, evicted, discarded and idle counts.
+        """
+
+        with self._lock:
+            retv = Edict(**self._stats)
+            retv.idle = sum(len(v) for v in self._pool.values())
+        return retv
+
+    def close(self):
+        """
+        Close every idle connection in the pool.
+        """
+
+        with self._lock:
+            pools = list(self._pool.values())
+            self._pool = {}
+        for idle in pools:
+            for conn, _ in idle:
+                conn.close()
+
+
+class FtpPool:
+    """
+    Thread safe pool of idle, logged in FTP control connections, keyed by
+    (host, port, user), with a cap on the connections open per key. Also
+    remembers what each server turned out to support, so the question is
+    only asked once.
+    """
+
+    def __init__(self, maxsize=4, idle=60.0, probe=5.0, timeout=60.0, limit=0):
+        """
+        Initialize the FtpPool.
+
+        Args:
+            maxsize (int, optional): Idle connections kept per key. Defaults
+            to 4.
+            idle (float, optional): Seconds an idle connection may sit in the
+            pool before it is evicted. Defaults to 60.0.
+            probe (float, optional): Connections idle for longer than this
+            are checked with a NOOP before being handed out, since FTP
+            servers drop idle sessions without telling. Defaults to 5.0.
+            timeout (float, optional): Socket timeout. Defaults to 60.0.
+            limit (int, optional): Most connections open per key, idle or in
+            use, callers wait for one to come free. Defaults to 0 (no limit).
+        """
+
+        self.maxsize = maxsize
+        self.idle = idle
+        self.probe = probe
+        self.timeout = timeout
+        self.limit = limit
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._pool = {}
+        self._open = {}
+        self._owner = {}
+        self._features = {}
+        self._stats = Edict(new=0, reused=0, evicted=0, discarded=0, waited=0)
+
+    def key(self, url):
+        """
+        Build the pool key for a parsed URL.
+
+        Args:
+            url (urllib.parse.ParseResult): The target URL.
+
+        Returns:
+            tuple: (host, port, user)
+        """
+
+        return (url.hostname, url.port or 21, url.username or "anonymous")
+
+    def connect(self, key, password=None):
+        """
+        Open and log in a new connection for a pool key.
+
+        Args:
+            key (tuple): A key as returned by key().
+            password (str, optional): The password, anonymous logins don't
+            need one.
+
+        Returns:
+            ftplib.FTP: The connection.
+        """
+
+        host, port, user = key
+        ftp = FTP(timeout=self.timeout)
+        try:
+            with span("connect", "net", host=host, port=port):
+                ftp.connect(host, port)
+            with span("login", "net", host=host, user=user):
+                ftp.login(user, password or "")
+        except BaseException:
+            ftp.close()
+            raise
+        with self._lock:
+            self._stats.new += 1
+        return ftp
+
+    def acquire(self, key, password=None):
+        """
+        Take an idle connection for `key` out of the pool, or open a new one,
+        waiting first if the key is at its limit.
+
+        Args:
+            key (tuple): A key as returned by key().
+            password (str, optional): The password, for a new connection.
+
+        Returns:
+            tuple: (connection, reused) where reused is True if the connection
+            came out of the pool.
+        """
+
+        waited = False
+        while True:
+            now = time.monotonic()
+            with self._cond:
+                idle = self._pool.get(key)
+                if not idle:
+                    if self.limit and self._open.get(key, 0) >= self.limit:
+                        if not waited:
+                            waited = True
+                            self._stats.waited += 1
+                        self._cond.wait()
+                        continue
+                    # hold the slot while we log in
+                    self._open[key] = self._open.get(key, 0) + 1
+                    break
+                ftp, stamp = idle.pop()
+                if now - stamp > self.idle:
+                    self._stats.evicted += 1
+                    self._forget(ftp)
+                    ftp.close()
+                    continue
+            if now - stamp > self.probe:
+                try:
+                    ftp.voidcmd("NOOP")
+                except all_errors:
+                    self.discard(ftp)
+                    continue
+            with self._lock:
+                self._stats.reused += 1
+            return (ftp, True)
+
+        try:
+            ftp = self.connect(key, password)
+        except BaseException:
+            with self._cond:
+                self._open[key] -= 1
+                self._cond.notify()
+            raise
+        with self._lock:
+            self._owner[ftp] = key
+        return (ftp, False)
+
+    def release(self, key, ftp):
+        """
+        Hand a connection back to the pool, with no transfer in progress.
+
+        Args:
+            key (tuple): The key the connection was acquired with.
+            ftp (ftplib.FTP): The connection.
+        """
+
+        with self._cond:
+            idle = self._pool.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((ftp, time.monotonic()))
+                self._cond.notify()
+                return
+            self._stats.discarded += 1
+            self._forget(ftp)
+        self._quit(ftp)
+
+    def discard(self, ftp):
+        """
+        Close a connection that can not be reused.
+
+        Args:
+            ftp (ftplib.FTP): The connection.
+        """
+
+        with self._cond:
+            self._stats.discarded += 1
+            self._forget(ftp)
+        ftp.close()
+
+    def _forget(self, ftp):
+        # Give up a connection's slot, with the lock held
+        key = self._owner.pop(ftp, None)
+        if key is not None:
+            self._open[key] -= 1
+            self._cond.notify()
+
+    def features(self, key):
+        """
+        Get what is known about the server behind a pool key.
+
+        Args:
+            key (tuple): A key as returned by key().
+
+        Returns:
+            dict: Feature names to True or False, shared by every user of the
+            key. Features not yet tried are missing.
+        """
+
+        with self._lock:
+            return self._features.setdefault(key[:2], {})
+
+    def _quit(self, ftp):
+        try:
+            ftp.quit()
+        except all_errors:
+            ftp.close()
+
+    def stats(self):
+        """
+        Get the pool counters.
+
+        Returns:
+            Edict: new, reused, evicted, discarded, waited (acquires that had
+            to wait for the limit), open and idle counts.
+        """
+
+        with self._lock:
+            retv = Edict(**self._stats)
+            retv.open = sum(self._open.values())
+            retv.idle = sum(len(v) for v in self._pool.values())
+        return retv
+
+    def close(self):
+        """
+        Log out and close every idle connection in the pool.
+        """
+
+        with self._cond:
+            pools = list(self._pool.values())
+            self._pool = {}
+            for idle in pools:
+                for ftp, _ in idle:
+                    self._forget(ftp)
+        for idle in pools:
+            for ftp, _ in idle:
+                self._quit(ftp)
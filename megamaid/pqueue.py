@@ -0,0 +1,179 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Fetch ordering for MegaMaid. A drop-in replacement for the FIFO fetch queue
+that hands out links by size, pattern weight or both, while aging keeps
+anything from waiting forever.
+"""
+
+# Stdlib imports
+import re
+import math
+import time
+import heapq
+import itertools
+
+from queue import Queue
+
+# Internal imports
+from megamaid.listing import as_record
+
+
+POLICIES = ("fifo", "smallest", "largest")
+
+# Size assumed for links whose size couldn't be found out
+UNKNOWN_SIZE = 1024 * 1024
+
+
+def parse_weight(raw):
+    """
+    Parse a pattern weight like ".*SHA256$=10".
+
+    Args:
+        raw (str): The pattern and weight, higher weights go first.
+
+    Returns:
+        tuple: (pattern, weight)
+    """
+
+    patt, _, weight = raw.rpartition("=")
+    if not patt:
+        raise ValueError(f"{raw}: expected RE=WEIGHT")
+    return (patt, float(weight))
+
+
+class FetchPriority:
+    """
+    Ranks links for fetching. A link's rank is log2 of its size (smallest),
+    64 minus that (largest) or 0 (fifo), less the weight of the first pattern
+    it matches; lower ranks go first.
+
+    With aging, links enqueued `aging` seconds apart are one rank apart, so a
+    link waits at most `aging` seconds for each rank it is behind newer links.
+    """
+
+    def __init__(self, policy="fifo", weights=None, aging=60.0):
+        """
+        Initialize the FetchPriority.
+
+        Args:
+            policy (str, optional): "fifo", "smallest" or "largest". Defaults
+            to "fifo".
+            weights (list, optional): (pattern, weight) tuples.
+            aging (float, optional): Seconds of waiting worth one rank, 0 to
+            order on rank alone. Defaults to 60.0.
+        """
+
+        if policy not in POLICIES:
+            raise ValueError(f"unknown priority policy {policy}")
+        self.policy = policy
+        self.weights = [(re.compile(p), w) for p, w in weights or []]
+        self.aging = aging
+        self.needs_size = policy != "fifo"
+
+    def rank(self, url, size=None):
+        """
+        Rank a link.
+
+        Args:
+            url (str): The link URL.
+            size (int, optional): Its size in bytes, if known.
+
+        Returns:
+            float: The rank, lower goes first.
+        """
+
+        retv = 0.0
+        if self.needs_size:
+            bits = math.log2((UNKNOWN_SIZE if size is None else size) + 1)
+            retv = bits if self.policy == "smallest" else 64 - bits
+        for regex, weight in self.weights:
+            if regex.match(url):
+                retv -= weight
+                break
+        return retv
+
+    def key(self, url, size=None):
+        """
+        Build the sort key for a link enqueued now.
+
+        Args:
+            url (str): The link URL.
+            size (int, optional): Its size in bytes, if known.
+
+        Returns:
+            float: The key, lower goes first.
+        """
+
+        if self.aging:
+            return time.monotonic() / self.aging + self.rank(url, size)
+        return self.rank(url, size)
+
+
+class PriorityFetchQueue(Queue):
+    """
+    queue.Queue ordered by a FetchPriority, ties and the fifo policy are
+    served in arrival order.
+    """
+
+    def __init__(self, priority=None, maxsize=0):
+        """
+        Initialize the PriorityFetchQueue.
+
+        Args:
+            priority (FetchPriority, optional): The ordering. Defaults to
+            fifo.
+            maxsize (int, optional): Most queued links, 0 for no limit.
+        """
+
+        self.priority = priority or FetchPriority()
+        self._seq = itertools.count()
+        Queue.__init__(self, maxsize)
+
+    @property
+    def needs_size(self):
+        return self.priority.needs_size
+
+    def put(self, item, block=True, timeout=None):
+        """
+        Queue a link.
+
+        Args:
+            item (LinkRecord or str): The link, its size is used when known.
+            block (bool, optional): As for queue.Queue.put().
+            timeout (float, optional): As for queue.Queue.put().
+        """
+
+        record = as_record(item)
+        key = self.priority.key(record.url, record.size) if record else float("-inf")
+        Queue.put(self, (key, next(self._seq), item), block, timeout)
+
+    def _init(self, maxsize):
+        self.queue = []
+
+    def _qsize(self):
+        return len(self.queue)
+
+    def _put(self, entry):
+        heapq.heappush(self.queue, entry)
+
+    def _get(self):
+        return heapq.heappop(self.queue)[2]
@@ -0,0 +1,255 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Segmented downloads for MegaMaid. Splits a large file into byte ranges that
+are fetched over parallel connections, straight into their place in the
+output file.
+"""
+
+# Stdlib imports
+import os
+import time
+import threading
+
+from urllib.parse import urlparse
+
+# Internal imports
+from megamaid.trace import span
+from megamaid.utils import BUFSIZE, THROTTLE, http_open
+
+
+# Smallest range worth its own connection, by default
+SEGMENT_SIZE = 8 * 1024 * 1024
+
+# Seconds between checkpoints of segment progress
+CHECKPOINT_EVERY = 2.0
+
+
+class SegmentError(IOError):
+    """
+    The server stopped honouring ranges for the file, or the file changed
+    underneath us. What was fetched so far can't be trusted.
+    """
+
+
+def plan(size, segments, minimum=SEGMENT_SIZE):
+    """
+    Split a file into byte ranges.
+
+    Args:
+        size (int): The file size.
+        segments (int): Most ranges to make.
+        minimum (int, optional): Smallest range. Defaults to SEGMENT_SIZE.
+
+    Returns:
+        list: [start, end, position] lists, end exclusive, position is where
+        the next byte of the range goes (start, for a new download).
+    """
+
+    count = max(1, min(segments, size // max(1, minimum)))
+    step = -(-size // count)
+    return [[start, min(start + step, size), start] for start in range(0, size, step)]
+
+
+def completed(segments):
+    """
+    Count the bytes of a segmented download already in place.
+
+    Args:
+        segments (list): Ranges as returned by plan().
+
+    Returns:
+        int: Bytes fetched, over all ranges.
+    """
+
+    return sum(pos - start for start, end, pos in segments)
+
+
+def preallocate(fd, size):
+    """
+    Reserve the space for a file, so positional writes don't fragment it.
+
+    Args:
+        fd (int): The open file.
+        size (int): The final size.
+    """
+
+    try:
+        os.posix_fallocate(fd, 0, size)
+    except (AttributeError, OSError):
+        # not every platform or filesystem can, a sparse file will do
+        os.ftruncate(fd, size)
+
+
+class SegmentedDownload:
+    """
+    Fetches the ranges of one file on a thread each. A range that fails is
+    retried from where it stopped without disturbing the others.
+    """
+
+    def __init__(
+        self,
+        site,
+        path,
+        size,
+        validator,
+        segments,
+        bufsize=BUFSIZE,
+        progress=None,
+        checkpoint=None,
+        retries=3,
+        log_q=None,
+    ):
+        """
+        Initialize the SegmentedDownload.
+
+        Args:
+            site (str): The URL.
+            path (str): The output file.
+            size (int): The file size.
+            validator (str): Strong ETag or Last-Modified date, sent with
+            If-Range so a changed file isn't stitched together.
+            segments (list): Ranges as returned by plan(), updated in place.
+            bufsize (int, optional): Read buffer size per range.
+            progress (callable, optional): Called with (bytes, size).
+            checkpoint (callable, optional): Called with `segments` every
+            CHECKPOINT_EVERY seconds, so progress can be saved for resuming.
+            retries (int, optional): Attempts per range after the first.
+            Defaults to 3.
+            log_q (logging.Logger, optional): The logger.
+        """
+
+        self.site = site
+        self.path = path
+        self.size = size
+        self.validator = validator
+        self.segments = segments
+        self.bufsize = bufsize
+        self.progress = progress
+        self.checkpoint = checkpoint
+        self.retries = retries
+        self.log_q = log_q
+        self.host = urlparse(site).hostname
+        self._lock = threading.Lock()
+        self._abort = threading.Event()
+        self._stamp = time.monotonic()
+        self._fd = None
+        self._errors = []
+
+    def run(self, resp=None):
+        """
+        Fetch every unfinished range.
+
+        Args:
+            resp (http.client.HTTPResponse, optional): A response already
+            streaming the file from byte 0, used for the first range instead
+            of a new request.
+
+        Raises:
+            SegmentError: The file changed or ranges stopped working.
+            IOError: A range still failed after its retries.
+        """
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(self._fd).st_size != self.size:
+                preallocate(self._fd, self.size)
+            threads = []
+            todo = [seg for seg in self.segments if seg[2] < seg[1]]
+            first = todo.pop(0) if resp is not None and todo else None
+            for seg in todo:
+                threads.append(threading.Thread(target=self._worker, args=(seg,)))
+                threads[-1].start()
+            if first:
+                self._worker(first, resp)
+            for t in threads:
+                t.join()
+        finally:
+            os.close(self._fd)
+        if self.checkpoint:
+            self.checkpoint(self.segments)
+        if self._errors:
+            segerr = [e for e in self._errors if isinstance(e, SegmentError)]
+            raise (segerr or self._errors)[0]
+
+    def _worker(self, seg, resp=None):
+        tries = 0
+        while seg[2] < seg[1] and not self._abort.is_set():
+            try:
+                if resp is not None:
+                    body, resp = resp, None
+                    self._copy(body, seg)
+                    continue
+                headers = {"Range": f"bytes={seg[2]}-{seg[1] - 1}"}
+                if self.validator:
+                    headers["If-Range"] = self.validator
+                with http_open(self.site, headers=headers) as body:
+                    self._check(body, seg)
+                    self._copy(body, seg)
+            except SegmentError as e:
+                self._fail(e)
+                return
+            except Exception as e:
+                tries += 1
+                if tries > self.retries:
+                    self._fail(e)
+                    return
+                if self.log_q:
+                    self.log_q.warning(
+                        f"SegmentedDownload(): {self.site} from byte {seg[2]}: "
+                        f"{e}, retry {tries}/{self.retries}"
+                    )
+                self._abort.wait(min(2**tries, 30))
+
+    def _fail(self, e):
+        with self._lock:
+            self._errors.append(e)
+        self._abort.set()
+
+    def _check(self, resp, seg):
+        if resp.status == 200:
+            raise SegmentError(f"{self.site}: server sent the whole file, not a range")
+        if resp.status != 206:
+            raise IOError(f"{self.site}: HTTP {resp.status} {resp.reason}")
+        crange = resp.getheader("Content-Range", "")
+        if not crange.startswith(f"bytes {seg[2]}-"):
+            raise SegmentError(f"{self.site}: asked for byte {seg[2]}, got {crange}")
+
+    def _copy(self, resp, seg):
+        buf = bytearray(self.bufsize)
+        view = memoryview(buf)
+        while seg[2] < seg[1]:
+            if self._abort.is_set():
+                return
+            n = resp.readinto(view[: min(self.bufsize, seg[1] - seg[2])])
+            if not n:
+                raise ConnectionResetError("connection closed mid-range")
+            with span("write", "disk", bytes=n, offset=seg[2]):
+                os.pwrite(self._fd, view[:n], seg[2])
+            THROTTLE.consume(self.host, n)
+            with self._lock:
+                seg[2] += n
+                if self.progress:
+                    self.progress(n, self.size)
+                now = time.monotonic()
+                if self.checkpoint and now - self._stamp >= CHECKPOINT_EVERY:
+                    self._stamp = now
+                    self.checkpoint(self.segments)
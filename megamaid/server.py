@@ -21,6 +21,12 @@
 """
 Socket Servers for MegaMaid. TCP and UNIX domain sockets are supported, but it
 can be extended to support UDP sockets as well.
+
+The protocol is newline framed JSON. A line holding an object is a request,
+{"command": ..., ...}, and a line holding an array of them is a batch, run in
+order and answered with an array of replies in one line. A request carrying
+an "id" gets it back in its reply, and any number of requests may be sent
+before reading the replies, which come back in the order the requests did.
 """
 
 
@@ -28,52 +34,192 @@ can be extended to support UDP sockets as well.
 import os
 import json
 import socket
-import select
 import logging
+import selectors
 
 # Internal imports
 from megamaid.utils import log_setup
 
 
+# Bytes asked of a client socket per read
+RECV_SIZE = 256 * 1024
+
+# Longest request line taken, a client sending more is dropped
+MAX_LINE = 16 * 1024 * 1024
+
+# Unsent reply bytes at which a client isn't read until it catches up
+MAX_PENDING = 4 * 1024 * 1024
+
+
+class _Client:
+    __slots__ = ("sock", "addr", "rbuf", "wbuf", "events")
+
+    def __init__(self, sock, addr):
+        self.sock = sock
+        self.addr = addr
+        self.rbuf = bytearray()
+        self.wbuf = bytearray()
+        self.events = selectors.EVENT_READ
+
+
 class MaidServer:
     """
     Base server class to handle Unix domain socket connections and data xfer.
+    Clients are served from one thread, with non-blocking sockets: requests
+    are split out of whatever each read brings, and replies are queued per
+    client and written as the socket takes them.
     """
 
-    def _handler(self, conn):
+    def _call(self, conn, req):
+        """
+        Run one request.
+
+        Args:
+            conn (socket.socket): The client connection socket.
+            req (dict): The request.
+
+        Returns:
+            The handler's reply (a dict), None if it had none.
+        """
+
+        if not isinstance(req, dict):
+            return {"error": "bad request: not an object"}
+        cback = self._cbmap.get(req.get("command"))
+        if cback is None:
+            retv = {"error": f"unknown command: {req.get('command')}"}
+        else:
+            try:
+                retv = cback(conn, req)
+            except Exception as e:
+                self._log.error(f"Error handling command {req['command']}: {e}")
+                retv = {"error": str(e)}
+        if "id" in req:
+            retv = dict(retv or {"ok": True}, id=req["id"])
+        return retv
+
+    def _reply(self, conn, line):
         """
-        Handle incoming data from a client connection.
+        Run a request line.
 
         Args:
             conn (socket.socket): The client connection socket.
+            line (bytes): The line, without its newline.
+
+        Returns:
+            bytes: The reply line.
+        """
+
+        try:
+            req = json.loads(line)
+        except ValueError as e:
+            self._log.error(f"Bad request: {e}")
+            retv = {"error": f"bad request: {e}"}
+        else:
+            if isinstance(req, list):
+                retv = [r or {"ok": True} for r in (self._call(conn, q) for q in req)]
+            else:
+                retv = self._call(conn, req)
+        if retv is None:
+            # a plain request without an id gets the old answer
+            return b"OK\n"
+        return json.dumps(retv).encode() + b"\n"
+
+    def _feed(self, conn, buf, data):
+        """
+        Add what a client sent to its read buffer, and run the requests
+        completed.
+
+        Args:
+            conn: The client connection, passed to the handlers.
+            buf (bytearray): The client's read buffer, left holding any
+            partial request.
+            data (bytes): What was read.
+
+        Returns:
+            bytes: The replies, None if the buffer passed MAX_LINE without a
+            whole request.
+        """
+
+        # only the new bytes need searching for the end of a line
+        start = len(buf)
+        buf += data
+        end = buf.find(b"\n", start)
+        if end < 0:
+            return None if len(buf) > MAX_LINE else b""
+        replies = []
+        pos = 0
+        while end >= 0:
+            if end > pos:
+                replies.append(self._reply(conn, bytes(buf[pos:end])))
+            pos = end + 1
+            end = buf.find(b"\n", pos)
+        del buf[:pos]
+        return b"".join(replies)
+
+    def _read(self, cl):
+        """
+        Read what a client sent and queue the replies to whole requests.
+
+        Args:
+            cl (_Client): The client.
 
         Returns:
-            bool: True if data was handled successfully, None otherwise.
+            bool: False if the connection closed.
         """
 
         try:
-            s_data = ""
-            while len(s_data) == 0 or s_data[-1] != "\n":
-                data = conn.recv(1024)
-                if not data:
-                    return None
-                s_data += data.decode()
-
-            if not data:
-                return None
-
-            jdata = json.loads(s_data)
-            self._log.debug(f"Received: {jdata}")
-
-            for k, v in self._cbmap.items():
-                self._log.debug(f"Checking for key: {k}")
-                if jdata.get("command", False) == k:
-                    self._log.debug(f"Found key: {k}")
-                    v(conn, jdata)
+            data = cl.sock.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
             return True
-        except socket.error as e:
+        except OSError as e:
             self._log.error(f"Error handling client connection: {e}")
-            return None
+            return False
+        if not data:
+            return False
+
+        replies = self._feed(cl.sock, cl.rbuf, data)
+        if replies is None:
+            self._log.error(f"Request from {cl.addr} over {MAX_LINE} bytes")
+            return False
+        cl.wbuf += replies
+        return self._write(cl)
+
+    def _write(self, cl):
+        """
+        Send what the socket takes of a client's queued replies.
+
+        Args:
+            cl (_Client): The client.
+
+        Returns:
+            bool: False if the connection failed.
+        """
+
+        if cl.wbuf:
+            try:
+                sent = cl.sock.send(cl.wbuf)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError as e:
+                self._log.error(f"Error sending to {cl.addr}: {e}")
+                return False
+            del cl.wbuf[:sent]
+
+        # wait to write what's left, and stop reading a client that doesn't
+        # read its replies
+        events = selectors.EVENT_WRITE if cl.wbuf else 0
+        if len(cl.wbuf) < MAX_PENDING:
+            events |= selectors.EVENT_READ
+        if events != cl.events:
+            self._sel.modify(cl.sock, events, cl)
+            cl.events = events
+        return True
+
+    def _drop(self, cl):
+        self._log.debug(f"Connection closed: {cl.addr}")
+        self._sel.unregister(cl.sock)
+        cl.sock.close()
+        del self._clmap[cl.sock]
 
     def add_handler(self, key=False, cback=False):
         """
@@ -88,7 +234,10 @@ class MaidServer:
 
         Note:
             The handler function should take two arguments: the client socket and
-            the data received from the client (result of json.reads()).
+            the data received from the client (result of json.reads()). A dict
+            it returns is the reply, otherwise the client gets "OK" ({"ok":
+            true} if the request had an id or came in a batch). The handler
+            runs on the server's thread, and shouldn't block.
         """
 
         if key and cback and key not in self._cbmap.keys() and callable(cback):
@@ -98,34 +247,29 @@ class MaidServer:
 
     def run(self):
         """
-        Run the server, handling multiple clients using select().
+        Run the server, handling multiple clients with a selector.
         """
 
-        s_list = [self._sock_file]
+        self._sel = selectors.DefaultSelector()
+        self._sock_file.setblocking(False)
+        self._sel.register(self._sock_file, selectors.EVENT_READ)
         while True:
-            r_list, _, e_list = select.select(s_list, [], s_list)
-            for n_sock in r_list:
-                if n_sock == self._sock_file:
-                    c_sock, c_addr = self._sock_file.accept()
-                    s_list.append(c_sock)
-                    self._clmap[c_sock] = c_addr
+            for key, events in self._sel.select():
+                if key.data is None:
+                    try:
+                        c_sock, c_addr = self._sock_file.accept()
+                    except (BlockingIOError, InterruptedError):
+                        continue
+                    c_sock.setblocking(False)
+                    cl = self._clmap[c_sock] = _Client(c_sock, c_addr)
+                    self._sel.register(c_sock, cl.events, cl)
                     self._log.debug(f"Accepted new connection from: {c_addr}")
-                else:
-                    msg = self._handler(n_sock)
-                    if msg is None:
-                        self._log.debug("Connection closed")
-                        s_list.remove(n_sock)
-                        n_sock.close()
-                        del self._clmap[n_sock]
-                    else:
-                        self._log.debug("Sending: 'OK'")
-                        n_sock.sendall("OK".encode())
-
-            for n_sock in e_list:
-                self._log.error(f"Error with socket: {n_sock}")
-                s_list.remove(n_sock)
-                n_sock.close()
-                del self._clmap[n_sock]
+                    continue
+                cl = key.data
+                if events & selectors.EVENT_WRITE and not self._write(cl):
+                    self._drop(cl)
+                elif events & selectors.EVENT_READ and not self._read(cl):
+                    self._drop(cl)
 
 
 class TcpServer(MaidServer):
@@ -138,9 +282,12 @@ class TcpServer(MaidServer):
         Initialize the TcpServer.
 
         Args:
+            host (str, optional): The address to bind. Defaults to
+            "localhost".
+            port (int, optional): The port to bind. Defaults to 9765.
             name (str, optional): The name of the server. Defaults to
             "tcpserver".
-            listeners (int, optional): Number of listeners. Defaults to 25.
+            conns (int, optional): Number of listeners. Defaults to 25.
         """
 
         MaidServer.__init__(self)
@@ -154,10 +301,11 @@ class TcpServer(MaidServer):
         else:
             self._host = "localhost"
         self._port = port
-        self._log = log_setup(host.lower(), logging.DEBUG)
+        self._log = log_setup(name.lower(), logging.DEBUG)
 
         self._log.debug("Starting TcpServer instance")
         self._sock_file = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock_file.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self._sock_file.bind((self._host, self._port))
         self._sock_file.listen(conns)
         self._log.debug(
@@ -172,7 +320,7 @@ class SockServer(MaidServer):
 
     SOCK_FILE = "/tmp/megamaid-{name}.sock"
 
-    def __init__(self, name=False, listeners=25):
+    def __init__(self, name=False, listeners=25, path=None):
         """
         Initialize the SockServer.
 
@@ -180,11 +328,13 @@ class SockServer(MaidServer):
             name (str, optional): The name of the server. Defaults to
             "unixserver".
             listeners (int, optional): Number of listeners. Defaults to 25.
+            path (str, optional): The socket file, instead of the one named
+            after the server.
         """
 
         MaidServer.__init__(self)
 
-        self._sock_name = None
+        self._sock_name = path
         self._sock_file = None
         self._cbmap = {}
         self._clmap = {}
@@ -194,7 +344,7 @@ class SockServer(MaidServer):
         else:
             self._name = "unixserver"
 
-        self._log = log_setup(name.lower(), logging.DEBUG)
+        self._log = log_setup(self._name.lower(), logging.DEBUG)
 
         try:
             os.unlink(self.sock_name)
@@ -219,4 +369,4 @@ class SockServer(MaidServer):
             str: The formatted socket file path.
         """
 
-        return self.SOCK_FILE.format(name=self._name)
+        return self._sock_name or self.SOCK_FILE.format(name=self._name)
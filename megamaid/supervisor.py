@@ -0,0 +1,163 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Worker pool supervision for MegaMaid. Watches the depth and throughput of each
+pipeline stage's queue and grows or shrinks that stage's worker threads.
+"""
+
+# Stdlib imports
+import time
+import threading
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+class Supervisor(threading.Thread):
+    """
+    Autoscaler for the SiteScrubber, LinkFilter and LinkFetcher pools.
+
+    A stage grows by one worker per tick while its queue holds more than
+    `backlog` items per live worker, for as long as the last growth step
+    actually raised that stage's throughput. It shrinks by one worker per tick
+    once its queue is empty, down to the stage's minimum.
+    """
+
+    def __init__(self, log_q, interval=2.0, backlog=2):
+        """
+        Initialize the Supervisor.
+
+        Args:
+            log_q (logging.Logger): The logger.
+            interval (float, optional): Seconds between scaling decisions.
+            Defaults to 2.0.
+            backlog (int, optional): Queued items per worker that trigger
+            growth. Defaults to 2.
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        self.log_q = log_q
+        self.interval = interval
+        self.backlog = backlog
+        self._stages = {}
+        self._halt = threading.Event()
+
+    def add_stage(
+        self, name, queue, factory, workers, minimum=1, maximum=8, measure="processed"
+    ):
+        """
+        Put a pipeline stage under supervision.
+
+        Args:
+            name (str): The stage name, used in log messages.
+            queue (queue.Queue): The queue the stage consumes.
+            factory (callable): Returns a new, unstarted worker thread.
+            workers (list): The stage's worker threads, new workers are
+            appended here.
+            minimum (int, optional): Fewest workers to keep. Defaults to 1.
+            maximum (int, optional): Most workers to run. Defaults to 8.
+            measure (str, optional): Worker counter used as throughput.
+            Defaults to "processed" (items handled).
+        """
+
+        self._stages[name] = Edict(
+            queue=queue,
+            factory=factory,
+            workers=workers,
+            minimum=minimum,
+            maximum=maximum,
+            measure=measure,
+            processed=self._processed(workers, measure),
+            rate=0.0,
+            grown_rate=None,
+        )
+
+    def _processed(self, workers, measure):
+        return sum(getattr(w, measure) for w in workers)
+
+    def _live(self, workers):
+        return [w for w in workers if w.is_alive() and not w.retiring]
+
+    def _scale(self, name, stage, elapsed):
+        done = self._processed(stage.workers, stage.measure)
+        stage.rate = (done - stage.processed) / elapsed
+        stage.processed = done
+        live = self._live(stage.workers)
+        depth = stage.queue.qsize()
+
+        grow = depth > self.backlog * len(live) and len(live) < stage.maximum
+        if not live and depth:
+            grow = True
+        elif grow and stage.grown_rate is not None and stage.rate <= stage.grown_rate:
+            # the last worker we added didn't buy any throughput
+            grow = False
+
+        if grow:
+            stage.grown_rate = stage.rate
+            worker = stage.factory()
+            stage.workers.append(worker)
+            worker.start()
+            self.log_q.info(
+                f"Supervisor(): {name} +1 -> {len(live) + 1} workers "
+                f"(depth {depth}, {stage.rate:.1f}/s)"
+            )
+        elif depth == 0 and len(live) > stage.minimum:
+            live[-1].retire()
+            stage.grown_rate = None
+            self.log_q.info(f"Supervisor(): {name} -1 -> {len(live) - 1} workers")
+        elif depth <= self.backlog * len(live):
+            stage.grown_rate = None
+
+    def stats(self):
+        """
+        Get the current size, queue depth and throughput of every stage.
+
+        Returns:
+            Edict: Per stage workers, depth and rate (per second, in the
+            stage's measure).
+        """
+
+        return Edict(
+            **{
+                name: dict(
+                    workers=len(self._live(s.workers)),
+                    depth=s.queue.qsize(),
+                    rate=s.rate,
+                )
+                for name, s in self._stages.items()
+            }
+        )
+
+    def stop(self):
+        """
+        Stop supervising, the workers are left running.
+        """
+
+        self._halt.set()
+
+    def run(self):
+        stamp = time.monotonic()
+        while not self._halt.wait(self.interval):
+            now = time.monotonic()
+            for name, stage in self._stages.items():
+                self._scale(name, stage, now - stamp)
+            stamp = now
+        self.log_q.info("Supervisor() thread exit")
@@ -0,0 +1,284 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Bandwidth limiting for MegaMaid. Every read from the network is charged to a
+global token bucket and to a bucket for the host it came from, and the reader
+sleeps off whatever it overdrew.
+"""
+
+# Stdlib imports
+import time
+import asyncio
+import threading
+
+# Internal imports
+from megamaid.edict import Edict
+
+
+_UNITS = {"K": 1024, "M": 1024**2, "G": 1024**3}
+
+
+def parse_rate(raw):
+    """
+    Parse a rate like "512K" or "10M" (bytes per second, binary units).
+
+    Args:
+        raw (str): The rate, 0 for unlimited.
+
+    Returns:
+        int: Bytes per second.
+    """
+
+    raw = str(raw).strip().upper().removesuffix("/S").removesuffix("B")
+    if raw[-1:] in _UNITS:
+        return int(float(raw[:-1]) * _UNITS[raw[-1]])
+    return int(float(raw))
+
+
+def parse_schedule(raw):
+    """
+    Parse a time of day window like "09:00-17:30=2M".
+
+    Args:
+        raw (str): The window, local time. It may wrap past midnight.
+
+    Returns:
+        tuple: (start, end, rate), start and end in minutes after midnight.
+    """
+
+    span, _, rate = raw.partition("=")
+    start, _, end = span.partition("-")
+    minutes = []
+    for stamp in (start, end):
+        hour, _, minute = stamp.partition(":")
+        minutes.append(int(hour) * 60 + int(minute or 0))
+    return (minutes[0], minutes[1], parse_rate(rate))
+
+
+class TokenBucket:
+    """
+    Token bucket that lets callers go into debt: a read always proceeds and
+    the caller is told how long to sleep to pay it back, so readers are served
+    in order without polling.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        """
+        Initialize the TokenBucket.
+
+        Args:
+            rate (int, optional): Bytes per second, 0 for unlimited.
+            burst (int, optional): Most bytes saved up while idle. Defaults
+            to one second's worth.
+        """
+
+        self.stamp = time.monotonic()
+        self.tokens = 0.0
+        self.burst = burst
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        """
+        Change the rate, keeping the current balance.
+
+        Args:
+            rate (int): Bytes per second, 0 for unlimited.
+        """
+
+        self.rate = rate or 0
+        self.size = self.burst or self.rate
+        self.tokens = min(self.tokens, self.size)
+
+    def reserve(self, n, now):
+        """
+        Take `n` bytes out of the bucket.
+
+        Args:
+            n (int): Bytes read.
+            now (float): time.monotonic().
+
+        Returns:
+            float: Seconds to wait before reading more.
+        """
+
+        if not self.rate:
+            return 0.0
+        self.tokens = min(self.size, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        self.tokens -= n
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+
+class Throttle:
+    """
+    Global and per-host bandwidth scheduler, with time of day schedules for
+    the global cap. Also counts the bytes each host delivered, so achieved
+    throughput can be compared against the caps.
+    """
+
+    def __init__(self, rate=0, host_rate=0, hosts=None, schedule=None):
+        """
+        Initialize the Throttle.
+
+        Args:
+            rate (int, optional): Global cap in bytes per second, 0 for none.
+            host_rate (int, optional): Cap for each host without its own.
+            hosts (dict, optional): Caps for particular hosts.
+            schedule (list, optional): (start, end, rate) windows, as
+            returned by parse_schedule(), that replace the global cap.
+        """
+
+        self._lock = threading.Lock()
+        self._global = TokenBucket()
+        self._buckets = {}
+        self._counts = {}
+        self._checked = 0.0
+        self.configure(rate, host_rate, hosts, schedule)
+
+    def configure(self, rate=0, host_rate=0, hosts=None, schedule=None):
+        """
+        Replace every cap, taking effect immediately.
+
+        Args:
+            rate (int, optional): Global cap in bytes per second, 0 for none.
+            host_rate (int, optional): Cap for each host without its own.
+            hosts (dict, optional): Caps for particular hosts.
+            schedule (list, optional): Time of day windows for the global cap.
+        """
+
+        with self._lock:
+            self.rate = rate or 0
+            self.host_rate = host_rate or 0
+            self.hosts = dict(hosts or {})
+            self.schedule = list(schedule or [])
+            self._global.set_rate(self._scheduled())
+            for host, bucket in self._buckets.items():
+                bucket.set_rate(self.hosts.get(host, self.host_rate))
+            self.limited = bool(
+                self.rate or self.host_rate or self.hosts or self.schedule
+            )
+
+    def set_rate(self, rate, host=None):
+        """
+        Change one cap, taking effect immediately.
+
+        Args:
+            rate (int): Bytes per second, 0 for unlimited.
+            host (str, optional): The host to cap, or None for the global cap.
+        """
+
+        with self._lock:
+            if host is None:
+                self.rate = rate
+                self._global.set_rate(self._scheduled())
+            else:
+                self.hosts[host] = rate
+                if host in self._buckets:
+                    self._buckets[host].set_rate(rate)
+            self.limited = bool(
+                self.rate or self.host_rate or self.hosts or self.schedule
+            )
+
+    def _scheduled(self):
+        # The global cap in force right now
+        if self.schedule:
+            now = time.localtime()
+            minute = now.tm_hour * 60 + now.tm_min
+            for start, end, rate in self.schedule:
+                if start <= minute < end or (end < start and not end <= minute < start):
+                    return rate
+        return self.rate
+
+    def reserve(self, host, n):
+        """
+        Charge `n` bytes read from `host`.
+
+        Args:
+            host (str): The host the bytes came from.
+            n (int): Bytes read.
+
+        Returns:
+            float: Seconds the reader should wait before reading more.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            count = self._counts.get(host)
+            if count is None:
+                count = self._counts[host] = [0, now, now]
+            count[0] += n
+            count[2] = now
+            if not self.limited:
+                return 0.0
+
+            if self.schedule and now - self._checked >= 30:
+                self._checked = now
+                self._global.set_rate(self._scheduled())
+            bucket = self._buckets.get(host)
+            if bucket is None:
+                bucket = TokenBucket(self.hosts.get(host, self.host_rate))
+                self._buckets[host] = bucket
+            return max(self._global.reserve(n, now), bucket.reserve(n, now))
+
+    def consume(self, host, n):
+        """
+        Charge `n` bytes read from `host`, sleeping if a cap was exceeded.
+
+        Args:
+            host (str): The host the bytes came from.
+            n (int): Bytes read.
+        """
+
+        delay = self.reserve(host, n)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def aconsume(self, host, n):
+        """
+        consume() for the asyncio engine.
+
+        Args:
+            host (str): The host the bytes came from.
+            n (int): Bytes read.
+        """
+
+        delay = self.reserve(host, n)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def stats(self):
+        """
+        Get what each host delivered.
+
+        Returns:
+            Edict: Per host bytes, rate (bytes per second between its first
+            and last read) and cap (bytes per second, 0 for none).
+        """
+
+        with self._lock:
+            retv = Edict()
+            for host, (total, first, last) in self._counts.items():
+                retv[host] = Edict(
+                    bytes=total,
+                    rate=total / (last - first) if last > first else 0.0,
+                    cap=self.hosts.get(host, self.host_rate),
+                )
+            return retv
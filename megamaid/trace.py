@@ -0,0 +1,323 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Tracing and profiling for MegaMaid. Spans are timed around the network calls,
+listing parses, filter matches, disk writes and queue waits, and saved as
+Chrome trace-event JSON that Perfetto (ui.perfetto.dev) or chrome://tracing
+can open. Tracing is off unless start_trace() is called, and a span costs a
+function call and a global lookup while it is.
+"""
+
+# Stdlib imports
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+
+
+# Most spans kept in memory, later ones are counted and dropped
+MAX_EVENTS = 1000000
+
+# The running Tracer, None while tracing is off
+TRACER = None
+
+
+class _NoSpan:
+    # What span() hands out while tracing is off, one is shared by everyone
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, val, tb):
+        return None
+
+    def set(self, **args):
+        pass
+
+
+_NOSPAN = _NoSpan()
+
+
+class _Span:
+    # One timed block, recorded with its tracer when the block exits
+
+    __slots__ = ("tracer", "name", "cat", "args", "start")
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, typ, val, tb):
+        end = time.perf_counter_ns()
+        if typ is not None:
+            self.args["error"] = typ.__name__
+        self.tracer.add(self.name, self.cat, self.start, end, self.args)
+        return None
+
+    def set(self, **args):
+        self.args.update(args)
+
+
+class Tracer:
+    """
+    Thread safe collector of timed spans. Each span is a complete ("X") trace
+    event on the thread that ran it, so nested spans show as a stack.
+    """
+
+    def __init__(self, limit=MAX_EVENTS):
+        """
+        Initialize the Tracer.
+
+        Args:
+            limit (int, optional): Most spans kept. Defaults to MAX_EVENTS.
+        """
+
+        self.limit = limit
+        self.dropped = 0
+        self._events = []
+        self._threads = {}
+        self._pid = os.getpid()
+        self._t0 = time.perf_counter_ns()
+
+    def add(self, name, cat, start, end, args):
+        """
+        Record a span.
+
+        Args:
+            name (str): What was timed.
+            cat (str): Its category (net, parse, filter, disk or queue).
+            start (int): time.perf_counter_ns() when it began.
+            end (int): time.perf_counter_ns() when it ended.
+            args (dict): Attributes shown with the span.
+        """
+
+        if len(self._events) >= self.limit:
+            self.dropped += 1
+            return
+        tid = threading.get_native_id()
+        if tid not in self._threads:
+            thread = threading.current_thread()
+            kind = type(thread).__name__
+            self._threads[tid] = (
+                thread.name if kind == "Thread" else f"{kind} ({thread.name})"
+            )
+        # list.append is atomic, so the threads need no lock
+        self._events.append((name, cat, tid, start, end - start, args))
+
+    def totals(self):
+        """
+        Sum the spans by name.
+
+        Returns:
+            dict: Span name to (count, seconds), most time first.
+        """
+
+        retv = {}
+        for name, _, _, _, dur, _ in list(self._events):
+            count, total = retv.get(name, (0, 0))
+            retv[name] = (count + 1, total + dur)
+        return {
+            name: (count, total / 1e9)
+            for name, (count, total) in sorted(retv.items(), key=lambda i: -i[1][1])
+        }
+
+    def events(self):
+        """
+        Build the trace events, thread names first.
+
+        Returns:
+            list: Chrome trace-event dicts, times in microseconds.
+        """
+
+        pid = self._pid
+        retv = [
+            {
+                "name": "process_name",
+                "ph": "M",
+                "pid": pid,
+                "tid": 0,
+                "args": {"name": "megamaid"},
+            }
+        ]
+        for tid, name in list(self._threads.items()):
+            retv.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": name},
+                }
+            )
+        for name, cat, tid, start, dur, args in list(self._events):
+            event = {
+                "name": name,
+                "cat": cat,
+                "ph": "X",
+                "pid": pid,
+                "tid": tid,
+                "ts": (start - self._t0) / 1000,
+                "dur": dur / 1000,
+            }
+            if args:
+                event["args"] = args
+            retv.append(event)
+        return retv
+
+    def save(self, fname):
+        """
+        Write the trace as Chrome trace-event JSON.
+
+        Args:
+            fname (str): The file to write.
+
+        Returns:
+            int: The number of spans written.
+        """
+
+        events = self.events()
+        with open(fname, "w") as fp:
+            json.dump(
+                {
+                    "traceEvents": events,
+                    "displayTimeUnit": "ms",
+                    "otherData": {"dropped": self.dropped},
+                },
+                fp,
+                default=str,
+            )
+        return sum(1 for e in events if e["ph"] == "X")
+
+
+def span(name, cat="megamaid", **args):
+    """
+    Time a block, as `with span("http_get", "net", url=site):`.
+
+    Args:
+        name (str): What is timed.
+        cat (str, optional): Its category. Defaults to "megamaid".
+        **args: Attributes shown with the span.
+
+    Returns:
+        A context manager; its set(**args) adds attributes from inside the
+        block. While tracing is off it is a shared no-op.
+    """
+
+    if TRACER is None:
+        return _NOSPAN
+    return _Span(TRACER, name, cat, args)
+
+
+def start_trace(limit=MAX_EVENTS):
+    """
+    Turn tracing on.
+
+    Args:
+        limit (int, optional): Most spans kept. Defaults to MAX_EVENTS.
+
+    Returns:
+        Tracer: The new TRACER.
+    """
+
+    global TRACER
+    TRACER = Tracer(limit)
+    return TRACER
+
+
+def stop_trace():
+    """
+    Turn tracing off.
+
+    Returns:
+        Tracer: The tracer that was running, or None.
+    """
+
+    global TRACER
+    retv, TRACER = TRACER, None
+    return retv
+
+
+def profiled(thread, outdir):
+    """
+    Run a thread under cProfile. Its stats are dumped when run() returns, to
+    `outdir`/<class>-<thread id>.prof.
+
+    Args:
+        thread (threading.Thread): The thread, not yet started.
+        outdir (str): Where the stats go.
+
+    Returns:
+        threading.Thread: `thread`.
+    """
+
+    run = thread.run
+
+    def _run():
+        prof = cProfile.Profile()
+        try:
+            prof.runcall(run)
+        finally:
+            prof.dump_stats(
+                os.path.join(
+                    outdir, f"{type(thread).__name__}-{threading.get_native_id()}.prof"
+                )
+            )
+
+    thread.run = _run
+    return thread
+
+
+def profile_summary(outdir, top=25):
+    """
+    Merge the per-thread stats in `outdir` by thread class, and write the
+    functions taking the most cumulative time in each to summary.txt.
+
+    Args:
+        outdir (str): Where profiled() dumped the stats.
+        top (int, optional): Functions listed per class. Defaults to 25.
+
+    Returns:
+        str: The summary's path, or None if there were no stats.
+    """
+
+    groups = {}
+    for fname in sorted(os.listdir(outdir)):
+        if fname.endswith(".prof"):
+            kind = fname.rpartition("-")[0]
+            groups.setdefault(kind, []).append(os.path.join(outdir, fname))
+    if not groups:
+        return None
+    retv = os.path.join(outdir, "summary.txt")
+    with open(retv, "w") as fp:
+        for kind, files in groups.items():
+            fp.write(f"==== {kind}: {len(files)} thread(s)\n")
+            pstats.Stats(*files, stream=fp).sort_stats("cumulative").print_stats(top)
+    return retv
@@ -1,10 +1,17 @@
 import os
 import re
+import json
 import logging
 
-from ftplib import FTP
+from ftplib import error_perm
+from contextlib import contextmanager
 from urllib.parse import urlparse
-from http.client import HTTPConnection, HTTPSConnection
+from http.client import IncompleteRead, RemoteDisconnected
+
+# Internal imports
+from megamaid.pool import ConnectionPool, FtpPool
+from megamaid.throttle import Throttle
+from megamaid.trace import span
 
 
 def log_setup(name, level=logging.INFO, fname=False, fmatter=False):
@@ -32,72 +39,217 @@ def log_cleanup(name):
         os.unlink(ln)
 
 
-def ftp_get(site, fp):
-    url = urlparse(site)
-    with FTP(url.netloc) as ftp:
-        ftp.login()
-        ftp.cwd(os.path.dirname(url.path))
-        ftp.retrbinary(f"RETR {os.path.basename(url.path)}", fp.write)
-        ftp.quit()
+HEADERS = {
+    "User-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537."
+}
 
+# Shared keep-alive pool used by every http_* call
+POOL = ConnectionPool()
 
-def http_get(site):
-    headers = {
-        "User-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537."
-    }
+# Shared pool of logged in FTP control connections, for walking and fetching
+FTP_POOL = FtpPool()
+
+# Bandwidth caps every network read is charged against, unlimited by default
+THROTTLE = Throttle()
+
+# Read buffer size for streamed downloads
+BUFSIZE = 65536
+
+# Seconds a pipeline stage waits for work before its thread exits
+IDLE = 15.0
+
+# Bodies up to this size get drained so the connection can go back to the pool
+DRAIN_MAX = 65536
+
+# Errors meaning a pooled connection was closed by the server while idle
+STALE_ERRORS = (RemoteDisconnected, BrokenPipeError, ConnectionResetError)
+
+
+# Check a logged in FTP connection for `site` out of FTP_POOL. It goes back
+# when the block is done, unless something went wrong that could have left a
+# transfer half finished. Commands take absolute paths, since the connection's
+# working directory is whatever its last user left.
+@contextmanager
+def ftp_open(site):
     url = urlparse(site)
-    conn = None
-    if len(os.getenv("http_proxy", "")) > 0:
-        proxy = urlparse(os.getenv("http_proxy"))
-        (host, port) = proxy.netloc.split(":")
-        if url.scheme == "https":
-            conn = HTTPSConnection(host, port)
-            conn.set_tunnel(url.hostname, 443)
-        else:
-            conn = HTTPConnection(host, port)
-        headers["Host"] = url.hostname
-    else:
-        if url.scheme == "https":
-            conn = HTTPSConnection(url.hostname)
-        else:
-            conn = HTTPConnection(url.hostname)
-    if len(os.getenv("http_proxy", "")) > 0:
-        if url.scheme == "http":
-            conn.request("GET", site, headers=headers)
-        elif url.scheme == "https":
-            conn.request("GET", url.path)
+    key = FTP_POOL.key(url)
+    ftp, _ = FTP_POOL.acquire(key, url.password)
+    try:
+        yield ftp
+    except error_perm:
+        # a refused command leaves the session as it was
+        FTP_POOL.release(key, ftp)
+        raise
+    except BaseException:
+        FTP_POOL.discard(ftp)
+        raise
     else:
-        conn.request("GET", url.path, headers=headers)
+        FTP_POOL.release(key, ftp)
 
-    return conn.getresponse().read()
 
+def ftp_get(
+    site, fp, bufsize=BUFSIZE, progress=None, offset=0, validator=None, on_start=None
+):
+    url = urlparse(site)
+    length = None
 
-def http_head(site):
-    conn = None
+    def _write(data):
+        with span("write", "disk", bytes=len(data)):
+            fp.write(data)
+        THROTTLE.consume(url.hostname, len(data))
+        if progress:
+            progress(len(data), length)
+
+    with span("ftp_get", "net", url=site, offset=offset), ftp_open(site) as ftp:
+        ftp.voidcmd("TYPE I")
+        try:
+            length = ftp.size(url.path)
+        except error_perm:
+            pass
+        try:
+            mdtm = ftp.voidcmd(f"MDTM {url.path}").split()[-1]
+        except error_perm:
+            mdtm = None
+
+        # only resume a partial that was started against the same remote file
+        if not validator or validator != mdtm or (length and offset > length):
+            offset = 0
+        fp.seek(offset)
+        fp.truncate()
+        if on_start:
+            on_start(offset, mdtm)
+
+        if not length or offset < length:
+            ftp.retrbinary(f"RETR {url.path}", _write, bufsize, offset or None)
+
+
+def ftp_stat(site):
     url = urlparse(site)
-    headers = {
-        "User-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537."
-    }
+    size = mdtm = None
+    with ftp_open(site) as ftp:
+        ftp.voidcmd("TYPE I")
+        try:
+            size = ftp.size(url.path)
+            mdtm = ftp.voidcmd(f"MDTM {url.path}").split()[-1]
+        except error_perm:
+            pass
+    return (size, mdtm)
+
+
+@contextmanager
+def http_open(site, method="GET", headers=None):
+    url = urlparse(site)
+    proxy = None
     if len(os.getenv("http_proxy", "")) > 0:
         proxy = urlparse(os.getenv("http_proxy"))
-        (host, port) = proxy.netloc.split(":")
-        if url.scheme == "https":
-            conn = HTTPSConnection(host, port)
-            conn.set_tunnel(url.hostname, 443)
-        else:
-            conn = HTTPConnection(host, port)
-        headers["Host"] = url.hostname
+
+    hdrs = dict(HEADERS)
+    if proxy:
+        hdrs["Host"] = url.netloc
+    if headers:
+        hdrs.update(headers)
+
+    # plain http through a proxy wants the absolute URI, everything else the path
+    if proxy and url.scheme == "http":
+        target = site
+    else:
+        target = url.path or "/"
+        if url.query:
+            target = f"{target}?{url.query}"
+
+    key = POOL.key(url, proxy)
+    conn, reused = POOL.acquire(key, proxy)
+    try:
+        # up to the response headers, the body is read by whoever asked
+        with span("request", "net", url=site, method=method, reused=reused) as sp:
+            conn.request(method, target, headers=hdrs)
+            resp = conn.getresponse()
+            sp.set(status=resp.status)
+    except STALE_ERRORS:
+        POOL.discard(conn)
+        if not reused:
+            raise
+        # the server dropped our idle connection, try once more on a fresh one
+        POOL.mark_retry()
+        conn = POOL.connect(key, proxy)
+        try:
+            with span("request", "net", url=site, method=method, reused=False) as sp:
+                conn.request(method, target, headers=hdrs)
+                resp = conn.getresponse()
+                sp.set(status=resp.status)
+        except Exception:
+            POOL.discard(conn)
+            raise
+    except Exception:
+        POOL.discard(conn)
+        raise
+
+    try:
+        yield resp
+    except BaseException:
+        POOL.discard(conn)
+        raise
     else:
-        if url.scheme == "https":
-            conn = HTTPSConnection(url.hostname)
+        if not resp.isclosed() and resp.length is not None and resp.length <= DRAIN_MAX:
+            try:
+                resp.read()
+            except Exception:
+                pass
+        if resp.isclosed() and not resp.will_close:
+            POOL.release(key, conn)
         else:
-            conn = HTTPConnection(url.hostname)
-    if len(os.getenv("http_proxy", "")) > 0:
-        if url.scheme == "http":
-            conn.request("HEAD", site, headers=headers)
-        elif url.scheme == "https":
-            conn.request("HEAD", url.path)
-    return conn.getresponse()
+            POOL.discard(conn)
+
+
+def http_get(site):
+    with span("http_get", "net", url=site), http_open(site) as resp:
+        data = resp.read()
+    THROTTLE.consume(urlparse(site).hostname, len(data))
+    return data
+
+
+def http_head(site):
+    with span("http_head", "net", url=site), http_open(site, "HEAD") as resp:
+        return resp
+
+
+# Yield the body of `resp` in chunks, reusing one buffer of `bufsize` bytes.
+# Each chunk is a memoryview that is only valid until the next one is read.
+# Reads are charged to `host` in THROTTLE.
+def iter_response(resp, bufsize=BUFSIZE, host=None):
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    while True:
+        n = resp.readinto(buf)
+        if not n:
+            if resp.length:
+                # the server hung up early, http.client doesn't complain
+                raise IncompleteRead(b"", resp.length)
+            break
+        THROTTLE.consume(host, n)
+        yield view[:n]
+
+
+# Local path a URL is mirrored to, optionally dropping `chop_l` leading components
+def output_path(url, chop_l=False):
+    if chop_l:
+        tfn = url.hostname + url.path
+        return f'./{"/".join(tfn.split("/")[chop_l:])}'
+    return url.hostname + url.path
+
+
+# Sidecar metadata (url and validators) for a partial download
+def load_part_meta(part):
+    try:
+        with open(f"{part}.meta") as fp:
+            return json.load(fp)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_part_meta(part, meta):
+    with open(f"{part}.meta", "w") as fp:
+        json.dump(meta, fp)
 
 
 # Normalize URLs, changing `//` to `/`
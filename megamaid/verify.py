@@ -0,0 +1,361 @@
+# Copyright (c) 2024 Mike 'Fuzzy' Partin <mike.partin32@gmail.com>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+Checksum verification for MegaMaid. Reads the SHA256, CHECKSUM, MD5 and
+similar files mirrors publish, and checks every file fetched against them as
+it lands, hashing in a pool of processes. Files that don't match are fetched
+again.
+"""
+
+# Stdlib imports
+import io
+import os
+import re
+import time
+import hashlib
+import threading
+import multiprocessing
+
+from queue import Empty
+from urllib.parse import unquote, urlparse
+from concurrent.futures import ProcessPoolExecutor
+
+# Internal imports
+from megamaid.edict import Edict
+from megamaid.utils import ftp_get, http_get, normalize_url
+
+
+# Times a file that fails verification is fetched again
+RETRIES = 2
+
+# Checksum files: OpenBSD's SHA256, NetBSD's MD5 and SHA512, FreeBSD's
+# CHECKSUM.SHA256-*, the SHA256SUMS/md5sums kind and foo.iso.sha256
+_SUMS = re.compile(
+    r"(?i)/(?:(?:sha(?:1|224|256|384|512)|md5)(?:sums?)?(?:\.txt|\.asc)?"
+    r"|checksums?(?:\.(?:sha(?:1|224|256|384|512)|md5)[^/]*)?(?:\.txt)?)$"
+    r"|\.(?:sha(?:1|224|256|384|512)|md5)$"
+)
+
+# SHA256 (name) = hex
+_BSD = re.compile(
+    r"^(SHA1|SHA224|SHA256|SHA384|SHA512|MD5) ?\((.+)\) ?= ?([0-9a-fA-F]+)$"
+)
+
+# hex  name, or hex *name for binary mode
+_GNU = re.compile(r"^([0-9a-fA-F]{32,128})(?:[ \t]+\*?(.+))?$")
+
+# What each hex digest length is, for files that don't say
+_LENGTHS = {
+    32: "md5",
+    40: "sha1",
+    56: "sha224",
+    64: "sha256",
+    96: "sha384",
+    128: "sha512",
+}
+
+# Which checksum to use when several files list the same file; sha256 first,
+# since fetchers hash it on the way in
+_PREFER = ("sha256", "sha512", "sha384", "sha224", "sha1", "md5")
+
+
+def is_checksum_file(url):
+    """
+    Tell whether a link looks like a checksum file.
+
+    Args:
+        url (str): The link URL.
+
+    Returns:
+        bool: True for SHA256, MD5SUMS, CHECKSUM.SHA512-*, foo.iso.sha256 and
+        the like.
+    """
+
+    return bool(_SUMS.search(urlparse(url).path))
+
+
+def parse_checksums(data, url):
+    """
+    Read a checksum file, in BSD ("SHA256 (name) = hex") or GNU ("hex  name")
+    style. Lines in neither, like PGP armor, are skipped.
+
+    Args:
+        data (bytes): The file.
+        url (str): Where it came from, names in it are relative to that.
+
+    Returns:
+        dict: Unquoted file URL to (algorithm, hex digest) tuples.
+    """
+
+    base = url.rsplit("/", 1)[0]
+    alone = url.rsplit("/", 1)[1].rsplit(".", 1)[0]
+    retv = {}
+    for line in data.decode("utf-8", "replace").splitlines():
+        line = line.strip()
+        m = _BSD.match(line)
+        if m:
+            algo, name, digest = m.group(1).lower(), m.group(2), m.group(3)
+        else:
+            m = _GNU.match(line)
+            if not m or len(m.group(1)) not in _LENGTHS:
+                continue
+            digest, name = m.group(1), m.group(2) or alone
+            algo = _LENGTHS[len(digest)]
+        if name.startswith("./"):
+            name = name[2:]
+        retv[unquote(normalize_url(f"{base}/{name}"))] = (algo, digest.lower())
+    return retv
+
+
+def fetch_bytes(url):
+    """
+    Fetch a small file into memory.
+
+    Args:
+        url (str): The URL, http, https or ftp.
+
+    Returns:
+        bytes: The file.
+    """
+
+    if urlparse(url).scheme == "ftp":
+        buf = io.BytesIO()
+        ftp_get(url, buf)
+        return buf.getvalue()
+    return http_get(url)
+
+
+def hash_path(path, algo, bufsize=1024 * 1024):
+    """
+    Hash a file, in a worker process.
+
+    Args:
+        path (str): The file.
+        algo (str): A hashlib algorithm name.
+        bufsize (int, optional): Read size.
+
+    Returns:
+        tuple: (hex digest, bytes read, seconds taken)
+    """
+
+    st = time.perf_counter()
+    digest = hashlib.new(algo)
+    buf = bytearray(bufsize)
+    view = memoryview(buf)
+    total = 0
+    with open(path, "rb", buffering=0) as fp:
+        while True:
+            n = fp.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+            total += n
+    return (digest.hexdigest(), total, time.perf_counter() - st)
+
+
+class Verifier(threading.Thread):
+    """
+    The verification stage. Takes ("sums", url) items for checksum files
+    found by the LinkFilter and ("file", url, path, sha256) items for files
+    the LinkFetchers wrote, where sha256 is the digest computed while the file
+    streamed in, or None. Files whose checksum isn't known yet wait for it.
+    """
+
+    def __init__(
+        self,
+        verify_q,
+        fetch_q,
+        log_q,
+        sig_q,
+        gui_q,
+        workers=2,
+        store=None,
+        jobs=None,
+    ):
+        """
+        Initialize the Verifier.
+
+        Args:
+            verify_q (queue.Queue): Where the work comes from.
+            fetch_q (queue.Queue): Where files that fail go to be fetched
+            again.
+            log_q (logging.Logger): The logger.
+            sig_q (queue.Queue): The exit signal queue.
+            gui_q (queue.Queue): The gui update queue.
+            workers (int, optional): Hashing processes. Defaults to 2.
+            store (ObjectStore, optional): Forgets bad files, so they aren't
+            recalled instead of fetched.
+            jobs (JobStore, optional): Puts bad files back to matched.
+        """
+
+        threading.Thread.__init__(self, daemon=True)
+        self.verify_q = verify_q
+        self.fetch_q = fetch_q
+        self.log_q = log_q
+        self.sig_q = sig_q
+        self.gui_q = gui_q
+        self.workers = workers
+        self.store = store
+        self.jobs = jobs
+        self._lock = threading.Lock()
+        self._pool = None
+        self._expected = {}
+        self._waiting = {}
+        self._tries = {}
+        self._stats = Edict(
+            sums=0, verified=0, failed=0, refetched=0, streamed=0, bytes=0, hashed=0
+        )
+        self._stats.busy = 0.0
+
+    def run(self):
+        try:
+            while True:
+                try:
+                    self.sig_q.get(False)
+                    self.log_q.info("Verifier() thread exit")
+                    self.sig_q.task_done()
+                    self.sig_q.put(True)
+                    return
+                except Empty:
+                    pass
+
+                try:
+                    item = self.verify_q.get(True, 1)
+                except Empty:
+                    continue
+                try:
+                    if item[0] == "sums":
+                        self._sums(item[1])
+                        self.verify_q.task_done()
+                    else:
+                        self._file(*item[1:])
+                except Exception as e:
+                    self.log_q.error(f"Verifier(): {item[1]}: {e}")
+                    self.verify_q.task_done()
+        finally:
+            if self._pool:
+                self._pool.shutdown()
+
+    def _sums(self, url):
+        found = parse_checksums(fetch_bytes(url), url)
+        self.log_q.debug(f"Verifier(): {url} lists {len(found)} files")
+        with self._lock:
+            self._stats.sums += 1
+            for key, (algo, digest) in found.items():
+                have = self._expected.get(key)
+                if have is None or _PREFER.index(algo) < _PREFER.index(have[0]):
+                    self._expected[key] = (algo, digest)
+            ready = [self._waiting.pop(k) for k in found if k in self._waiting]
+        # files that arrived before their checksums go round again
+        for item in ready:
+            self.verify_q.put(item)
+
+    def _file(self, url, path, sha256):
+        key = unquote(normalize_url(url))
+        with self._lock:
+            want = self._expected.get(key)
+            if want is None:
+                self._waiting[key] = ("file", url, path, sha256)
+        if want is None:
+            self.verify_q.task_done()
+            return
+
+        algo, digest = want
+        if algo == "sha256" and sha256:
+            # hashed on the way in, no need to read it back
+            with self._lock:
+                self._stats.streamed += 1
+            self._checked(url, path, digest, sha256, os.path.getsize(path))
+            self.verify_q.task_done()
+            return
+
+        if self._pool is None:
+            # forking now would copy locks the other threads hold
+            methods = multiprocessing.get_all_start_methods()
+            ctx = multiprocessing.get_context(
+                "forkserver" if "forkserver" in methods else "spawn"
+            )
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=ctx)
+        future = self._pool.submit(hash_path, path, algo)
+
+        def _done(fut):
+            try:
+                got, size, took = fut.result()
+                self._checked(url, path, digest, got, size, took)
+            except Exception as e:
+                self.log_q.error(f"Verifier(): {url}: {e}")
+            finally:
+                self.verify_q.task_done()
+
+        future.add_done_callback(_done)
+
+    def _checked(self, url, path, want, got, size, took=None):
+        if got == want:
+            with self._lock:
+                self._stats.verified += 1
+                self._stats.bytes += size
+                if took is not None:
+                    self._stats.hashed += size
+                    self._stats.busy += took
+                self._tries.pop(url, None)
+            self.gui_q.put({"verified": 1, "vbytes": size})
+            return
+
+        with self._lock:
+            self._stats.failed += 1
+            tries = self._tries[url] = self._tries.get(url, 0) + 1
+        self.gui_q.put({"vfailed": 1})
+        if tries > RETRIES:
+            self.log_q.error(
+                f"Verifier(): {path} still doesn't match its checksum after "
+                f"{RETRIES} fetches, keeping it"
+            )
+            return
+
+        self.log_q.warning(f"Verifier(): {path} doesn't match its checksum, refetching")
+        if self.store:
+            self.store.forget(url)
+        if self.jobs:
+            self.jobs.matched(url)
+        os.unlink(path)
+        with self._lock:
+            self._stats.refetched += 1
+        # the fetch about to happen counts it again
+        self.gui_q.put({"have": -1, "size": -size})
+        self.fetch_q.put(url)
+
+    def stats(self):
+        """
+        Get the verification counters.
+
+        Returns:
+            Edict: sums (checksum files read), verified, failed, refetched,
+            streamed (verified without reading the file back), unverified
+            (no checksum found), bytes verified, hashed (bytes read back by
+            the workers) and rate (bytes per second each worker hashed).
+        """
+
+        with self._lock:
+            retv = Edict(**self._stats)
+            retv.unverified = len(self._waiting)
+        retv.rate = retv.hashed / retv.busy if retv.busy else 0.0
+        del retv["busy"]
+        return retv
@@ -0,0 +1,124 @@
+import os
+import json
+import time
+import socket
+import threading
+
+import pytest
+
+from megamaid.aserver import AsyncSockServer
+
+
+def start(tmp_path, **kwargs):
+    srv = AsyncSockServer("pytest", path=str(tmp_path / "a.sock"))
+    for key, val in kwargs.items():
+        setattr(srv, key, val)
+    srv.add_handler("echo", lambda conn, data: {"echo": data.get("value")})
+    threading.Thread(target=srv.run, daemon=True).start()
+    for _ in range(500):
+        if os.path.exists(srv.sock_name) and srv._loop is not None:
+            break
+        time.sleep(0.01)
+    return srv
+
+
+class Client:
+
+    def __init__(self, path):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(5)
+        self.sock.connect(path)
+        self.buf = b""
+
+    def send(self, req):
+        self.sock.sendall(json.dumps(req).encode() + b"\n")
+
+    def read(self):
+        while b"\n" not in self.buf:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return None
+            self.buf += chunk
+        line, _, self.buf = self.buf.partition(b"\n")
+        return json.loads(line)
+
+    def call(self, req):
+        self.send(req)
+        return self.read()
+
+
+def wait_for(cond):
+    for _ in range(500):
+        if cond():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+@pytest.fixture
+def srv(tmp_path):
+    return start(tmp_path)
+
+
+def test_same_protocol(srv):
+    c = Client(srv.sock_name)
+    assert c.call({"command": "echo", "value": 1, "id": 2}) == {"echo": 1, "id": 2}
+    assert c.call([{"command": "echo", "value": 3}, {"command": "x"}]) == [
+        {"echo": 3},
+        {"error": "unknown command: x"},
+    ]
+
+
+def test_subscribe_and_publish(srv):
+    c = Client(srv.sock_name)
+    assert c.call({"command": "subscribe", "topics": ["b", "a"]}) == {
+        "ok": True,
+        "topics": ["a", "b"],
+    }
+    assert "error" in c.call({"command": "subscribe", "topics": "a"})
+    srv.publish("a", {"n": 1})
+    srv.publish("other", {"n": 2})
+    srv.publish("b", {"n": 3})
+    assert c.read() == {"n": 1, "event": "a"}
+    assert c.read() == {"n": 3, "event": "b"}
+    assert c.call({"command": "unsubscribe", "topics": ["a"]})["topics"] == ["b"]
+    srv.publish("a", {"n": 4})
+    srv.publish("b", {"n": 5})
+    assert c.read() == {"n": 5, "event": "b"}
+
+
+def test_disconnect_unsubscribes(srv):
+    c = Client(srv.sock_name)
+    c.call({"command": "subscribe", "topics": ["a"]})
+    c.sock.close()
+    assert wait_for(lambda: not srv._subs and not srv._clmap)
+
+
+def test_every_publishes_while_subscribed(srv):
+    calls = []
+    srv.every(0.02, "stats", lambda: calls.append(1) or {"calls": len(calls)})
+    time.sleep(0.1)
+    assert calls == []
+    c = Client(srv.sock_name)
+    c.call({"command": "subscribe", "topics": ["stats"]})
+    assert c.read() == {"calls": 1, "event": "stats"}
+
+
+def test_slow_subscriber_is_dropped(tmp_path):
+    srv = start(tmp_path, _behind=64 * 1024)
+    slow = Client(srv.sock_name)
+    slow.call({"command": "subscribe", "topics": ["big"]})
+    event = {"data": "x" * 10000}
+    # the subscriber reads nothing until the socket buffers and the
+    # transport's backlog are full
+    for _ in range(2000):
+        srv.publish("big", event)
+        if not srv._subs:
+            break
+        time.sleep(0.001)
+    assert wait_for(lambda: not srv._subs)
+    # everything queued before the drop still arrives, then the notice
+    line = slow.read()
+    while line != {"event": "dropped"}:
+        assert line["event"] == "big"
+        line = slow.read()
@@ -0,0 +1,137 @@
+import logging
+
+import pytest
+
+import megamaid.coordinator as coordinator
+from megamaid.coordinator import Coordinator, Worker
+
+
+class Clock:
+    # Stands in for the time module, so leases expire when the test says
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    retv = Clock()
+    monkeypatch.setattr(coordinator, "time", retv)
+    return retv
+
+
+def lease(coord, worker="w1", n=10):
+    return coord._lease(None, {"worker": worker, "max": n})
+
+
+def result(coord, reply, url, worker="w1", **kwargs):
+    data = dict(worker=worker, lease=reply["lease"], url=url, ok=True)
+    data.update(kwargs)
+    return coord._result(None, data)
+
+
+def test_lease_and_result(clock):
+    coord = Coordinator(pattern=[r".*\.iso$"], recursive=True, ttl=60)
+    coord.add("http://h/pub/")
+    reply = lease(coord)
+    assert [i["url"] for i in reply["items"]] == ["http://h/pub/"]
+    links = [["http://h/pub/a.iso", 1, None, True], ["http://h/pub/a.txt", 1, None, True]]
+    assert result(coord, reply, "http://h/pub/", sites=["http://h/pub/sub/"], links=links)
+    st = coord.stats()
+    assert (st.sites, st.links, st.matched, st.queued, st.leased) == (1, 2, 1, 2, 0)
+
+    # sites go out before fetches
+    reply = lease(coord)
+    assert [i["kind"] for i in reply["items"]] == ["site", "fetch"]
+    assert reply["items"][1]["size"] == 1
+    assert result(coord, reply, "http://h/pub/a.iso", bytes=1)["ok"]
+    assert result(coord, reply, "http://h/pub/sub/")["ok"]
+    assert lease(coord)["done"]
+
+
+def test_seen_urls_are_canonical(clock):
+    coord = Coordinator(recursive=True)
+    coord.add("http://h/pub/")
+    coord.add("HTTP://H:80/pub/./")
+    reply = lease(coord)
+    assert len(reply["items"]) == 1
+    links = [["http://h/pub/a", None, None, False], ["http://h/pub//a", None, None, False]]
+    result(coord, reply, "http://h/pub/", sites=["http://h:80/pub/"], links=links)
+    st = coord.stats()
+    assert (st.links, st.queued) == (1, 1)
+
+
+def test_expired_lease_is_handed_out_again(clock):
+    coord = Coordinator(ttl=60)
+    coord.add("http://h/a/")
+    coord.add("http://h/b/")
+    first = lease(coord, "w1", 1)
+    second = lease(coord, "w2", 1)
+
+    # w2 heartbeats its lease, w1 has gone quiet
+    clock.now += 40
+    coord._heartbeat(None, {"worker": "w2", "leases": [second["lease"]]})
+    clock.now += 40
+    coord._heartbeat(None, {"worker": "w2", "leases": [second["lease"]]})
+    st = coord.stats()
+    assert (st.expired, st.queued, st.leased) == (1, 1, 1)
+
+    again = lease(coord, "w3")
+    assert again["items"] == first["items"]
+    # w1's late result is turned away, w3 has the item now
+    assert result(coord, first, "http://h/a/") == {"ok": False, "error": "not leased"}
+    assert result(coord, again, "http://h/a/", worker="w3")["ok"]
+
+
+def test_heartbeat_only_extends_listed_leases(clock):
+    coord = Coordinator(ttl=60)
+    coord.add("http://h/a/")
+    coord.add("http://h/b/")
+    held = lease(coord, "w1", 1)
+    lost = lease(coord, "w1", 1)
+    for _ in range(3):
+        clock.now += 40
+        coord._heartbeat(None, {"worker": "w1", "leases": [held["lease"]]})
+    assert held["lease"] in coord._leases
+    assert lost["lease"] not in coord._leases
+    # nor can a worker extend someone else's lease
+    other = lease(coord, "w2", 1)
+    clock.now += 40
+    coord._heartbeat(None, {"worker": "w1", "leases": [other["lease"]]})
+    clock.now += 40
+    coord._heartbeat(None, {"worker": "w1", "leases": []})
+    assert other["lease"] not in coord._leases
+
+
+def test_failures_retry_then_give_up(clock):
+    coord = Coordinator(retries=1)
+    coord.add("http://h/a/")
+    for _ in range(2):
+        reply = lease(coord)
+        result(coord, reply, "http://h/a/", ok=False, error="boom")
+    st = coord.stats()
+    assert (st.retried, st.failed, st.queued) == (1, 1, 0)
+
+
+class DeadClient:
+
+    def __init__(self):
+        self.calls = 0
+
+    def call(self, command, **kwargs):
+        self.calls += 1
+        raise ConnectionRefusedError("refused")
+
+
+def test_report_gives_up_when_the_lease_has_expired(clock, monkeypatch):
+    worker = Worker(DeadClient(), None, logging.getLogger("test"), "w1")
+    worker._ttl = 60
+    monkeypatch.setattr(worker._stop, "wait", lambda secs: clock.sleep(secs))
+    assert worker._report({"lease": 1, "url": "http://h/a"}) is None
+    assert worker.client.calls == 13
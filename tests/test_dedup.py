@@ -0,0 +1,90 @@
+import pytest
+
+from megamaid.dedup import (
+    BloomFilter,
+    ListingGuard,
+    UrlSet,
+    canonical_url,
+    make_guard,
+    make_seen,
+)
+
+
+@pytest.mark.parametrize(
+    "url, canon",
+    [
+        ("HTTP://Example.COM:80/a/", "http://example.com/a/"),
+        ("https://h:443/a", "https://h/a"),
+        ("http://h:8080/a", "http://h:8080/a"),
+        ("http://h", "http://h/"),
+        ("http://h/a//b/./c/../d#frag", "http://h/a/b/d"),
+        ("http://h/a/b/../", "http://h/a/"),
+        ("http://h/a?x=1#y", "http://h/a?x=1"),
+        ("http://h/b c", "http://h/b%20c"),
+        ("http://h/%7euser/%41", "http://h/~user/A"),
+        ("http://h/caf%c3%a9", "http://h/caf%C3%A9"),
+        ("http://h/café", "http://h/caf%C3%A9"),
+        # reserved characters stay escaped, a%2Fb is one segment
+        ("http://h/a%2Fb", "http://h/a%2Fb"),
+        ("http://h/a%2fb/..", "http://h/"),
+        ("http://h/a%3Bb", "http://h/a%3Bb"),
+        ("http://h/100%", "http://h/100%25"),
+        ("http://h/%2E%2E/a", "http://h/a"),
+    ],
+)
+def test_canonical_url(url, canon):
+    assert canonical_url(url) == canon
+
+
+def test_escaped_slash_is_not_a_slash():
+    assert canonical_url("http://h/a%2Fb") != canonical_url("http://h/a/b")
+
+
+@pytest.mark.parametrize("cls", [UrlSet, lambda: BloomFilter(1000, 0.001)])
+def test_seen_sets(cls):
+    seen = cls()
+    assert seen.add("http://h/a")
+    assert not seen.add("HTTP://h:80/a#x")
+    assert seen.add("http://h/b")
+    assert "http://h//a" in seen
+    assert "http://h/c" not in seen
+    st = seen.stats()
+    assert (st.unique, st.hits) == (2, 1)
+    assert st.rate == pytest.approx(1 / 3)
+
+
+def test_bloom_error_rate():
+    bloom = BloomFilter(10000, 0.01)
+    for i in range(10000):
+        bloom.add(f"http://h/{i}")
+    false = sum(f"http://other/{i}" in bloom for i in range(10000))
+    assert false < 300
+    assert all(f"http://h/{i}" in bloom for i in range(0, 10000, 7))
+
+
+def test_make_seen():
+    assert type(make_seen("exact")) is UrlSet
+    assert type(make_seen("bloom", 100, 0.01)) is BloomFilter
+    assert make_seen("off") is None
+
+
+@pytest.mark.parametrize("mode", ["exact", "bloom"])
+def test_listing_guard(mode):
+    guard = make_guard(mode, 1000, 0.001)
+    assert guard.check("http://h/pub/", ["a", "b", "loop/"])
+    assert guard.check("http://h/pub/x/", ["c"])
+    # a symlink back up the tree lists the same entries, in any order
+    assert not guard.check("http://h/pub/loop/", ["loop/", "a", "b"])
+    assert not guard.check("http://h/pub/x/loop/", ["b", "a", "loop/"])
+    # the same entries elsewhere are fine
+    assert guard.check("http://h/other/", ["a", "b", "loop/"])
+    assert guard.check("http://mirror/pub/loop/", ["a", "b", "loop/"])
+
+
+def test_listing_guard_bloom_mode_keeps_no_dict():
+    guard = make_guard("bloom", 1000, 0.001)
+    assert isinstance(guard._bloom, BloomFilter)
+    guard.check("http://h/pub/", ["a"])
+    assert guard._prints == {}
+    assert type(make_guard("exact")) is ListingGuard
+    assert make_guard("off") is None
@@ -0,0 +1,96 @@
+import logging
+from queue import Queue
+
+from megamaid.grabber import LinkFilter, LinkParser
+from megamaid.listing import LinkRecord
+
+
+def parser(recursive=True):
+    p = LinkParser()
+    p.site = "http://h/pub"
+    p.site_q = Queue()
+    p.link_q = Queue()
+    p.log_q = logging.getLogger("test")
+    p.gui_q = Queue()
+    p.recursive = recursive
+    return p
+
+
+def feed(p, page, chunk=1000):
+    for i in range(0, len(page), chunk):
+        p.parse(page[i : i + chunk])
+    p.close()
+    return list(p.link_q.queue), list(p.site_q.queue)
+
+
+def table(rows, td='<td align="right">'):
+    head = '<html><h1>Index of /pub</h1><table><tr><th><a href="?C=N;O=D">Name</a></th></tr>\n'
+    body = "".join(
+        f'<tr><td><a href="f{i}.bin">f{i}.bin</a></td>{td}2024-01-31 12:00 </td>'
+        f"{td}{i}</td></tr>\n"
+        for i in range(rows)
+    )
+    return (head + body + '<tr><td><a href="sub/">sub/</a></td></tr>\n</table>').encode()
+
+
+def test_fast_path():
+    links, sites = feed(parser(), table(200))
+    assert len(links) == 200
+    assert links[5] == LinkRecord("http://h/pub/f5.bin", 5, 1706702400, True)
+    # sub/ has no date or size columns, so the fast path doesn't see it
+    assert sites == []
+
+
+def test_html_fallback_when_no_rows_match():
+    p = parser()
+    # detected as an Apache table, but the columns aren't laid out as one
+    links, sites = feed(p, table(200, td='<td class="r">'))
+    assert p.format == ""
+    assert len(links) == 200
+    assert links[0] == LinkRecord("http://h/pub/f0.bin", None, None, False)
+    assert sites == ["http://h/pub/sub/"]
+
+
+def test_short_page_fallback():
+    links, _ = feed(parser(), table(2, td="<td>"), chunk=100000)
+    assert [r.url for r in links] == ["http://h/pub/f0.bin", "http://h/pub/f1.bin"]
+
+
+def test_plain_html():
+    page = b'<html><a href="x.iso">x</a> <a href="?C=N">s</a> <a href="d/">d</a></html>'
+    links, sites = feed(parser(), page)
+    assert [r.url for r in links] == ["http://h/pub/x.iso"]
+    assert sites == ["http://h/pub/d/"]
+
+
+class Jobs:
+    # A job store that can't record one link
+
+    def matched(self, url):
+        if url.endswith("/bad"):
+            raise OSError("disk full")
+
+    def skipped(self, url):
+        pass
+
+
+def test_link_filter_survives_a_bad_link():
+    link_q, fetch_q = Queue(), Queue()
+    f = LinkFilter(
+        link_q,
+        fetch_q,
+        logging.getLogger("test"),
+        Queue(),
+        Queue(),
+        [r".*\.iso$", r".*/bad"],
+        jobs=Jobs(),
+        idle=0.2,
+    )
+    for url in ("http://h/a.iso", "http://h/bad", "http://h/b.txt", "http://h/c.iso"):
+        link_q.put(url)
+    f.start()
+    link_q.join()
+    f.join(5)
+    assert not f.is_alive()
+    assert f.processed == 4
+    assert [r.url for r in fetch_q.queue] == ["http://h/a.iso", "http://h/c.iso"]
@@ -0,0 +1,68 @@
+import sqlite3
+
+from megamaid.jobstore import JobStore
+
+
+def record(jobs):
+    jobs.site("http://h/")
+    jobs.site("http://h/sub/")
+    jobs.site_done("http://h/")
+    for name in "abcd":
+        jobs.link(f"http://h/{name}")
+    jobs.matched("http://h/a")
+    jobs.matched("http://h/b")
+    jobs.fetched("http://h/b")
+    jobs.skipped("http://h/c")
+
+
+def test_resume(tmp_path):
+    path = str(tmp_path / "job.db")
+    jobs = JobStore(path)
+    record(jobs)
+    # seeing a link again doesn't undo its progress
+    jobs.link("http://h/b")
+    jobs.site("http://h/")
+    jobs.close()
+
+    jobs = JobStore(path)
+    pending = jobs.pending()
+    assert pending.sites == ["http://h/sub/"]
+    assert pending.links == ["http://h/d"]
+    assert pending.matched == ["http://h/a"]
+    assert sorted(jobs.known("sites")) == ["http://h/", "http://h/sub/"]
+    assert len(list(jobs.known("links"))) == 4
+    st = jobs.stats()
+    assert st.sites == {"queued": 1, "done": 1}
+    assert st.links == {"queued": 1, "matched": 1, "fetched": 1, "skipped": 1}
+    jobs.close()
+
+
+def test_reset(tmp_path):
+    path = str(tmp_path / "job.db")
+    jobs = JobStore(path)
+    record(jobs)
+    jobs.close()
+    jobs = JobStore(path, reset=True)
+    assert jobs.pending() == {"sites": [], "links": [], "matched": []}
+    jobs.close()
+
+
+def test_failed_batch_is_counted_and_writer_survives(tmp_path):
+    path = str(tmp_path / "job.db")
+    jobs = JobStore(path)
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TRIGGER refuse BEFORE INSERT ON links WHEN NEW.url = 'bad' "
+        "BEGIN SELECT RAISE(ABORT, 'refused'); END"
+    )
+    db.commit()
+    db.close()
+
+    jobs.link("bad")
+    jobs.flush()
+    jobs.link("http://h/later")
+    st = jobs.stats()
+    assert st.lost == 1
+    assert st.links.queued == 1
+    assert list(jobs.known("links")) == ["http://h/later"]
+    jobs.close()
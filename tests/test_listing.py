@@ -0,0 +1,158 @@
+import os
+import calendar
+
+from megamaid.listing import (
+    FtpEntry,
+    LinkRecord,
+    ListEntry,
+    as_record,
+    detect_format,
+    extract,
+    is_current,
+    parse_list,
+    parse_mlsd,
+    parse_modified,
+    parse_mtime,
+    parse_size,
+)
+
+APACHE_TABLE = b"""<html><head><title>Index of /pub</title></head><body>
+<h1>Index of /pub</h1>
+<table>
+<tr><th><a href="?C=N;O=D">Name</a></th><th><a href="?C=M;O=A">Last modified</a></th></tr>
+<tr><td valign="top"></td><td><a href="/">Parent Directory</a></td><td>&nbsp;</td><td align="right">  - </td></tr>
+<tr><td valign="top"></td><td><a href="a.iso">a.iso</a></td><td align="right">2024-01-31 12:00  </td><td align="right">1.2G</td></tr>
+<tr><td valign="top"></td><td><a href="b%20c.txt">b c.txt</a></td><td align="right">2024-02-01 08:30  </td><td align="right">123</td></tr>
+<tr><td valign="top"></td><td><a href="sub/">sub/</a></td><td align="right">2024-02-01 08:30  </td><td align="right">  - </td></tr>
+</table></body></html>
+"""
+
+NGINX = b"""<html><head><title>Index of /pub/</title></head><body>
+<h1>Index of /pub/</h1><hr><pre><a href="../">../</a>
+<a href="sub/">sub/</a>                                               31-Jan-2024 12:00       -
+<a href="a.tar.gz">a.tar.gz</a>                                           01-Feb-2024 08:30    4096
+</pre><hr></body></html>
+"""
+
+LIGHTTPD = b"""<html><body><div class="list"><table>
+<tr><td class="n"><a href="a.bin">a.bin</a></td><td class="m">2024-Jan-31 12:00:00</td><td class="s">2.0K</td><td class="t">application/octet-stream</td></tr>
+</table></div></body></html>
+"""
+
+
+def test_detect_format():
+    assert detect_format(APACHE_TABLE) == "apache-table"
+    assert detect_format(NGINX) == "pre"
+    assert detect_format(LIGHTTPD) == "lighttpd"
+    assert detect_format(b"<html><a href='x'>x</a></html>") is None
+
+
+def test_extract_apache_table():
+    entries = extract(APACHE_TABLE, "apache-table")
+    assert [e.href for e in entries] == ["a.iso", "b%20c.txt", "sub/"]
+    iso, txt, sub = entries
+    assert iso == ListEntry(
+        "a.iso", int(1.2 * 1024**3), calendar.timegm((2024, 1, 31, 12, 0, 0)), False
+    )
+    assert (txt.size, txt.exact) == (123, True)
+    assert sub.size is None
+
+
+def test_extract_pre():
+    entries = extract(NGINX, "pre")
+    assert [e.href for e in entries] == ["sub/", "a.tar.gz"]
+    assert entries[1].size == 4096
+    assert entries[1].mtime == calendar.timegm((2024, 2, 1, 8, 30, 0))
+
+
+def test_extract_lighttpd():
+    (entry,) = extract(LIGHTTPD, "lighttpd")
+    assert entry == ListEntry("a.bin", 2048, calendar.timegm((2024, 1, 31, 12, 0, 0)), False)
+
+
+def test_extract_unescapes_hrefs():
+    row = b'<a href="a&amp;b">a&amp;b</a>   2024-01-31 12:00    1\n'
+    assert extract(row, "pre")[0].href == "a&b"
+
+
+def test_parse_size():
+    assert parse_size(b"123") == (123, True)
+    assert parse_size(b"1K") == (1024, False)
+    assert parse_size(b" - ") == (None, False)
+    assert parse_size(b"&nbsp;") == (None, False)
+    assert parse_size(b"junk") == (None, False)
+
+
+def test_parse_mtime():
+    stamp = calendar.timegm((2024, 1, 31, 12, 0, 0))
+    assert parse_mtime(b"2024-01-31 12:00") == stamp
+    assert parse_mtime(b"31-Jan-2024 12:00") == stamp
+    assert parse_mtime(b"2024-Jan-31 12:00:00") == stamp
+    assert parse_mtime(b"yesterday") is None
+    assert parse_mtime(b"2024-Foo-31 12:00") is None
+
+
+def test_parse_modified():
+    stamp = calendar.timegm((2024, 1, 31, 12, 0, 5))
+    assert parse_modified("20240131120005") == stamp
+    assert parse_modified("20240131120005.123") == stamp
+    assert parse_modified("Wed, 31 Jan 2024 12:00:05 GMT") == stamp
+    assert parse_modified("") is None
+    assert parse_modified("garbage") is None
+
+
+def test_parse_mlsd():
+    facts = {"type": "file", "size": "10", "modify": "20240131120000"}
+    assert parse_mlsd("a", facts) == FtpEntry(
+        "a", "file", 10, calendar.timegm((2024, 1, 31, 12, 0, 0))
+    )
+    assert parse_mlsd("d", {"type": "dir"}) == FtpEntry("d", "dir", None, None)
+    assert parse_mlsd("l", {"type": "OS.unix=symlink"}).kind == "link"
+    assert parse_mlsd(".", {"type": "cdir"}) is None
+    assert parse_mlsd("..", {"type": "pdir"}) is None
+
+
+def test_parse_list_unix():
+    now = calendar.timegm((2024, 3, 1, 0, 0, 0))
+    line = "-rw-r--r--   1 ftp      ftp          1234 Jan 31 12:00 a file.txt"
+    assert parse_list(line, now) == FtpEntry(
+        "a file.txt", "file", 1234, calendar.timegm((2024, 1, 31, 12, 0, 0))
+    )
+    # no group column, and a date from last year
+    line = "drwxr-xr-x   2 ftp 4096 Dec 31 23:00 sub"
+    entry = parse_list(line, now)
+    assert (entry.kind, entry.size) == ("dir", None)
+    assert entry.mtime == calendar.timegm((2023, 12, 31, 23, 0, 0))
+    line = "lrwxrwxrwx   1 ftp ftp 4 Jan  1  2020 latest -> v2"
+    assert parse_list(line, now) == FtpEntry(
+        "latest", "link", None, calendar.timegm((2020, 1, 1, 0, 0, 0))
+    )
+    assert parse_list("total 12", now) is None
+    assert parse_list("drwxr-xr-x 2 ftp ftp 4096 Jan 31 12:00 ..", now) is None
+
+
+def test_parse_list_dos():
+    entry = parse_list("01-31-24  01:05PM                 1234 a.txt")
+    assert entry == FtpEntry(
+        "a.txt", "file", 1234, calendar.timegm((2024, 1, 31, 13, 5, 0))
+    )
+    assert parse_list("01-31-2024  12:00AM       <DIR>          sub").kind == "dir"
+
+
+def test_as_record():
+    rec = LinkRecord("http://h/a", 1, 2, True)
+    assert as_record(rec) is rec
+    assert as_record("http://h/a") == LinkRecord("http://h/a", None, None, False)
+    assert as_record(True) is None
+
+
+def test_is_current(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"x" * 10)
+    os.utime(path, (1000, 1000))
+    assert is_current(LinkRecord("u", 10, 1000, True), path) is True
+    assert is_current(LinkRecord("u", 10, 1000 + 30, True), path) is True
+    assert is_current(LinkRecord("u", 10, 1000 + 3600, True), path) is False
+    assert is_current(LinkRecord("u", 11, 1000, True), path) is False
+    assert is_current(LinkRecord("u", 10, 1000, False), path) is None
+    assert is_current(LinkRecord("u", None, None, False), path) is None
@@ -0,0 +1,45 @@
+import json
+
+from megamaid.manifest import Manifest
+
+
+def test_replay_last_entry_wins(tmp_path):
+    m = Manifest(str(tmp_path))
+    m.set("a", url="http://h/a", etag='"1"', modified=None, size=1, checked=10)
+    m.set("a", url="http://h/a", etag='"2"', modified=None, size=2, checked=20)
+    m.touch("a", 30)
+    m.touch("missing", 30)
+    m.close()
+
+    m = Manifest(str(tmp_path))
+    assert m.get("a") == dict(
+        url="http://h/a", etag='"2"', modified=None, size=2, checked=30
+    )
+    assert m.get("missing") is None
+    m.close()
+
+
+def test_torn_write_is_skipped(tmp_path):
+    path = tmp_path / Manifest.FILE_NAME
+    path.write_text(json.dumps({"path": "a", "size": 1}) + '\n{"path": "b", "si')
+    m = Manifest(str(tmp_path))
+    assert m.get("a") == {"size": 1}
+    assert m.get("b") is None
+    m.close()
+
+
+def test_compacts_rewritten_journal(tmp_path):
+    path = tmp_path / Manifest.FILE_NAME
+    with open(path, "w") as fp:
+        for i in range(2000):
+            fp.write(json.dumps({"path": "a", "size": i}) + "\n")
+    m = Manifest(str(tmp_path))
+    m.close()
+    assert path.read_text().splitlines() == [json.dumps({"path": "a", "size": 1999})]
+
+
+def test_open_is_shared(tmp_path):
+    try:
+        assert Manifest.open(str(tmp_path)) is Manifest.open(str(tmp_path))
+    finally:
+        Manifest.close_all()
@@ -0,0 +1,63 @@
+import re
+
+import pytest
+
+from megamaid.matcher import LinkMatcher, suffixes
+
+
+@pytest.mark.parametrize(
+    "pattern, expected",
+    [
+        (r".*\.iso$", ((".iso",), True)),
+        (r"^.*\.(iso|img)$", ((".iso", ".img"), True)),
+        (r".*install[0-9]+\.(?:iso|img)$", ((".iso", ".img"), False)),
+        (r".*-[0-9]+\.tar\.gz$", ((".tar.gz",), False)),
+        (r".*\.iso", (None, False)),
+        (r"a$|b$", (None, False)),
+        (r"(?i).*\.iso$", (None, False)),
+        (r".*\$", (None, False)),
+        (r".*[0-9]$", (None, False)),
+    ],
+)
+def test_suffixes(pattern, expected):
+    assert suffixes(pattern) == expected
+
+
+LINKS = [
+    "http://h/pub/a.iso",
+    "http://h/pub/a.ISO",
+    "http://h/pub/install12.img",
+    "http://h/pub/installx.img",
+    "http://h/pub/b-1.tar.gz",
+    "http://h/pub/b.tar.gz",
+    "http://h/pub/readme.txt",
+    "http://h/pub/iso/readme",
+    "http://h/pub/a.iso.sig",
+]
+
+PATTERNS = [
+    [r".*\.iso$"],
+    [r".*\.(iso|img)$", r".*-[0-9]+\.tar\.gz$"],
+    [r".*install[0-9]+\.(iso|img)$", r".*/iso/.*"],
+    [r"(?i).*\.iso$"],
+    [r"(a)\1", r".*readme.*"],
+    [r"http://h/pub/[ab]"],
+]
+
+
+@pytest.mark.parametrize("patterns", PATTERNS)
+@pytest.mark.parametrize("excludes", [[], [r".*\.sig$"], [r".*/b.*", r".*\.txt$"]])
+def test_matches_like_re_match(patterns, excludes):
+    # the fast paths must agree with trying every regex in turn
+    matcher = LinkMatcher(patterns, excludes)
+    for link in LINKS:
+        want = any(re.match(p, link) for p in patterns) and not any(
+            re.match(p, link) for p in excludes
+        )
+        assert matcher(link) == want, link
+
+
+def test_no_patterns_match_everything():
+    matcher = LinkMatcher()
+    assert all(matcher.match(link) for link in LINKS)
+    assert not LinkMatcher(False, [".*"]).match(LINKS[0])
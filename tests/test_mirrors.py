@@ -0,0 +1,75 @@
+from types import SimpleNamespace
+
+import pytest
+
+import megamaid.mirrors as mirrors
+from megamaid.mirrors import MAX_BACKOFF, Mirrors, parse_group
+
+A, B, C = "http://a/pub/", "https://b/mirror/", "ftp://c/pub/"
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    retv = SimpleNamespace(now=1000.0)
+    retv.monotonic = lambda: retv.now
+    monkeypatch.setattr(mirrors, "time", retv)
+    return retv
+
+
+def test_parse_group():
+    assert parse_group(["http://a/pub", B]) == (A, B)
+    with pytest.raises(ValueError):
+        parse_group([A])
+    with pytest.raises(ValueError):
+        parse_group([A, "rsync://c/pub/"])
+
+
+def test_canonical_and_claim():
+    m = Mirrors([[A, B, C]])
+    assert m.canonical(f"{B}x/y.iso") == f"{A}x/y.iso"
+    assert m.canonical("http://other/y.iso") == "http://other/y.iso"
+    assert m.claim(f"{C}x/y.iso")
+    assert not m.claim(f"{A}x/y.iso")
+    assert m.claim(f"{B}x/z.iso")
+
+
+def test_untried_mirrors_first_then_fastest(clock):
+    m = Mirrors([[A, B, C]])
+    m.record(A, 1000, 1.0)
+    m.record(C, 5000, 1.0)
+    # B was never measured
+    assert [b for b, _ in m.candidates(f"{A}f")] == [B, C, A]
+    m.record(B, 100, 1.0)
+    assert m.candidates(f"{A}f")[0] == (C, f"{C}f")
+    assert [b for b, _ in m.candidates(f"{A}f", ("http", "https"))] == [A, B]
+    assert m.candidates("http://other/f") == [(None, "http://other/f")]
+
+
+def test_failures_back_off(clock):
+    m = Mirrors([[A, B]])
+    m.record(A, 10000, 1.0)
+    m.record(B, 1000, 1.0)
+    m.failed(A)
+    assert m.candidates(f"{A}f")[0][0] == B
+    clock.now += 2.1
+    # back, but its error rate still costs it
+    assert m.stats()[A].errors == pytest.approx(0.3)
+    assert m.candidates(f"{A}f")[0][0] == A
+    for _ in range(20):
+        m.failed(A)
+    # sitting out never lasts longer than MAX_BACKOFF
+    clock.now += MAX_BACKOFF - 1
+    assert m._score(A, clock.now) == -1
+    clock.now += 1.1
+    assert m._score(A, clock.now) >= 0
+
+
+def test_speed_average():
+    m = Mirrors([[A, B]], alpha=0.5)
+    m.record(A, 1000, 1.0)
+    m.record(A, 3000, 1.0)
+    m.failed(A, 0, 0.0)
+    st = m.stats()[A]
+    assert (st.speed, st.ok, st.failed, st.bytes) == (2000, 2, 1, 4000)
+    m.record(None, 1, 1)
+    m.failed(None)
@@ -0,0 +1,141 @@
+import os
+import hashlib
+import threading
+
+import pytest
+
+from megamaid.objstore import HashingWriter, ObjectStore, hash_file
+
+
+def sha(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def fetched(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as fp:
+        fp.write(data)
+    return str(path)
+
+
+@pytest.fixture
+def store(tmp_path):
+    retv = ObjectStore(str(tmp_path / "store"))
+    yield retv
+    retv.close()
+
+
+def test_hash_file(tmp_path):
+    path = fetched(tmp_path / "f", b"x" * 3000000)
+    assert hash_file(path, 4096) == sha(b"x" * 3000000)
+
+
+def test_hashing_writer(tmp_path):
+    path = str(tmp_path / "f")
+    with open(path, "ab") as fp:
+        w = HashingWriter(fp)
+        w.write(b"hello ")
+        w.write(b"world")
+        assert w.digest() == sha(b"hello world")
+
+
+def test_hashing_writer_resume(tmp_path):
+    path = fetched(tmp_path / "f", b"hello ")
+    with open(path, "ab") as fp:
+        w = HashingWriter(fp)
+        assert w.seek(6) == 6
+        w.write(b"world")
+        assert w.digest(False) == sha(b"hello world")
+
+
+def test_hashing_writer_falls_back_to_disk(tmp_path):
+    path = str(tmp_path / "f")
+    with open(path, "ab") as fp:
+        w = HashingWriter(fp)
+        w.write(b"hello")
+        fp.flush()
+        # a segmented download writes at offsets, around the writer
+        fd = os.open(path, os.O_WRONLY)
+        os.pwrite(fd, b" world", 5)
+        os.close(fd)
+        assert w.digest(False) is None
+        assert w.digest() == sha(b"hello world")
+
+
+def test_add_and_dedup(store, tmp_path):
+    data = b"same content"
+    digest = sha(data)
+    first = fetched(tmp_path / "m1" / "a", data)
+    assert store.add(first, digest, "http://one/a", mtime=1, etag='"e"') is False
+    obj = store.path(digest)
+    assert os.path.samefile(first, obj)
+
+    second = fetched(tmp_path / "m2" / "b", data)
+    assert store.add(second, digest, "http://two/b") is True
+    assert os.path.samefile(second, obj)
+    assert open(second, "rb").read() == data
+
+    st = store.stats()
+    assert (st.stored, st.deduped, st.saved) == (1, 1, len(data))
+    assert (st.objects, st.bytes, st.urls) == (1, len(data), 2)
+    assert store.lookup("http://one/a") == dict(
+        digest=digest, size=len(data), mtime=1, etag='"e"', modified=None
+    )
+
+
+def test_materialize_and_forget(store, tmp_path):
+    data = b"stored once"
+    digest = sha(data)
+    store.add(fetched(tmp_path / "m1" / "a", data), digest, "http://one/a")
+    target = str(tmp_path / "m3" / "a")
+    os.makedirs(os.path.dirname(target))
+    assert store.materialize(digest, target)
+    assert open(target, "rb").read() == data
+    assert store.stats().recalled == 1
+    assert not store.materialize(sha(b"never stored"), target)
+
+    store.forget("http://one/a")
+    assert store.lookup("http://one/a") is None
+    assert os.path.isfile(store.path(digest))
+
+
+def test_concurrent_adds_of_the_same_content(store, tmp_path):
+    data = os.urandom(100000)
+    digest = sha(data)
+    paths = [fetched(tmp_path / f"m{i}" / "f", data) for i in range(8)]
+    start = threading.Barrier(len(paths))
+    errors = []
+
+    def add(i):
+        start.wait()
+        try:
+            store.add(paths[i], digest, f"http://m{i}/f")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=add, args=(i,)) for i in range(len(paths))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert errors == []
+    st = store.stats()
+    assert (st.stored, st.deduped, st.objects) == (1, 7, 1)
+    assert all(os.path.samefile(p, store.path(digest)) for p in paths)
+    assert not [f for f in os.listdir(os.path.dirname(store.path(digest))) if "." in f]
+
+
+def test_reflink_or_copy(tmp_path):
+    store = ObjectStore(str(tmp_path / "store"), "reflink")
+    data = b"reflinked"
+    path = fetched(tmp_path / "m1" / "a", data)
+    store.add(path, sha(data), "http://one/a")
+    # whether or not the filesystem can reflink, the two are separate files
+    assert not os.path.samefile(path, store.path(sha(data)))
+    assert open(store.path(sha(data)), "rb").read() == data
+    store.close()
+
+
+def test_unknown_link_mode(tmp_path):
+    with pytest.raises(ValueError):
+        ObjectStore(str(tmp_path / "store"), "symlink")
@@ -0,0 +1,117 @@
+import threading
+
+import pytest
+
+import megamaid.pool as pool
+from megamaid.pool import ConnectionPool, FtpPool
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+
+class Conn:
+
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+    def quit(self):
+        self.closed = True
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    retv = Clock()
+    monkeypatch.setattr(pool, "time", retv)
+    return retv
+
+
+@pytest.fixture
+def http(clock, monkeypatch):
+    retv = ConnectionPool(maxsize=2, idle=10)
+    monkeypatch.setattr(retv, "connect", lambda key, proxy=None: Conn())
+    return retv
+
+
+def test_reuse(http):
+    key = ("http", "h", 80, None)
+    conn, reused = http.acquire(key)
+    assert not reused
+    http.release(key, conn)
+    assert http.acquire(key) == (conn, True)
+    # other hosts don't get it
+    assert http.acquire(("http", "other", 80, None))[0] is not conn
+
+
+def test_idle_cap(http):
+    key = ("http", "h", 80, None)
+    conns = [http.acquire(key)[0] for _ in range(3)]
+    for conn in conns:
+        http.release(key, conn)
+    assert [c.closed for c in conns] == [False, False, True]
+    st = http.stats()
+    assert (st.idle, st.discarded) == (2, 1)
+
+
+def test_stale_connection_not_handed_out(http, clock):
+    key = ("http", "h", 80, None)
+    conn, _ = http.acquire(key)
+    http.release(key, conn)
+    clock.now += 11
+    fresh, reused = http.acquire(key)
+    assert conn.closed and not reused and fresh is not conn
+    assert http.stats().evicted == 1
+
+
+def test_release_sweeps_stale_connections(http, clock):
+    old = ("http", "old", 80, None)
+    new = ("http", "new", 80, None)
+    conn, _ = http.acquire(old)
+    http.release(old, conn)
+    clock.now += 5
+    http.release(new, http.acquire(new)[0])
+    assert not conn.closed
+    clock.now += 6
+    http.release(new, http.acquire(new)[0])
+    assert conn.closed
+    st = http.stats()
+    assert (st.evicted, st.idle) == (1, 1)
+    assert old not in http._pool
+
+
+@pytest.fixture
+def ftp(clock, monkeypatch):
+    retv = FtpPool(maxsize=2, idle=60, probe=5, limit=1)
+    monkeypatch.setattr(retv, "connect", lambda key, password=None: Conn())
+    return retv
+
+
+def test_ftp_limit_waits_for_a_release(ftp):
+    key = ("h", 21, "anonymous")
+    first, _ = ftp.acquire(key)
+    got = []
+    t = threading.Thread(target=lambda: got.append(ftp.acquire(key)))
+    t.start()
+    t.join(0.2)
+    assert t.is_alive() and not got
+    ftp.release(key, first)
+    t.join(5)
+    assert got == [(first, True)]
+    assert ftp.stats().waited == 1
+
+
+def test_ftp_discard_frees_the_slot(ftp):
+    key = ("h", 21, "anonymous")
+    first, _ = ftp.acquire(key)
+    ftp.discard(first)
+    second, reused = ftp.acquire(key)
+    assert second is not first and not reused
+    assert ftp.stats().open == 1
@@ -0,0 +1,83 @@
+from types import SimpleNamespace
+
+import pytest
+
+import megamaid.pqueue as pqueue
+from megamaid.listing import LinkRecord
+from megamaid.pqueue import FetchPriority, PriorityFetchQueue, parse_weight
+
+
+def drain(q):
+    retv = []
+    while not q.empty():
+        item = q.get()
+        retv.append(item.url if isinstance(item, LinkRecord) else item)
+    return retv
+
+
+def fill(q, sizes):
+    for name, size in sizes:
+        q.put(LinkRecord(f"http://h/{name}", size, None, size is not None))
+
+
+SIZES = [("mid", 5000), ("big", 10**9), ("tiny", 10), ("unknown", None)]
+
+
+def test_parse_weight():
+    assert parse_weight(r".*SHA256$=10") == (r".*SHA256$", 10.0)
+    assert parse_weight("a=b=-1.5") == ("a=b", -1.5)
+    with pytest.raises(ValueError):
+        parse_weight("=3")
+
+
+def test_fifo():
+    q = PriorityFetchQueue()
+    fill(q, SIZES)
+    assert drain(q) == [f"http://h/{n}" for n, _ in SIZES]
+    assert not q.needs_size
+
+
+def test_smallest_and_largest():
+    q = PriorityFetchQueue(FetchPriority("smallest", aging=0))
+    fill(q, SIZES)
+    # unknown sizes rank as 1 MiB
+    assert drain(q) == ["http://h/tiny", "http://h/mid", "http://h/unknown", "http://h/big"]
+    q = PriorityFetchQueue(FetchPriority("largest", aging=0))
+    fill(q, SIZES)
+    assert drain(q) == ["http://h/big", "http://h/unknown", "http://h/mid", "http://h/tiny"]
+
+
+def test_weights_move_links_ahead():
+    prio = FetchPriority("smallest", [(r".*big$", 30), (r".*", -100)], aging=0)
+    q = PriorityFetchQueue(prio)
+    fill(q, SIZES)
+    # only the first matching pattern counts
+    assert drain(q)[0] == "http://h/big"
+
+
+def test_bare_urls_and_tokens():
+    q = PriorityFetchQueue(FetchPriority("smallest", aging=0))
+    q.put(LinkRecord("http://h/a", 10**7, None, True))
+    q.put("http://h/b")
+    q.put(True)
+    assert drain(q) == [True, "http://h/b", "http://h/a"]
+
+
+def test_aging(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(pqueue, "time", SimpleNamespace(monotonic=lambda: now[0]))
+    q = PriorityFetchQueue(FetchPriority("smallest", aging=10))
+    fill(q, [("big", 2**20 - 1)])
+    # a link 20 ranks smaller still waits for the big one, after 200s
+    now[0] += 201
+    fill(q, [("small", 0)])
+    assert drain(q) == ["http://h/big", "http://h/small"]
+    fill(q, [("big", 2**20 - 1)])
+    now[0] += 199
+    fill(q, [("small", 0)])
+    assert drain(q) == ["http://h/small", "http://h/big"]
+
+
+def test_unknown_policy():
+    with pytest.raises(ValueError):
+        FetchPriority("random")
@@ -0,0 +1,106 @@
+import os
+import threading
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from megamaid.segment import SegmentError, SegmentedDownload, completed, plan
+
+DATA = bytes(range(256)) * 1024
+
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    ranges = True
+
+    def do_GET(self):
+        rng = self.headers.get("Range")
+        if rng and self.ranges:
+            start, end = (int(x) for x in rng[len("bytes=") :].split("-"))
+            body = DATA[start : end + 1]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end}/{len(DATA)}")
+        else:
+            body = DATA
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # an aborted download hangs up mid-body
+        pass
+
+
+@pytest.fixture
+def server():
+    srv = Server(("127.0.0.1", 0), RangeHandler)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{srv.server_address[1]}/f"
+    srv.shutdown()
+    srv.server_close()
+    RangeHandler.ranges = True
+
+
+def test_plan():
+    assert plan(100, 4, 10) == [[0, 25, 0], [25, 50, 25], [50, 75, 50], [75, 100, 75]]
+    # never smaller than the minimum, never fewer than one
+    assert plan(100, 8, 40) == [[0, 50, 0], [50, 100, 50]]
+    assert plan(5, 4, 10) == [[0, 5, 0]]
+    segs = plan(1001, 3, 1)
+    assert segs[0][0] == 0 and segs[-1][1] == 1001
+    assert all(a[1] == b[0] for a, b in zip(segs, segs[1:]))
+
+
+def test_completed():
+    assert completed([[0, 10, 4], [10, 20, 20], [20, 30, 20]]) == 14
+
+
+def test_segmented_download(server, tmp_path):
+    path = str(tmp_path / "f.part")
+    segments = plan(len(DATA), 4, 1)
+    seen = []
+    dl = SegmentedDownload(
+        server, path, len(DATA), '"v1"', segments, 4096, checkpoint=seen.append
+    )
+    dl.run()
+    assert open(path, "rb").read() == DATA
+    assert completed(segments) == len(DATA)
+    assert seen[-1] is segments
+
+
+def test_resumes_unfinished_ranges(server, tmp_path):
+    path = str(tmp_path / "f.part")
+    segments = plan(len(DATA), 4, 1)
+    # the first half of each range is already on disk
+    with open(path, "wb") as fp:
+        fp.write(bytes(len(DATA)))
+        for seg in segments:
+            half = (seg[1] - seg[0]) // 2
+            fp.seek(seg[0])
+            fp.write(DATA[seg[0] : seg[0] + half])
+            seg[2] = seg[0] + half
+    got = []
+    dl = SegmentedDownload(
+        server, path, len(DATA), None, segments, progress=lambda n, t: got.append(n)
+    )
+    dl.run()
+    assert open(path, "rb").read() == DATA
+    assert sum(got) == len(DATA) // 2
+
+
+def test_ranges_ignored(server, tmp_path):
+    RangeHandler.ranges = False
+    dl = SegmentedDownload(
+        server, str(tmp_path / "f.part"), len(DATA), None, plan(len(DATA), 2, 1)
+    )
+    with pytest.raises(SegmentError):
+        dl.run()
@@ -0,0 +1,97 @@
+import json
+import socket
+import threading
+
+import pytest
+
+import megamaid.server as server
+from megamaid.server import SockServer, TcpServer
+
+
+def handlers(srv):
+    srv.add_handler("echo", lambda conn, data: {"echo": data.get("value")})
+    srv.add_handler("plain", lambda conn, data: None)
+    srv.add_handler("boom", lambda conn, data: 1 / 0)
+
+
+@pytest.fixture
+def sock(tmp_path):
+    srv = SockServer("pytest", path=str(tmp_path / "s.sock"))
+    handlers(srv)
+    threading.Thread(target=srv.run, daemon=True).start()
+    retv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    retv.settimeout(5)
+    retv.connect(srv.sock_name)
+    yield retv
+    retv.close()
+
+
+def lines(sock, n):
+    buf = b""
+    while buf.count(b"\n") < n:
+        chunk = sock.recv(65536)
+        if not chunk:
+            break
+        buf += chunk
+    return buf.split(b"\n")[:n]
+
+
+def test_add_handler(tmp_path):
+    srv = SockServer("pytest", path=str(tmp_path / "s.sock"))
+    assert srv.add_handler("a", lambda c, d: None)
+    assert not srv.add_handler("a", lambda c, d: None)
+    assert not srv.add_handler("b", "not callable")
+
+
+def test_requests(sock):
+    sock.sendall(
+        b'{"command": "echo", "value": 1}\n'
+        b'{"command": "plain"}\n'
+        b'{"command": "plain", "id": 7}\n'
+        b'{"command": "nope"}\n'
+        b'{"command": "boom"}\n'
+        b"not json\n"
+        b"[1]\n"
+    )
+    got = lines(sock, 7)
+    assert json.loads(got[0]) == {"echo": 1}
+    assert got[1] == b"OK"
+    assert json.loads(got[2]) == {"ok": True, "id": 7}
+    assert json.loads(got[3]) == {"error": "unknown command: nope"}
+    assert json.loads(got[4]) == {"error": "division by zero"}
+    assert json.loads(got[5])["error"].startswith("bad request")
+    assert json.loads(got[6]) == [{"error": "bad request: not an object"}]
+
+
+def test_batch_and_pipelining(sock):
+    batch = [{"command": "echo", "value": i, "id": i} for i in range(3)]
+    batch.append({"command": "plain"})
+    # a request split over several sends, then many in one
+    data = json.dumps(batch).encode() + b"\n"
+    sock.sendall(data[:5])
+    sock.sendall(data[5:])
+    sock.sendall(b"".join(b'{"command": "echo", "value": %d}\n' % i for i in range(500)))
+    got = lines(sock, 501)
+    assert json.loads(got[0]) == [
+        {"echo": 0, "id": 0},
+        {"echo": 1, "id": 1},
+        {"echo": 2, "id": 2},
+        {"ok": True},
+    ]
+    assert [json.loads(line)["echo"] for line in got[1:]] == list(range(500))
+
+
+def test_oversized_request_drops_the_client(sock, monkeypatch):
+    monkeypatch.setattr(server, "MAX_LINE", 1000)
+    sock.sendall(b"x" * 2000)
+    assert sock.recv(10) == b""
+
+
+def test_tcp():
+    srv = TcpServer("127.0.0.1", 0, "pytest")
+    handlers(srv)
+    threading.Thread(target=srv.run, daemon=True).start()
+    conn = socket.create_connection(srv._sock_file.getsockname(), 5)
+    conn.sendall(b'{"command": "echo", "value": "tcp", "id": "a"}\n')
+    assert json.loads(lines(conn, 1)[0]) == {"echo": "tcp", "id": "a"}
+    conn.close()
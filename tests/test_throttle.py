@@ -0,0 +1,104 @@
+import time
+
+import pytest
+
+import megamaid.throttle as throttle
+from megamaid.throttle import Throttle, TokenBucket, parse_rate, parse_schedule
+
+
+class Clock:
+    # Stands in for the time module, in the throttle only
+
+    def __init__(self):
+        self.now = 1000.0
+        self.hour = 12
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def localtime(self):
+        return time.struct_time((2024, 1, 1, self.hour, 0, 0, 0, 1, -1))
+
+    def sleep(self, secs):
+        self.slept += secs
+        self.now += secs
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    retv = Clock()
+    monkeypatch.setattr(throttle, "time", retv)
+    return retv
+
+
+def test_parse_rate():
+    assert parse_rate("0") == 0
+    assert parse_rate("512K") == 512 * 1024
+    assert parse_rate("1.5m") == int(1.5 * 1024**2)
+    assert parse_rate("2MB/s") == 2 * 1024**2
+    assert parse_rate("300B") == 300
+    assert parse_rate(100) == 100
+
+
+def test_parse_schedule():
+    assert parse_schedule("09:00-17:30=2M") == (540, 1050, 2 * 1024**2)
+    assert parse_schedule("22-6=0") == (1320, 360, 0)
+
+
+def test_bucket_debt():
+    bucket = TokenBucket(1000, burst=500)
+    assert bucket.reserve(1500, bucket.stamp) == pytest.approx(1.5)
+    # debt is paid back at the rate, then saving up stops at the burst
+    assert bucket.reserve(0, bucket.stamp + 1.5) == 0.0
+    assert bucket.reserve(500, bucket.stamp + 10) == 0.0
+    assert bucket.reserve(1000, bucket.stamp) == pytest.approx(1.0)
+    assert TokenBucket(0).reserve(10**9, 0) == 0.0
+
+
+def test_set_rate_keeps_balance():
+    bucket = TokenBucket(1000)
+    bucket.reserve(0, bucket.stamp + 5)
+    assert bucket.tokens == 1000
+    bucket.set_rate(100)
+    assert bucket.tokens == 100
+
+
+def test_global_and_host_caps(clock):
+    t = Throttle(rate=1000, host_rate=100, hosts={"fast": 500})
+    assert t.reserve("a", 200) == pytest.approx(2.0)
+    assert t.reserve("fast", 300) == pytest.approx(0.6)
+    assert t.reserve("fast", 500) == pytest.approx(1.6)
+    # the global bucket is shared, b's own cap isn't what holds it back
+    t.consume("b", 100)
+    assert clock.slept == pytest.approx(1.1)
+
+
+def test_unlimited_still_counts(clock):
+    t = Throttle()
+    assert t.reserve("a", 100) == 0.0
+    clock.now += 2
+    t.consume("a", 100)
+    assert clock.slept == 0
+    assert t.stats().a == {"bytes": 200, "rate": 100.0, "cap": 0}
+
+
+def test_set_rate_live(clock):
+    t = Throttle()
+    assert not t.limited
+    t.set_rate(100, "a")
+    assert t.limited
+    assert t.reserve("a", 100) == pytest.approx(1.0)
+    t.set_rate(0, "a")
+    assert t.reserve("a", 100) == 0.0
+
+
+def test_schedule(clock):
+    night = parse_schedule("22:00-06:00=0")
+    day = parse_schedule("06:00-22:00=100")
+    t = Throttle(rate=1000, schedule=[night, day])
+    assert t.reserve("a", 100) == pytest.approx(1.0)
+    # the schedule is looked at again every 30 seconds
+    clock.hour = 23
+    clock.now += 31
+    assert t.reserve("a", 100) == 0.0
@@ -0,0 +1,96 @@
+import json
+import threading
+
+import pytest
+
+import megamaid.trace as trace
+from megamaid.trace import Tracer, profile_summary, profiled, span
+
+
+@pytest.fixture
+def tracer():
+    retv = trace.start_trace()
+    yield retv
+    trace.stop_trace()
+
+
+def test_span_is_a_no_op_while_tracing_is_off():
+    assert trace.TRACER is None
+    with span("http_get", "net", url="http://x/") as sp:
+        sp.set(status=200)
+    assert span("other") is span("http_get")
+
+
+def test_spans_record_args_and_errors(tracer):
+    with span("http_get", "net", url="http://x/") as sp:
+        sp.set(status=200)
+    with pytest.raises(ValueError):
+        with span("parse", "parse"):
+            raise ValueError("bad")
+
+    events = [e for e in tracer.events() if e["ph"] == "X"]
+    assert [e["name"] for e in events] == ["http_get", "parse"]
+    assert events[0]["cat"] == "net"
+    assert events[0]["args"] == {"url": "http://x/", "status": 200}
+    assert events[1]["args"] == {"error": "ValueError"}
+    assert all(e["dur"] >= 0 and e["ts"] >= 0 for e in events)
+
+
+def test_stop_trace_hands_back_the_tracer(tracer):
+    assert trace.stop_trace() is tracer
+    assert trace.TRACER is None
+    assert trace.stop_trace() is None
+
+
+def test_limit_drops_extra_spans():
+    tracer = Tracer(limit=2)
+    for n in range(5):
+        tracer.add("get", "net", n, n + 10, {})
+    assert len(tracer.totals()) == 1
+    assert tracer.totals()["get"][0] == 2
+    assert tracer.dropped == 3
+
+
+def test_totals_sorted_by_time():
+    tracer = Tracer()
+    tracer.add("fast", "net", 0, 1000, {})
+    tracer.add("slow", "net", 0, 2 * 10**9, {})
+    tracer.add("fast", "net", 0, 1000, {})
+    assert list(tracer.totals().items()) == [("slow", (1, 2.0)), ("fast", (2, 2e-6))]
+
+
+def test_threads_are_named(tracer):
+    def _work():
+        with span("fetch", "net"):
+            pass
+
+    thread = threading.Thread(target=_work, name="fetcher")
+    thread.start()
+    thread.join()
+    names = [e["args"]["name"] for e in tracer.events() if e["name"] == "thread_name"]
+    assert names == ["fetcher"]
+
+
+def test_save_writes_chrome_json(tracer, tmp_path):
+    with span("write", "disk", bytes=10):
+        pass
+    tracer.dropped = 4
+    fname = tmp_path / "trace.json"
+    assert tracer.save(str(fname)) == 1
+
+    data = json.loads(fname.read_text())
+    assert data["otherData"] == {"dropped": 4}
+    assert data["traceEvents"][0]["name"] == "process_name"
+    assert data["traceEvents"][-1]["args"] == {"bytes": 10}
+
+
+def test_profiled_threads_are_summarized(tmp_path):
+    assert profile_summary(str(tmp_path)) is None
+    thread = profiled(threading.Thread(target=sum, args=([1, 2],)), str(tmp_path))
+    thread.start()
+    thread.join()
+    assert [p.name.startswith("Thread-") for p in tmp_path.glob("*.prof")] == [True]
+
+    summary = profile_summary(str(tmp_path))
+    with open(summary) as fp:
+        assert fp.readline().startswith("==== Thread: 1 thread(s)")
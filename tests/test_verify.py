@@ -0,0 +1,111 @@
+import hashlib
+import logging
+
+from queue import Queue
+
+import pytest
+
+import megamaid.verify as verify
+from megamaid.verify import Verifier, hash_path, is_checksum_file, parse_checksums
+
+MD5 = "d41d8cd98f00b204e9800998ecf8427e"
+SHA256 = "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://h/pub/SHA256",
+        "http://h/pub/MD5",
+        "http://h/pub/SHA256SUMS",
+        "http://h/pub/md5sums.txt",
+        "http://h/pub/SHA512SUMS.asc",
+        "http://h/pub/CHECKSUM.SHA256-FreeBSD-14.0-RELEASE-amd64",
+        "http://h/pub/CHECKSUMS",
+        "http://h/pub/a.iso.sha256",
+        "http://h/pub/a.iso.MD5",
+    ],
+)
+def test_is_checksum_file(url):
+    assert is_checksum_file(url)
+
+
+@pytest.mark.parametrize(
+    "url",
+    [
+        "http://h/pub/a.iso",
+        "http://h/pub/sha256.c",
+        "http://h/pub/SHA256/",
+        "http://h/pub/a.sha256.sig",
+        "http://h/pub/mysha256",
+    ],
+)
+def test_not_checksum_file(url):
+    assert not is_checksum_file(url)
+
+
+def test_parse_bsd_and_gnu():
+    data = f"""-----BEGIN PGP SIGNED MESSAGE-----
+SHA256 (a.iso) = {SHA256.upper()}
+MD5 (sub/b c.img) = {MD5}
+{SHA256}  ./c.tar.gz
+{MD5} *d%20e.bin
+deadbeef  too-short
+""".encode()
+    assert parse_checksums(data, "http://h/pub/SHA256SUMS") == {
+        "http://h/pub/a.iso": ("sha256", SHA256),
+        "http://h/pub/sub/b c.img": ("md5", MD5),
+        "http://h/pub/c.tar.gz": ("sha256", SHA256),
+        "http://h/pub/d e.bin": ("md5", MD5),
+    }
+
+
+def test_parse_single_file_sum():
+    data = f"{SHA256}\n".encode()
+    assert parse_checksums(data, "http://h/pub/a.iso.sha256") == {
+        "http://h/pub/a.iso": ("sha256", SHA256)
+    }
+
+
+def test_hash_path(tmp_path):
+    path = tmp_path / "f"
+    path.write_bytes(b"abc" * 1000)
+    digest, total, took = hash_path(str(path), "sha1", 1000)
+    assert digest == hashlib.sha1(b"abc" * 1000).hexdigest()
+    assert total == 3000 and took >= 0
+
+
+def test_verifier(tmp_path, monkeypatch):
+    files = {"good.iso": b"good", "old.img": b"md5 checked", "bad.iso": b"corrupt"}
+    paths = {}
+    for name, data in files.items():
+        paths[name] = tmp_path / name
+        paths[name].write_bytes(data)
+    sums = (
+        f"SHA256 (good.iso) = {hashlib.sha256(b'good').hexdigest()}\n"
+        f"SHA256 (bad.iso) = {hashlib.sha256(b'intact').hexdigest()}\n"
+        f"{hashlib.md5(b'md5 checked').hexdigest()}  old.img\n"
+    ).encode()
+    monkeypatch.setattr(verify, "fetch_bytes", lambda url: sums)
+
+    verify_q, fetch_q, sig_q = Queue(), Queue(), Queue()
+    v = Verifier(verify_q, fetch_q, logging.getLogger("test"), sig_q, Queue(), 1)
+    base = "http://h/pub"
+    # a file that arrives before its checksum waits for it
+    verify_q.put(("file", f"{base}/good.iso", str(paths["good.iso"]), None))
+    verify_q.put(("sums", f"{base}/SHA256SUMS"))
+    digest = hashlib.sha256(b"corrupt").hexdigest()
+    verify_q.put(("file", f"{base}/bad.iso", str(paths["bad.iso"]), digest))
+    verify_q.put(("file", f"{base}/old.img", str(paths["old.img"]), None))
+    verify_q.put(("file", f"{base}/unlisted", str(tmp_path / "unlisted"), None))
+    v.start()
+    verify_q.join()
+    sig_q.put(True)
+    v.join(30)
+
+    st = v.stats()
+    assert (st.sums, st.verified, st.failed, st.refetched) == (1, 2, 1, 1)
+    assert (st.streamed, st.unverified) == (1, 1)
+    assert st.hashed == len(b"good") + len(b"md5 checked")
+    assert list(fetch_q.queue) == [f"{base}/bad.iso"]
+    assert not paths["bad.iso"].exists()